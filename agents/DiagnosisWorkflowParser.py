@@ -10,11 +10,10 @@ from tools.Actions import Actions, is_valid_action
 from tools.utils import (
     count_matches,
     count_radiology_modality_and_organ_matches,
-    REGION_EXACT_DICT,
-    REGION_SUBSTR_DICT,
-    MODALITY_EXACT_DICT,
-    MODALITY_SUBSTR_DICT,
-    MODALITY_SPECIAL_CASES_DICT,
+    get_lab_test_mapping,
+    LabTestMapping,
+    RADIOLOGY_MODALITY_MATCHER,
+    RADIOLOGY_REGION_MATCHER,
     UNIQUE_MODALITY_TO_ORGAN_MAPPING,
 )
 from agents.AgentAction import AgentAction
@@ -41,7 +40,7 @@ class InvalidActionError(Exception):
 
 
 class DiagnosisWorkflowParser(AgentOutputParser):
-    lab_test_mapping_df: pd.DataFrame
+    lab_test_mapping_df: Union[pd.DataFrame, LabTestMapping]
     custom_parsings: int = 0
     action: str = ""
     action_input: Union[List[str], Dict] = None
@@ -154,17 +153,8 @@ class DiagnosisWorkflowParser(AgentOutputParser):
             # action_keywords = extract_keywords_spacy(action)
 
             # Check if imaging modality is directly given as action
-            modality_counts = count_matches(
-                self.action,
-                exact_dict=MODALITY_EXACT_DICT,
-                substr_dict=MODALITY_SUBSTR_DICT,
-                special_cases_dict=MODALITY_SPECIAL_CASES_DICT,
-            )
-            organ_counts = count_matches(
-                self.action,
-                exact_dict=REGION_EXACT_DICT,
-                substr_dict=REGION_SUBSTR_DICT,
-            )
+            modality_counts = RADIOLOGY_MODALITY_MATCHER.count(self.action)
+            organ_counts = RADIOLOGY_REGION_MATCHER.count(self.action)
 
             # Valid imaging keywords should make up more than 25% of the action keywords or else it is likely a false positive
             if sum(modality_counts.values()) + sum(organ_counts.values()) > 0.25 * len(
@@ -173,7 +163,7 @@ class DiagnosisWorkflowParser(AgentOutputParser):
                 self.action_input_prepend = self.action
                 self.action = "Imaging"
 
-            lab_test_names = self.lab_test_mapping_df["label"].tolist()
+            lab_test_names = get_lab_test_mapping(self.lab_test_mapping_df).labels
 
             # Remove single character tests (most importantly the test "I")
             lab_test_names = [name for name in lab_test_names if len(name) > 1]
@@ -1,6 +1,5 @@
 import pickle
 from typing import List, Tuple, Union, Dict, Any
-from hashlib import sha256
 import pandas as pd
 
 from langchain.agents import AgentExecutor
@@ -20,39 +19,76 @@ from agents.prompts import (
     DIAG_CRIT_TOOL_USE_EXAMPLE,
 )
 from agents.DiagnosisWorkflowParser import DiagnosisWorkflowParser
+from agents.summary_cache import TextSummaryCache, summary_template
 from tools.Tools import (
     RunLaboratoryTests,
     RunImaging,
     DoPhysicalExamination,
     ReadDiagnosticCriteria,
 )
-from tools.utils import action_input_pretty_printer
+from tools.utils import (
+    action_input_pretty_printer,
+    get_lab_test_mapping,
+    LabTestMapping,
+)
 from utils.nlp import calculate_num_tokens, truncate_text
 
 STOP_WORDS = ["Observation:", "Observations:", "observation:", "observations:"]
 
 
-class TextSummaryCache:
-    def __init__(self):
-        self.cache = {}
+# Summing the tokens of separately tokenized parts differs from tokenizing the joined text by a few tokens at every boundary
+TOKEN_ESTIMATE_SLACK_PER_PART = 4
 
-    def hash_text(self, text):
-        return sha256(text.encode()).hexdigest()
 
-    def add_summary(self, text, summary):
-        text_hash = self.hash_text(text)
-        if text_hash in self.cache:
-            return
-        self.cache[text_hash] = summary
+class ScratchpadTokenCounter:
+    """
+    Running token count of the prompt. The prompt with the input is tokenized once per input and every step of the
+    scratchpad once when it is appended, so the cost of a step only grows with the new text.
+    """
 
-    def get_summary(self, text):
-        text_hash = self.hash_text(text)
-        return self.cache.get(text_hash, None)
+    def __init__(self):
+        self.input = None
+        self.prompt_and_input_tokens = 0
+        self.step_texts = []
+        self.step_tokens = []
+        self.total_tokens = 0
+
+    def count_prompt_and_input(self, tokenizer, prompt, input):
+        if input != self.input:
+            # New patient, steps of the previous one are not reused
+            self.input = input
+            self.prompt_and_input_tokens = calculate_num_tokens(
+                tokenizer, [prompt.format(input=input, agent_scratchpad="")]
+            )
+            self.step_texts = []
+            self.step_tokens = []
+        return self.prompt_and_input_tokens
+
+    def count_steps(self, tokenizer, step_texts):
+        for indx, step_text in enumerate(step_texts):
+            if indx < len(self.step_texts) and self.step_texts[indx] == step_text:
+                continue
+            del self.step_texts[indx:]
+            del self.step_tokens[indx:]
+            self.step_texts.append(step_text)
+            self.step_tokens.append(calculate_num_tokens(tokenizer, [step_text]))
+        return sum(self.step_tokens[: len(step_texts)])
+
+    def estimate(self, tokenizer, prompt, input, step_texts):
+        """
+        Returns:
+            total_tokens (int): Estimate of the tokens of the prompt formatted with the input and the joined steps
+        """
+        self.total_tokens = self.count_prompt_and_input(
+            tokenizer, prompt, input
+        ) + self.count_steps(tokenizer, step_texts)
+        return self.total_tokens
 
 
 class CustomZeroShotAgent(ZeroShotAgent):
-    lab_test_mapping_df: pd.DataFrame = None
+    lab_test_mapping_df: Union[pd.DataFrame, LabTestMapping] = None
     observation_summary_cache: TextSummaryCache = TextSummaryCache()
+    token_counter: ScratchpadTokenCounter = ScratchpadTokenCounter()
     stop: List[str]
     max_context_length: int
     tags: Dict[str, str]
@@ -66,6 +102,25 @@ class CustomZeroShotAgent(ZeroShotAgent):
     def _stop(self) -> List[str]:
         return self.stop
 
+    # The estimate only decides when it is clearly below the limit. Close to the limit the prompt is tokenized as a whole
+    def _over_context_limit(
+        self, input, thoughts, estimated_tokens=None, num_steps=0
+    ) -> bool:
+        limit = self.max_context_length - 100
+        if (
+            estimated_tokens is not None
+            and estimated_tokens + TOKEN_ESTIMATE_SLACK_PER_PART * (num_steps + 1)
+            < limit
+        ):
+            return False
+        return (
+            calculate_num_tokens(
+                self.llm_chain.llm.tokenizer,
+                [self.llm_chain.prompt.format(input=input, agent_scratchpad=thoughts)],
+            )
+            >= limit
+        )
+
     # Need to override to pass input so that we can calculate the number of tokes
     def get_full_inputs(
         self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any
@@ -81,46 +136,27 @@ class CustomZeroShotAgent(ZeroShotAgent):
         self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any
     ) -> Union[str, List[BaseMessage]]:
         """Construct the scratchpad that lets the agent continue its thought process."""
-        thoughts = ""
-        for action, observation in intermediate_steps:
-            thoughts += action.log
-            thoughts += (
-                f"\n{self.observation_prefix}{observation.strip()}\n{self.llm_prefix} "
-            )
-        if (
-            calculate_num_tokens(
-                self.llm_chain.llm.tokenizer,
-                [
-                    self.llm_chain.prompt.format(
-                        input=kwargs["input"],
-                        agent_scratchpad=thoughts,
-                    )
-                ],
-            )
-            >= self.max_context_length - 100
-        ) and self.summarize:
+        tokenizer = self.llm_chain.llm.tokenizer
+        step_texts = [
+            action.log
+            + f"\n{self.observation_prefix}{observation.strip()}\n{self.llm_prefix} "
+            for action, observation in intermediate_steps
+        ]
+        thoughts = "".join(step_texts)
+        estimated_tokens = self.token_counter.estimate(
+            tokenizer, self.llm_chain.prompt, kwargs["input"], step_texts
+        )
+        over_limit = self._over_context_limit(
+            kwargs["input"], thoughts, estimated_tokens, len(step_texts)
+        )
+        if over_limit and self.summarize:
             thoughts = self._summarize_steps(intermediate_steps)
+            over_limit = self._over_context_limit(kwargs["input"], thoughts)
 
         # Worst worst case, we are still over or close to the limit even after summarizing and thus should truncate and force a diagnosis
-        if (
-            calculate_num_tokens(
-                self.llm_chain.llm.tokenizer,
-                [
-                    self.llm_chain.prompt.format(
-                        input=kwargs["input"],
-                        agent_scratchpad=thoughts,
-                    )
-                ],
-            )
-            >= self.max_context_length - 100
-        ):
-            prompt_and_input_tokens = calculate_num_tokens(
-                self.llm_chain.llm.tokenizer,
-                [
-                    self.llm_chain.prompt.format(
-                        input=kwargs["input"], agent_scratchpad=""
-                    )
-                ],
+        if over_limit:
+            prompt_and_input_tokens = self.token_counter.count_prompt_and_input(
+                tokenizer, self.llm_chain.prompt, kwargs["input"]
             )
             # Could be that input is already over limit and we need to truncate input
             if prompt_and_input_tokens > self.max_context_length - 100:
@@ -159,6 +195,11 @@ class CustomZeroShotAgent(ZeroShotAgent):
             },
         )
         chain = LLMChain(llm=self.llm_chain.llm, prompt=prompt)
+        # Observations are truncated to fit the context length, so summaries are only shared between equal context lengths
+        template = (
+            summary_template(prompt, [])
+            + f"\nmax_context_length={self.max_context_length}"
+        )
         summaries = []
         summaries.append("A summary of information I know thus far:")
         for indx, (action, observation) in enumerate(intermediate_steps):
@@ -178,7 +219,9 @@ class CustomZeroShotAgent(ZeroShotAgent):
                         )
                     )
                 # Check cache to not re-summarize same observation
-                summary = self.observation_summary_cache.get_summary(observation)
+                summary = self.observation_summary_cache.get_summary(
+                    observation, template
+                )
                 if not summary:
                     # Summary of each step should be minimal and should not exceed max_context_length
                     prompt_tokens = calculate_num_tokens(
@@ -188,16 +231,19 @@ class CustomZeroShotAgent(ZeroShotAgent):
                         ],
                     )
 
-                    observation = truncate_text(
+                    # The cache is keyed by the complete observation, the context length in the template determines its truncation
+                    truncated_observation = truncate_text(
                         self.llm_chain.llm.tokenizer,
                         observation,
                         self.max_context_length
                         - prompt_tokens
                         - 100,  # Gives a max of 100 tokens to generate for the summary if we are near context length limit. Usually only used when model does really weird infinite generations of action inputs and doesnt hit a stop token so shouldnt be much actual info to summarize anyway
                     )
-                    summary = chain.predict(observation=observation, stop=[])
+                    summary = chain.predict(observation=truncated_observation, stop=[])
                     # Add to cache
-                    self.observation_summary_cache.add_summary(observation, summary)
+                    self.observation_summary_cache.add_summary(
+                        observation, summary, template
+                    )
                 summaries.append("Observation: " + summary)
             else:
                 # Include invalid requests in summary to not run into infinite loop of same invalid tool being ordered
@@ -238,6 +284,114 @@ def create_prompt(
     return template
 
 
+class AgentSession:
+    """
+    Builds everything that does not depend on the patient once per run: the lab test mapping and its label index, the tools, prompt, output parser, agent and executor.
+    Only the patient specific state of the tools is rebound in build_agent_executor for every admission.
+    """
+
+    def __init__(
+        self,
+        llm,
+        lab_test_mapping_df,
+        logfile,
+        max_context_length,
+        tags,
+        include_ref_range,
+        bin_lab_results,
+        include_tool_use_examples,
+        provide_diagnostic_criteria,
+        summarize,
+        model_stop_words,
+        summary_cache=None,
+    ):
+        # Build the label and itemid indexes once. Tools, parser and agent look up tests through them, the session keeps
+        # the DataFrame the mapping refers to alive
+        lab_test_mapping = get_lab_test_mapping(lab_test_mapping_df)
+        self.lab_test_mapping_df = lab_test_mapping_df
+        self.lab_test_mapping = lab_test_mapping
+
+        # Define which tools the agent can use to answer user queries
+        self.patient_tools = [
+            DoPhysicalExamination(),
+            RunLaboratoryTests(
+                lab_test_mapping_df=lab_test_mapping,
+                include_ref_range=include_ref_range,
+                bin_lab_results=bin_lab_results,
+            ),
+            RunImaging(),
+        ]
+        tools = list(self.patient_tools)
+
+        # Go through options and see if we want to add any extra tools.
+        add_tool_use_examples = ""
+        add_tool_descr = ""
+        if provide_diagnostic_criteria:
+            tools.append(ReadDiagnosticCriteria())
+            add_tool_descr += DIAG_CRIT_TOOL_DESCR
+            add_tool_use_examples += DIAG_CRIT_TOOL_USE_EXAMPLE
+
+        tool_names = [tool.name for tool in tools]
+
+        # Create prompt
+        tool_use_examples = ""
+        if include_tool_use_examples:
+            tool_use_examples = TOOL_USE_EXAMPLES.format(
+                add_tool_use_examples=add_tool_use_examples
+            )
+        prompt = create_prompt(tags, tool_names, add_tool_descr, tool_use_examples)
+
+        # Create output parser
+        output_parser = DiagnosisWorkflowParser(lab_test_mapping_df=lab_test_mapping)
+
+        # Initialize logging callback if file provided
+        handler = None
+        if logfile:
+            handler = [FileCallbackHandler(logfile)]
+
+        # LLM chain consisting of the LLM and a prompt
+        llm_chain = LLMChain(llm=llm, prompt=prompt, callbacks=handler)
+
+        # Create agent
+        self.agent = CustomZeroShotAgent(
+            llm_chain=llm_chain,
+            output_parser=output_parser,
+            stop=list(STOP_WORDS + model_stop_words),
+            allowed_tools=tool_names,
+            verbose=True,
+            return_intermediate_steps=True,
+            max_context_length=max_context_length,
+            tags=tags,
+            lab_test_mapping_df=lab_test_mapping,
+            summarize=summarize,
+        )
+        # Summaries of a shared cache are kept across patients
+        self.summary_cache = summary_cache
+        if summary_cache is not None:
+            self.agent.observation_summary_cache = summary_cache
+
+        # Init agent executor
+        self.agent_executor = AgentExecutor.from_agent_and_tools(
+            agent=self.agent,
+            tools=tools,
+            verbose=True,
+            max_iterations=10,
+            return_intermediate_steps=True,
+            callbacks=handler,
+        )
+
+    def build_agent_executor(self, patient):
+        # Rebind the patient and reset all state that must not leak from the previous patient
+        for tool in self.patient_tools:
+            tool.action_results = patient
+            if isinstance(tool, RunImaging):
+                tool.already_requested_scans = {}
+        if self.summary_cache is None:
+            self.agent.observation_summary_cache = TextSummaryCache()
+        self.agent.token_counter = ScratchpadTokenCounter()
+        return self.agent_executor
+
+
 def build_agent_executor_ZeroShot(
     patient,
     llm,
@@ -252,72 +406,20 @@ def build_agent_executor_ZeroShot(
     summarize,
     model_stop_words,
 ):
+    # Convenience for building a single executor. When running over many patients, create one AgentSession instead
     with open(lab_test_mapping_path, "rb") as f:
         lab_test_mapping_df = pickle.load(f)
-
-    # Define which tools the agent can use to answer user queries
-    tools = [
-        DoPhysicalExamination(action_results=patient),
-        RunLaboratoryTests(
-            action_results=patient,
-            lab_test_mapping_df=lab_test_mapping_df,
-            include_ref_range=include_ref_range,
-            bin_lab_results=bin_lab_results,
-        ),
-        RunImaging(action_results=patient),
-    ]
-
-    # Go through options and see if we want to add any extra tools.
-    add_tool_use_examples = ""
-    add_tool_descr = ""
-    if provide_diagnostic_criteria:
-        tools.append(ReadDiagnosticCriteria())
-        add_tool_descr += DIAG_CRIT_TOOL_DESCR
-        add_tool_use_examples += DIAG_CRIT_TOOL_USE_EXAMPLE
-
-    tool_names = [tool.name for tool in tools]
-
-    # Create prompt
-    tool_use_examples = ""
-    if include_tool_use_examples:
-        tool_use_examples = TOOL_USE_EXAMPLES.format(
-            add_tool_use_examples=add_tool_use_examples
-        )
-    prompt = create_prompt(tags, tool_names, add_tool_descr, tool_use_examples)
-
-    # Create output parser
-    output_parser = DiagnosisWorkflowParser(lab_test_mapping_df=lab_test_mapping_df)
-
-    # Initialize logging callback if file provided
-    handler = None
-    if logfile:
-        handler = [FileCallbackHandler(logfile)]
-
-    # LLM chain consisting of the LLM and a prompt
-    llm_chain = LLMChain(llm=llm, prompt=prompt, callbacks=handler)
-
-    # Create agent
-    agent = CustomZeroShotAgent(
-        llm_chain=llm_chain,
-        output_parser=output_parser,
-        stop=list(STOP_WORDS + model_stop_words),
-        allowed_tools=tool_names,
-        verbose=True,
-        return_intermediate_steps=True,
+    session = AgentSession(
+        llm=llm,
+        lab_test_mapping_df=lab_test_mapping_df,
+        logfile=logfile,
         max_context_length=max_context_length,
         tags=tags,
-        lab_test_mapping_df=lab_test_mapping_df,
+        include_ref_range=include_ref_range,
+        bin_lab_results=bin_lab_results,
+        include_tool_use_examples=include_tool_use_examples,
+        provide_diagnostic_criteria=provide_diagnostic_criteria,
         summarize=summarize,
+        model_stop_words=model_stop_words,
     )
-
-    # Init agent executor
-    agent_executor = AgentExecutor.from_agent_and_tools(
-        agent=agent,
-        tools=tools,
-        verbose=True,
-        max_iterations=10,
-        return_intermediate_steps=True,
-        callbacks=handler,
-    )
-
-    return agent_executor
+    return session.build_agent_executor(patient)
@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import threading
+import time
+from hashlib import sha256
+
+
+class TextSummaryCache:
+    """
+    In-memory cache of observation summaries. The template identifies the prompt and settings the summary was created
+    with so that summaries of different prompts are not mixed.
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def hash_text(self, text):
+        return sha256(text.encode()).hexdigest()
+
+    def add_summary(self, text, summary, template=""):
+        key = (self.hash_text(template), self.hash_text(text))
+        if key in self.cache:
+            return
+        self.cache[key] = summary
+
+    def get_summary(self, text, template=""):
+        key = (self.hash_text(template), self.hash_text(text))
+        summary = self.cache.get(key, None)
+        self.count(summary)
+        return summary
+
+    def count(self, summary):
+        if summary is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class DiskSummaryCache(TextSummaryCache):
+    """
+    Summary cache in a SQLite database that is shared between runs and processes. Entries are keyed by model name,
+    template hash and observation hash. When the cache grows beyond max_entries, the least recently used entries are
+    evicted.
+    """
+
+    # Check the size of the cache every this many insertions
+    EVICTION_INTERVAL = 256
+
+    def __init__(self, path, model_name, max_entries=100_000):
+        super().__init__()
+        self.path = path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.insertions = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+        with self.lock:
+            self.evict()
+
+    def connect(self):
+        # SQLite connections must not be shared with forked processes, so every process opens its own
+        if self.connection is None or self.connection_pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self.connection_pid = os.getpid()
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                "model TEXT NOT NULL, "
+                "template_hash TEXT NOT NULL, "
+                "observation_hash TEXT NOT NULL, "
+                "summary TEXT NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (model, template_hash, observation_hash))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def add_summary(self, text, summary, template=""):
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                "INSERT OR IGNORE INTO summaries VALUES (?, ?, ?, ?, ?)",
+                (
+                    self.model_name,
+                    self.hash_text(template),
+                    self.hash_text(text),
+                    summary,
+                    time.time(),
+                ),
+            )
+            connection.commit()
+            self.insertions += 1
+            if self.insertions % self.EVICTION_INTERVAL == 0:
+                self.evict()
+
+    def get_summary(self, text, template=""):
+        key = (self.model_name, self.hash_text(template), self.hash_text(text))
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute(
+                "SELECT summary FROM summaries "
+                "WHERE model = ? AND template_hash = ? AND observation_hash = ?",
+                key,
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE summaries SET last_used = ? "
+                    "WHERE model = ? AND template_hash = ? AND observation_hash = ?",
+                    (time.time(), *key),
+                )
+                connection.commit()
+        summary = row[0] if row is not None else None
+        self.count(summary)
+        return summary
+
+    def evict(self):
+        connection = self.connect()
+        connection.execute(
+            "DELETE FROM summaries WHERE rowid IN ("
+            "SELECT rowid FROM summaries ORDER BY last_used ASC "
+            "LIMIT MAX((SELECT COUNT(*) FROM summaries) - ?, 0))",
+            (self.max_entries,),
+        )
+        connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connect().execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+
+
+def create_summary_cache(path, model_name, max_entries=100_000):
+    """Disk backed cache if a path is given, otherwise an in-memory cache"""
+    if path:
+        return DiskSummaryCache(path, model_name, max_entries)
+    return TextSummaryCache()
+
+
+def summary_template(prompt, stop):
+    # Identifies the prompt with all tags filled in and the stop words of a summarization
+    return prompt.format(observation="") + "\n".join(stop)
+
+
+def summarize_with_cache(chain, observation, stop, summary_cache=None):
+    """
+    Summarize an observation with an LLMChain with a single observation input, reusing cached summaries if a cache is given
+    """
+    if summary_cache is None:
+        return chain.predict(observation=observation, stop=stop)
+    template = summary_template(chain.prompt, stop)
+    summary = summary_cache.get_summary(observation, template)
+    if summary is None:
+        summary = chain.predict(observation=observation, stop=stop)
+        summary_cache.add_summary(observation, summary, template)
+    return summary
@@ -0,0 +1,100 @@
+"""
+Benchmark of the compiled count_matches against the uncompiled reference implementation.
+
+Uses typical MIMIC-IV radiology exam names and imaging requests of the agent, as classified for every radiology note
+during dataset creation and for every imaging action of the agent, and free text actions checked for lab test names.
+
+Usage: python -m benchmarks.count_matches --repeats 200
+"""
+import argparse
+import time
+
+from tools.utils import (
+    count_matches,
+    count_matches_iterative,
+    ADDITIONAL_LAB_TEST_MAPPING,
+    MODALITY_EXACT_DICT,
+    MODALITY_SUBSTR_DICT,
+    MODALITY_SPECIAL_CASES_DICT,
+    REGION_EXACT_DICT,
+    REGION_SUBSTR_DICT,
+)
+
+EXAM_NAMES = [
+    "CT ABD & PELVIS WITH CONTRAST",
+    "CT ABDOMEN W/CONTRAST",
+    "CHEST (PA & LAT)",
+    "CHEST (PORTABLE AP)",
+    "LIVER OR GALLBLADDER US (SINGLE ORGAN)",
+    "US ABD LIMIT, SINGLE ORGAN",
+    "MRCP",
+    "MR ABDOMEN W/O CONTRAST",
+    "ERCP BILIARY&PANCREAS BY GI UNIT",
+    "BILIARY (HIDA) SCAN",
+    "PORTABLE ABDOMEN",
+    "UNILAT LOWER EXT VEINS",
+    "CTA CHEST W&W/O C&RECONS, NON-CORONARY",
+    "PELVIS US, TRANSVAGINAL & TRANSABDOMINAL",
+    "DRAINAGE OF ABSCESS/COLLECTION",
+    "UGI SGL CONTRAST W/ KUB",
+    "Abdominal Ultrasound",
+    "CT of the abdomen and pelvis with IV contrast",
+    "Upper GI series",
+    "Endoscopic ultrasound",
+]
+
+FREE_TEXT_ACTIONS = [
+    "Complete Blood Count, Basic Metabolic Panel, Lipase and Liver Function Tests",
+    "I would like to order a CRP and a urinalysis",
+    "Check the lactate and blood cultures",
+]
+
+
+def time_function(count_function, texts, kwargs, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        results = [count_function(text, **kwargs) for text in texts]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    cases = {
+        "modality": (
+            EXAM_NAMES,
+            {
+                "exact_dict": MODALITY_EXACT_DICT,
+                "substr_dict": MODALITY_SUBSTR_DICT,
+                "special_cases_dict": MODALITY_SPECIAL_CASES_DICT,
+            },
+        ),
+        "region": (
+            EXAM_NAMES,
+            {"exact_dict": REGION_EXACT_DICT, "substr_dict": REGION_SUBSTR_DICT},
+        ),
+        "lab test names": (
+            FREE_TEXT_ACTIONS,
+            {"exact_dict": {"names": [name for name in ADDITIONAL_LAB_TEST_MAPPING if len(name) > 1]}},
+        ),
+    }
+
+    for name, (texts, kwargs) in cases.items():
+        reference_time, reference = time_function(count_matches_iterative, texts, kwargs, args.repeats)
+        compiled_time, compiled = time_function(count_matches, texts, kwargs, args.repeats)
+        assert compiled == reference, "Compiled counts differ from the reference"
+        calls = len(texts) * args.repeats
+        print(
+            "{:<15} reference: {:8.2f} us/call | compiled: {:8.2f} us/call | speedup: {:5.1f}x".format(
+                name,
+                reference_time / calls * 1e6,
+                compiled_time / calls * 1e6,
+                reference_time / compiled_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
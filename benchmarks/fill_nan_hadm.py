@@ -0,0 +1,93 @@
+"""
+Benchmark of the vectorized fill_nan_hadm against the iterative reference implementation on synthetic data.
+
+The defaults approximate a cohort of one pathology after filtering MIMIC-IV to the subjects of the cohort.
+
+Usage: python -m benchmarks.fill_nan_hadm --n_admissions 5000 --n_lab_events 2000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from dataset.dataset import fill_nan_hadm, fill_nan_hadm_iterative
+
+
+def create_synthetic_data(n_admissions, n_lab_events, n_radiology, n_microbiology, seed=2023):
+    rng = np.random.default_rng(seed)
+    hadm_ids = np.arange(n_admissions) + 20000000
+    # Some subjects have multiple admissions so that admission windows can overlap
+    subject_ids = rng.integers(10000000, 10000000 + int(n_admissions * 0.8), n_admissions)
+    hadm_to_subject_id = dict(zip(hadm_ids, subject_ids))
+
+    admit_times = pd.Timestamp("2150-01-01") + pd.to_timedelta(rng.integers(0, 365 * 10, n_admissions), "D")
+    n_transfers = rng.integers(1, 5, n_admissions)
+    transfers_df = pd.DataFrame(
+        {
+            "hadm_id": np.repeat(hadm_ids, n_transfers),
+            "intime": np.repeat(admit_times, n_transfers)
+            + pd.to_timedelta(rng.integers(0, 24 * 14, n_transfers.sum()), "h"),
+        }
+    )
+
+    def create_events(n_rows):
+        admission = rng.integers(0, n_admissions, n_rows)
+        charttime = admit_times[admission] + pd.to_timedelta(rng.integers(-24 * 5, 24 * 20, n_rows), "h")
+        hadm_id = np.where(rng.random(n_rows) < 0.4, np.nan, hadm_ids[admission].astype(float))
+        return pd.DataFrame(
+            {
+                "subject_id": subject_ids[admission],
+                "hadm_id": hadm_id,
+                "charttime": charttime,
+            }
+        )
+
+    return (
+        create_events(n_lab_events),
+        create_events(n_radiology),
+        create_events(n_microbiology),
+        list(hadm_ids),
+        transfers_df,
+        hadm_to_subject_id,
+    )
+
+
+def time_fill(fill_function, data):
+    lab_events_df, radiology_df, microbiology_df, disease_ids, transfers_df, hadm_to_subject_id = data
+    start = time.perf_counter()
+    result = fill_function(
+        lab_events_df.copy(),
+        radiology_df.copy(),
+        microbiology_df.copy(),
+        disease_ids,
+        transfers_df,
+        hadm_to_subject_id,
+    )
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_admissions", type=int, default=5000)
+    parser.add_argument("--n_lab_events", type=int, default=2000000)
+    parser.add_argument("--n_radiology", type=int, default=50000)
+    parser.add_argument("--n_microbiology", type=int, default=100000)
+    parser.add_argument("--skip_iterative", action="store_true")
+    args = parser.parse_args()
+
+    data = create_synthetic_data(args.n_admissions, args.n_lab_events, args.n_radiology, args.n_microbiology)
+
+    vectorized_time, vectorized_result = time_fill(fill_nan_hadm, data)
+    print(f"vectorized: {vectorized_time:.2f}s")
+
+    if not args.skip_iterative:
+        iterative_time, iterative_result = time_fill(fill_nan_hadm_iterative, data)
+        print(f"iterative:  {iterative_time:.2f}s ({iterative_time / vectorized_time:.0f}x slower)")
+        for vectorized_df, iterative_df in zip(vectorized_result, iterative_result):
+            pd.testing.assert_frame_equal(vectorized_df, iterative_df)
+        print("Outputs are identical")
+
+
+if __name__ == "__main__":
+    main()
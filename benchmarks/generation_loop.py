@@ -0,0 +1,155 @@
+"""
+Benchmark of the generation loop of ExLlamaV2BaseGenerator against the previous loop, which concatenated every token
+and probability to the sequence and moved the full logits to the host for sampling.
+
+Uses a synthetic model with the vocabulary size of Llama 2 whose forward pass is a single matrix product, so that the
+time of the loop itself dominates. Runs on CUDA if available. Both loops sample greedily with the default repetition
+penalty, as for runs without self consistency, and never stop early.
+
+Usage: python -m benchmarks.generation_loop --num_tokens 1000 --repeats 3
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+import torch
+from exllamav2.generator import ExLlamaV2Sampler
+
+from models.exllamav2_generator_base_custom import ExLlamaV2BaseGenerator
+
+VOCAB_SIZE = 32000
+HIDDEN_SIZE = 256
+
+
+class SyntheticCache:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.current_seq_len = 0
+        self.key_states = []
+        self.value_states = []
+
+
+class SyntheticModel:
+    def __init__(self, max_seq_len, device):
+        self.config = SimpleNamespace(max_seq_len=max_seq_len)
+        dtype = torch.half if device.type == "cuda" else torch.float
+        generator = torch.Generator().manual_seed(0)
+        self.embedding = torch.randn(
+            (VOCAB_SIZE, HIDDEN_SIZE), generator=generator
+        ).to(device, dtype)
+        self.head = torch.randn((HIDDEN_SIZE, VOCAB_SIZE), generator=generator).to(
+            device, dtype
+        )
+        self.device = device
+
+    def forward(self, input_ids, cache, input_mask=None, preprocess_only=False, loras=None):
+        cache.current_seq_len += input_ids.shape[-1]
+        if preprocess_only:
+            return None
+        hidden = self.embedding[input_ids.to(self.device)]
+        return hidden @ self.head
+
+
+class SyntheticTokenizer:
+    pad_token_id = 0
+
+    def __init__(self, prompt_length):
+        generator = torch.Generator().manual_seed(1)
+        self.ids = torch.randint(1, VOCAB_SIZE, (1, prompt_length), generator=generator)
+
+    def encode(self, text, encode_special_tokens=False):
+        return self.ids.clone()
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def concatenating_loop(model, cache, tokenizer, settings, num_tokens):
+    """Previous loop of generate_simple for one prompt"""
+    sequence_ids = tokenizer.encode("")
+    cache.current_seq_len = 0
+    model.forward(sequence_ids[:, :-1], cache, preprocess_only=True)
+    probabilities_sequence = torch.tensor([[]])
+    for _ in range(num_tokens):
+        logits = model.forward(sequence_ids[:, -1:], cache).float().cpu()
+        token, probabilities, eos = ExLlamaV2Sampler.sample(
+            logits, settings, sequence_ids, random.random(), tokenizer
+        )
+        sequence_ids = torch.cat([sequence_ids, token], dim=1)
+        probabilities_sequence = torch.cat(
+            [probabilities_sequence, probabilities], dim=1
+        )
+        if eos:
+            break
+    return sequence_ids, probabilities_sequence
+
+
+def preallocated_loop(generator, settings, num_tokens):
+    return generator.generate_simple(
+        "", settings, num_tokens, stop_criteria=lambda input_ids, scores: False
+    )
+
+
+def benchmark(name, loop, num_tokens, repeats, device):
+    loop()
+    timings = []
+    for _ in range(repeats):
+        synchronize(device)
+        start = time.perf_counter()
+        loop()
+        synchronize(device)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"{name}: {best:.3f}s, {num_tokens / best:.1f} tokens/s")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num_tokens", type=int, default=1000)
+    parser.add_argument("--prompt_length", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = SyntheticModel(args.prompt_length + args.num_tokens, device)
+    cache = SyntheticCache(batch_size=1)
+    tokenizer = SyntheticTokenizer(args.prompt_length)
+    generator = ExLlamaV2BaseGenerator(model, cache, tokenizer)
+    settings = ExLlamaV2Sampler.Settings().greedy_clone()
+
+    print(
+        f"Device: {device}, vocabulary: {VOCAB_SIZE}, prompt: {args.prompt_length} tokens, "
+        f"generated: {args.num_tokens} tokens"
+    )
+    with torch.inference_mode():
+        reference_ids, _ = concatenating_loop(
+            model, cache, tokenizer, settings, args.num_tokens
+        )
+        ids, _ = preallocated_loop(generator, settings, args.num_tokens)
+        assert torch.equal(ids, reference_ids), "Loops generated different tokens"
+
+        reference = benchmark(
+            "Concatenating loop, host sampling",
+            lambda: concatenating_loop(
+                model, cache, tokenizer, settings, args.num_tokens
+            ),
+            args.num_tokens,
+            args.repeats,
+            device,
+        )
+        preallocated = benchmark(
+            "Preallocated loop, device sampling",
+            lambda: preallocated_loop(generator, settings, args.num_tokens),
+            args.num_tokens,
+            args.repeats,
+            device,
+        )
+    print(f"Speedup: {reference / preallocated:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import shutil
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+# Bump whenever load_data changes the content of the frames it returns so that stale caches are not reused
+CACHE_VERSION = 1
+
+# Raw MIMIC-IV files read by load_data, relative to base_mimic
+RAW_FILES = [
+    join("hosp", "admissions.csv"),
+    join("hosp", "transfers.csv"),
+    join("hosp", "diagnoses_icd.csv"),
+    join("hosp", "d_icd_diagnoses.csv"),
+    join("hosp", "procedures_icd.csv"),
+    join("hosp", "d_icd_procedures.csv"),
+    join("hosp", "microbiologyevents.csv"),
+    join("hosp", "labevents.csv"),
+    join("hosp", "d_labitems.csv"),
+    join("note", "discharge.csv"),
+    join("note", "radiology.csv"),
+    join("note", "radiology_detail.csv"),
+]
+
+# Names of the frames returned by load_data, in return order
+FRAME_NAMES = [
+    "admissions_df",
+    "transfers_df",
+    "diag_icd",
+    "procedures_df",
+    "discharge_df",
+    "radiology_report_df",
+    "radiology_report_details_df",
+    "lab_events_df",
+    "microbiology_df",
+]
+
+
+def fingerprint_raw_files(base_mimic, hadm_ids=None):
+    """
+    Create the cache key of a load_data call from the path, mtime and size of every raw file and the requested cohort.
+    Replacing or touching any raw file therefore invalidates the cache.
+
+    Args:
+        base_mimic (str): Path to the MIMIC-IV root directory
+        hadm_ids (array-like): Optional cohort passed to load_data
+
+    Returns:
+        key (str): Hex digest identifying the cached frames
+    """
+    files = []
+    for raw_file in RAW_FILES:
+        stat = os.stat(join(base_mimic, raw_file))
+        files.append([raw_file, stat.st_mtime_ns, stat.st_size])
+
+    cohort = None
+    if hadm_ids is not None:
+        cohort = sorted(int(_id) for _id in set(hadm_ids))
+
+    description = {
+        "version": CACHE_VERSION,
+        "base_mimic": os.path.abspath(base_mimic),
+        "files": files,
+        "hadm_ids": cohort,
+    }
+    return hashlib.sha256(
+        json.dumps(description, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def cache_path(cache_dir, key):
+    return join(cache_dir, "load_data_{}".format(key))
+
+
+def write_frames_to_cache(frames, cache_dir, key):
+    """
+    Write the frames returned by load_data as one parquet file each into a directory named after the key.
+
+    Args:
+        frames (tuple): Frames in the order of FRAME_NAMES
+        cache_dir (str): Directory holding all cached versions
+        key (str): Key from fingerprint_raw_files
+    """
+    path = cache_path(cache_dir, key)
+    tmp_path = path + ".tmp"
+    # Write into a temporary directory first so that an interrupted write is never picked up as a valid cache
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, df in zip(FRAME_NAMES, frames):
+        df.to_parquet(join(tmp_path, name + ".parquet"))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_frames_from_cache(cache_dir, key):
+    """
+    Load the frames written by write_frames_to_cache.
+
+    Returns:
+        frames (tuple): Frames in the order of FRAME_NAMES or None if there is no cache for the key
+    """
+    path = cache_path(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+
+    frames = []
+    for name in FRAME_NAMES:
+        df = pd.read_parquet(join(path, name + ".parquet"))
+        # Parquet restores missing strings as None. The pipeline checks for NaN with x == x, so restore NaN
+        for col in df.columns[df.dtypes == object]:
+            df[col] = df[col].mask(df[col].isna(), np.nan)
+        frames.append(df)
+    return tuple(frames)
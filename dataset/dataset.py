@@ -5,7 +5,9 @@ import traceback
 from collections import Counter
 from datetime import timedelta
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
 from dataset.discharge import (
     extract_history,
@@ -17,10 +19,22 @@ from dataset.radiology import (
     extract_rad_events,
     sanitize_rad,
 )
-from dataset.labs import parse_lab_events, parse_microbio
+from dataset.labs import parse_lab_events_grouped, parse_microbio_grouped
 from dataset.procedures import extract_procedures
 from dataset.diagnosis import extract_diagnosis_from_diag_df
-from dataset.utils import write_hadm_to_file, print_value_counts
+from dataset.utils import (
+    write_hadm_to_file,
+    print_value_counts,
+    group_rows_by_hadm_id,
+    select_hadm_rows,
+    map_hadm_ids,
+)
+from dataset.cache import (
+    fingerprint_raw_files,
+    cache_path,
+    write_frames_to_cache,
+    load_frames_from_cache,
+)
 from tools.utils import count_radiology_modality_and_organ_matches
 
 
@@ -126,6 +140,7 @@ def extract_info(
     radiology_report_details_df,
     diag_df,
     procedures_df,
+    num_workers=1,
 ):
     # Extract the discharge, history, pe, le and radiology report for hadm_ids
     hadm_info = extract_hadm_info(
@@ -137,6 +152,7 @@ def extract_info(
         microbiology_df,
         radiology_report_df,
         radiology_report_details_df,
+        num_workers=num_workers,
     )
     print("--")
 
@@ -151,25 +167,28 @@ def extract_info(
         print("--")
 
         # Remove mentions of target
-        hadm_info = sanitize_hadm_texts(hadm_info, sanitize_list)
+        hadm_info = sanitize_hadm_texts(hadm_info, sanitize_list, num_workers)
         print("--")
 
         # Extract diagnoses
-        for _id in hadm_info:
+        def extract_discharge_diagnosis(_id):
             try:
-                hadm_info[_id][
-                    "Discharge Diagnosis"
-                ] = extract_diagnosis_from_discharge(hadm_info[_id]["Discharge"])
+                return extract_diagnosis_from_discharge(hadm_info[_id]["Discharge"])
             except Exception as e:
                 print("ID: {}, Error: {}".format(_id, e))
-                hadm_info[_id]["Discharge Diagnosis"] = ""
+                return ""
+
+        for _id, diagnosis in map_hadm_ids(
+            extract_discharge_diagnosis, hadm_info, num_workers
+        ).items():
+            hadm_info[_id]["Discharge Diagnosis"] = diagnosis
         hadm_info = extract_diagnosis_from_diag_df(hadm_info, diag_df)
 
         # Extract procedures
         procedures_df_icd9 = procedures_df[procedures_df["icd_version"] == 9]
         procedures_df_icd10 = procedures_df[procedures_df["icd_version"] == 10]
         hadm_info = extract_procedures(
-            hadm_info, procedures_df_icd9, procedures_df_icd10
+            hadm_info, procedures_df_icd9, procedures_df_icd10, num_workers
         )
 
         # Examine data completeness
@@ -232,22 +251,242 @@ def create_valuestr_microbio(row):
         return comment
 
 
-def load_data(base_mimic: str = ""):
+def create_valuestr_lab_vectorized(lab_events_df):
+    """
+    Column-wise version of create_valuestr_lab. Returns exactly the Series of
+    lab_events_df.apply(create_valuestr_lab, axis=1).
+
+    The same precedence is applied as boolean masks, from lowest to highest priority: comments, flag, value (+ uom),
+    valuenum (+ uom). Numbers are converted with pandas astype(str), which calls str() on every element just like
+    the row version, so the strings are identical.
+    """
+    valuenum = lab_events_df["valuenum"]
+    value = lab_events_df["value"]
+    valueuom = lab_events_df["valueuom"].astype(object)
+
+    has_uom = valueuom.notna().to_numpy()
+    uom_suffix = np.full(len(lab_events_df), "", dtype=object)
+    uom_suffix[has_uom] = " " + valueuom[has_uom].astype(str).to_numpy(dtype=object)
+
+    # Finally, return comments if all else fails
+    valuestr = lab_events_df["comments"].to_numpy(dtype=object, copy=True)
+
+    # Check if flag is not NaN (i.e. abnormal)
+    use_flag = lab_events_df["flag"].notna().to_numpy()
+    valuestr[use_flag] = lab_events_df["flag"].astype(object).to_numpy()[use_flag]
+
+    # Next, try to extract value
+    use_value = (value.notna() & (value != "___")).to_numpy()
+    valuestr[use_value] = (
+        value[use_value].astype(str).to_numpy(dtype=object) + uom_suffix[use_value]
+    )
+
+    # First try to extract valuenum (Value numeric)
+    use_valuenum = (valuenum.notna() & (valuenum != "___")).to_numpy()
+    valuestr[use_valuenum] = (
+        valuenum[use_valuenum].astype(str).to_numpy(dtype=object)
+        + uom_suffix[use_valuenum]
+    )
+
+    return pd.Series(valuestr, index=lab_events_df.index, dtype=object)
+
+
+def create_valuestr_microbio_vectorized(microbiology_df):
+    """
+    Column-wise version of create_valuestr_microbio. Returns exactly the Series of
+    microbiology_df.apply(create_valuestr_microbio, axis=1).
+    """
+    org_name = microbiology_df["org_name"].astype(object)
+    comments = microbiology_df["comments"].astype(object)
+    return org_name.where(org_name.notna(), comments).rename(None)
+
+
+# Columns and dtypes of the large event tables. Only these columns are read, everything else is skipped at parse time
+LAB_EVENTS_DTYPES = {
+    "subject_id": "int64",
+    "hadm_id": "float64",
+    "itemid": "int64",
+    "charttime": "object",
+    "value": "object",
+    "valuenum": "float64",
+    "valueuom": "category",
+    "ref_range_lower": "float64",
+    "ref_range_upper": "float64",
+    "flag": "category",
+    "comments": "object",
+}
+
+MICROBIOLOGY_DTYPES = {
+    "subject_id": "int64",
+    "hadm_id": "float64",
+    "charttime": "object",
+    "spec_itemid": "int64",
+    "test_itemid": "int64",
+    "org_itemid": "float64",
+    "org_name": "object",
+    "comments": "object",
+}
+
+RADIOLOGY_DTYPES = {
+    "note_id": "object",
+    "subject_id": "int64",
+    "hadm_id": "float64",
+    "charttime": "object",
+    "text": "object",
+}
+
+RADIOLOGY_DETAILS_DTYPES = {
+    "note_id": "object",
+    "subject_id": "int64",
+    "field_name": "category",
+    "field_value": "object",
+    "field_ordinal": "int64",
+}
+
+DISCHARGE_DTYPES = {
+    "note_id": "object",
+    "subject_id": "int64",
+    "hadm_id": "int64",
+    "charttime": "object",
+    "text": "object",
+}
+
+DEFAULT_CHUNKSIZE = 1_000_000
+
+
+def read_csv_chunked(
+    path,
+    dtypes,
+    subject_ids=None,
+    chunk_filter=None,
+    parse_dates=(),
+    chunksize=DEFAULT_CHUNKSIZE,
+):
+    """
+    Stream a csv in chunks and keep only the rows that are needed, so that peak memory scales with the kept rows
+    instead of the size of the file.
+
+    Args:
+        path (str): Path to the csv
+        dtypes (dict): Mapping of column to dtype. Only these columns are read. Categorical columns are parsed as
+            strings and converted per chunk, then merged into a single categorical
+        subject_ids (array-like): If given, only rows of these subject_ids are kept
+        chunk_filter (callable): Optional function applied to each chunk that returns the filtered chunk
+        parse_dates (list): Columns to convert to datetime per chunk
+        chunksize (int): Number of rows read at once
+
+    Returns:
+        df (pd.DataFrame): Concatenation of all filtered chunks
+    """
+    categorical_columns = [col for col, dtype in dtypes.items() if dtype == "category"]
+    read_dtypes = {
+        col: "object" if dtype == "category" else dtype for col, dtype in dtypes.items()
+    }
+    if subject_ids is not None:
+        subject_ids = pd.unique(np.asarray(subject_ids))
+
+    chunks = []
+    rows_read = 0
+    for chunk in pd.read_csv(
+        path, usecols=list(dtypes), dtype=read_dtypes, chunksize=chunksize
+    ):
+        rows_read += len(chunk)
+        if subject_ids is not None:
+            chunk = chunk[chunk["subject_id"].isin(subject_ids)]
+        if chunk_filter is not None:
+            chunk = chunk_filter(chunk)
+        chunk = chunk.copy()
+        for col in parse_dates:
+            chunk[col] = pd.to_datetime(chunk[col])
+        for col in categorical_columns:
+            chunk[col] = chunk[col].astype("category")
+        chunks.append(chunk)
+
+    # Dtypes are fixed by read_dtypes, so empty or all-NA chunks cannot change the result dtypes
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=FutureWarning)
+        df = pd.concat(chunks, ignore_index=True)
+    # Categories differ between chunks, so concat falls back to object. Merge them into one categorical
+    for col in categorical_columns:
+        df[col] = union_categoricals(
+            [chunk[col] for chunk in chunks], ignore_order=True
+        )
+    print("Kept {} of {} rows from {}".format(len(df), rows_read, path))
+    return df
+
+
+def load_data(
+    base_mimic: str = "",
+    hadm_ids=None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    cache_dir: str = None,
+):
+    """
+    Load all MIMIC-IV tables needed to create the dataset.
+
+    If cache_dir is given, the preprocessed frames are stored there as parquet, keyed on the mtime and size of the
+    raw files and the cohort. Later calls with unchanged raw files load the frames from the cache instead of parsing
+    the csvs again. See read_mimic_tables for the arguments.
+    """
+    if cache_dir is None:
+        return read_mimic_tables(base_mimic, hadm_ids, chunksize)
+
+    key = fingerprint_raw_files(base_mimic, hadm_ids)
+    frames = load_frames_from_cache(cache_dir, key)
+    if frames is not None:
+        print("Loaded preprocessed tables from {}".format(cache_path(cache_dir, key)))
+        return frames
+
+    frames = read_mimic_tables(base_mimic, hadm_ids, chunksize)
+    write_frames_to_cache(frames, cache_dir, key)
+    print("Wrote preprocessed tables to {}".format(cache_path(cache_dir, key)))
+    return frames
+
+
+def read_mimic_tables(
+    base_mimic: str = "",
+    hadm_ids=None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+):
+    """
+    Read and preprocess all MIMIC-IV tables needed to create the dataset from the raw csvs.
+
+    The large event and note tables are streamed in chunks with explicit dtypes and only the needed columns. If
+    hadm_ids is given, these tables are restricted while reading to the patients (subject_ids) of those admissions.
+    All rows of those patients are kept, also those without hadm_id, as fill_nan_hadm assigns them to an admission
+    later. Peak memory then scales with the cohort instead of MIMIC.
+
+    Args:
+        base_mimic (str): Path to the MIMIC-IV root directory
+        hadm_ids (array-like): Optional cohort of hadm_ids to restrict the event and note tables to
+        chunksize (int): Number of rows read at once from the large tables
+    """
     base_hosp = join(base_mimic, "hosp")
     base_notes = join(base_mimic, "note")
 
     # Load admissions
     admissions_df = pd.read_csv(join(base_hosp, "admissions.csv"))
 
+    # Restrict event tables to all patients of the cohort
+    subject_ids = None
+    if hadm_ids is not None:
+        subject_ids = admissions_df[admissions_df["hadm_id"].isin(hadm_ids)][
+            "subject_id"
+        ].unique()
+
     # Load transfers
     transfers_df = pd.read_csv(join(base_mimic, "hosp", "transfers.csv"))
 
-    diagnoses_icd_df = pd.read_csv(join(base_hosp, "diagnoses_icd.csv"))
+    diagnoses_icd_df = pd.read_csv(
+        join(base_hosp, "diagnoses_icd.csv"), dtype={"icd_code": str}
+    )
     # remove NAN ICD Codes
     diagnoses_icd_df = diagnoses_icd_df[~diagnoses_icd_df.icd_code.isna()]
 
     # ICD Descriptions
-    icd_descriptions = pd.read_csv(join(base_hosp, "d_icd_diagnoses.csv"))
+    icd_descriptions = pd.read_csv(
+        join(base_hosp, "d_icd_diagnoses.csv"), dtype={"icd_code": str}
+    )
 
     # Expand to include names of disease, once for version 9 and once for version 10
     diag_icd9 = diagnoses_icd_df[diagnoses_icd_df.icd_version == 9]
@@ -265,10 +504,14 @@ def load_data(base_mimic: str = ""):
     diag_icd = pd.concat([diag_icd9, diag_icd10])
 
     # Load procedures
-    procedures_df = pd.read_csv(join(base_hosp, "procedures_icd.csv"))
+    procedures_df = pd.read_csv(
+        join(base_hosp, "procedures_icd.csv"), dtype={"icd_code": str}
+    )
 
     # Load description of procedures and merge
-    procedures_descr_df = pd.read_csv(join(base_hosp, "d_icd_procedures.csv"))
+    procedures_descr_df = pd.read_csv(
+        join(base_hosp, "d_icd_procedures.csv"), dtype={"icd_code": str}
+    )
     procedures_descr_9_df = procedures_descr_df[procedures_descr_df.icd_version == 9]
     procedures_descr_10_df = procedures_descr_df[procedures_descr_df.icd_version == 10]
     procedures_9_df = procedures_df[procedures_df.icd_version == 9]
@@ -282,21 +525,47 @@ def load_data(base_mimic: str = ""):
     procedures_df = pd.concat([procedures_9_df, procedures_10_df])
 
     # Load notes
-    discharge_df = pd.read_csv(join(base_notes, "discharge.csv"))
+    discharge_df = read_csv_chunked(
+        join(base_notes, "discharge.csv"),
+        DISCHARGE_DTYPES,
+        subject_ids=subject_ids,
+        chunksize=chunksize,
+    )
 
     # Load radiology reports
-    radiology_report_df = pd.read_csv(join(base_notes, "radiology.csv"))
+    radiology_report_df = read_csv_chunked(
+        join(base_notes, "radiology.csv"),
+        RADIOLOGY_DTYPES,
+        subject_ids=subject_ids,
+        chunksize=chunksize,
+    )
 
     # Load radiology report details
-    radiology_report_details_df = pd.read_csv(join(base_notes, "radiology_detail.csv"))
+    radiology_report_details_df = read_csv_chunked(
+        join(base_notes, "radiology_detail.csv"),
+        RADIOLOGY_DETAILS_DTYPES,
+        subject_ids=subject_ids,
+        chunksize=chunksize,
+    )
 
-    # Load microbiology events
-    microbiology_df = pd.read_csv(join(base_hosp, "microbiologyevents.csv"))
-    # Remove canceled tests
-    microbiology_df = microbiology_df[microbiology_df["org_itemid"] != 90760.0]
+    # Load microbiology events and remove canceled tests
+    microbiology_df = read_csv_chunked(
+        join(base_hosp, "microbiologyevents.csv"),
+        MICROBIOLOGY_DTYPES,
+        subject_ids=subject_ids,
+        chunk_filter=lambda chunk: chunk[chunk["org_itemid"] != 90760.0],
+        parse_dates=["charttime"],
+        chunksize=chunksize,
+    )
 
     # Load lab events
-    lab_events_df = pd.read_csv(join(base_hosp, "labevents.csv"))
+    lab_events_df = read_csv_chunked(
+        join(base_hosp, "labevents.csv"),
+        LAB_EVENTS_DTYPES,
+        subject_ids=subject_ids,
+        parse_dates=["charttime"],
+        chunksize=chunksize,
+    )
 
     # Load lab event descriptions
     lab_events_descr_df = pd.read_csv(join(base_hosp, "d_labitems.csv"))
@@ -307,16 +576,10 @@ def load_data(base_mimic: str = ""):
     )
 
     # Create valuestr from valuenum and valueuom
-    lab_events_df["valuestr"] = lab_events_df.apply(
-        lambda row: create_valuestr_lab(row),
-        axis=1,
-    )
+    lab_events_df["valuestr"] = create_valuestr_lab_vectorized(lab_events_df)
 
     # Create valuestr for microbio
-    microbiology_df["valuestr"] = microbiology_df.apply(
-        lambda row: create_valuestr_microbio(row),
-        axis=1,
-    )
+    microbiology_df["valuestr"] = create_valuestr_microbio_vectorized(microbiology_df)
 
     # Many lab events dont have a hadm_id. If a patient only has one hadm_id we can fill that in for them
     # get all patients with only one hadm_id
@@ -351,12 +614,8 @@ def load_data(base_mimic: str = ""):
     # )
     # microbiology_df = microbiology_df.drop(columns=["hadm_id_x", "hadm_id_y"])
 
-    # Convert transfers to datetime
+    # Convert transfers to datetime. Lab and microbiology charttimes are already converted while streaming
     transfers_df["intime"] = pd.to_datetime(transfers_df["intime"])
-    # Convert lab events charrtime to datetime
-    lab_events_df["charttime"] = pd.to_datetime(lab_events_df["charttime"])
-    # Convert microbiology charttime to datetime
-    microbiology_df["charttime"] = pd.to_datetime(microbiology_df["charttime"])
 
     return (
         admissions_df,
@@ -378,6 +637,84 @@ def fill_nan_hadm(
     disease_ids,
     transfers_df,
     hadm_to_subject_id,
+):
+    """
+    Fill missing hadm_ids of lab events, radiology reports and microbiology events of the same subject that were
+    recorded between one day before the first transfer and the last transfer of a disease admission.
+
+    Builds one admission window per disease hadm_id and assigns all rows with a single join on subject_id instead of
+    scanning every frame once per admission. If windows of a subject overlap, the row is assigned to the hadm_id that
+    comes first in disease_ids. The output is identical to fill_nan_hadm_iterative.
+    """
+    windows = create_admission_windows(disease_ids, transfers_df, hadm_to_subject_id)
+
+    lab_events_df = fill_nan_hadm_from_windows(lab_events_df, windows)
+    radiology_reports_df = fill_nan_hadm_from_windows(radiology_reports_df, windows)
+    microbiology_df = fill_nan_hadm_from_windows(microbiology_df, windows)
+
+    return lab_events_df, radiology_reports_df, microbiology_df
+
+
+def create_admission_windows(disease_ids, transfers_df, hadm_to_subject_id):
+    # Deduplicate but keep the order of disease_ids as priority for overlapping windows
+    disease_ids = list(dict.fromkeys(disease_ids))
+    windows = pd.DataFrame(
+        {"fill_hadm_id": disease_ids, "priority": range(len(disease_ids))}
+    )
+    windows["subject_id"] = windows["fill_hadm_id"].map(hadm_to_subject_id)
+
+    # First and last transfer of each admission. NaT is sorted last, like in the iterative version
+    transfers = transfers_df[transfers_df["hadm_id"].isin(disease_ids)][
+        ["hadm_id", "intime"]
+    ].sort_values("intime")
+    first_transfer = transfers.drop_duplicates("hadm_id", keep="first").set_index(
+        "hadm_id"
+    )["intime"]
+    last_transfer = transfers.drop_duplicates("hadm_id", keep="last").set_index(
+        "hadm_id"
+    )["intime"]
+
+    windows["start_time"] = windows["fill_hadm_id"].map(first_transfer) - timedelta(
+        days=1
+    )
+    windows["end_time"] = windows["fill_hadm_id"].map(last_transfer)
+    return windows.dropna(subset=["subject_id"])
+
+
+def fill_nan_hadm_from_windows(df, windows):
+    nan_rows = np.flatnonzero(df["hadm_id"].isna().to_numpy())
+    candidates = pd.DataFrame(
+        {
+            "row": nan_rows,
+            "subject_id": df["subject_id"].to_numpy()[nan_rows],
+            "charttime": df["charttime"].to_numpy()[nan_rows],
+        }
+    )
+    candidates = candidates.merge(windows, on="subject_id", how="inner")
+    candidates = candidates[
+        (candidates["charttime"] >= candidates["start_time"])
+        & (candidates["charttime"] <= candidates["end_time"])
+    ]
+    # Rows inside of multiple windows go to the admission that comes first
+    candidates = candidates.sort_values(["row", "priority"]).drop_duplicates(
+        "row", keep="first"
+    )
+
+    if len(candidates):
+        df.iloc[
+            candidates["row"].to_numpy(), df.columns.get_loc("hadm_id")
+        ] = candidates["fill_hadm_id"].to_numpy()
+    return df
+
+
+# Reference implementation of fill_nan_hadm. Scans all frames once per disease hadm_id
+def fill_nan_hadm_iterative(
+    lab_events_df,
+    radiology_reports_df,
+    microbiology_df,
+    disease_ids,
+    transfers_df,
+    hadm_to_subject_id,
 ):
     for _id in disease_ids:
         s_id = hadm_to_subject_id[_id]
@@ -422,6 +759,7 @@ def extract_hadm_info(
     microbiology_df,
     radiology_report_df,
     radiology_report_details_df,
+    num_workers=1,
 ):
     skipped = 0
     lab_events_df["charttime"] = pd.to_datetime(lab_events_df["charttime"])
@@ -532,98 +870,108 @@ def extract_hadm_info(
         hadm_to_subject_id,
     )
 
-    hadm_info = {}
+    # Parse lab and microbiology events and group radiology reports for all admissions at once, so that every
+    # admission gets its results without rescanning the frames
+    lab_results = parse_lab_events_grouped(lab_events_df_sf, disease_ids)
+    microbio_results = parse_microbio_grouped(microbiology_df_sf, disease_ids)
+    radiology_report_groups = group_rows_by_hadm_id(radiology_report_df_sf)
 
-    for _id in disease_ids:
-        if _id in discharge_dict:
-            discharge_row = discharge_dict[_id]
-            discharge_text = discharge_row["text"]
+    # Everything per admission is text processing on read-only data, so admissions can be processed in parallel
+    def extract_admission(_id):
+        discharge_row = discharge_dict[_id]
+        discharge_text = discharge_row["text"]
 
-            # Check if history field exists
-            if (
-                "history of present illness" not in discharge_text.lower()
-                and "___ of present illness:" not in discharge_text.lower()
-            ):
-                continue
+        # Check if history field exists
+        if (
+            "history of present illness" not in discharge_text.lower()
+            and "___ of present illness:" not in discharge_text.lower()
+        ):
+            return None
 
-            history = extract_history(discharge_text)
+        history = extract_history(discharge_text)
 
-            pe = extract_physical_examination(discharge_text)
+        pe = extract_physical_examination(discharge_text)
 
-            le, ref_r_low, ref_r_up = parse_lab_events(lab_events_df_sf, _id)
+        le, ref_r_low, ref_r_up = lab_results.get(_id, ({}, {}, {}))
 
-            microbio, microbio_spec = parse_microbio(microbiology_df_sf, _id)
+        microbio, microbio_spec = microbio_results.get(_id, ({}, {}))
 
-            rad = extract_rad_events(
-                radiology_report_df_sf[radiology_report_df_sf["hadm_id"] == _id][
-                    "text"
-                ].values
-            )
+        radiology_reports = select_hadm_rows(
+            radiology_report_df_sf, radiology_report_groups, _id
+        )
 
-            note_ids = radiology_report_df_sf[radiology_report_df_sf["hadm_id"] == _id][
-                "note_id"
-            ].values
-
-            note_names = []
-            for note_id in note_ids:
-                name = exam_name_map.get(note_id, None)
-                if name is None:
-                    parent_note_id = parent_note_map.get(note_id, None)
-                    if parent_note_id:
-                        name = exam_name_map.get(parent_note_id, "Unknown")
-                    else:
-                        warnings.warn(
-                            "Note ID {} has no exam name and no parent_note_id".format(
-                                note_id
-                            )
+        rad = extract_rad_events(radiology_reports["text"].values)
+
+        note_ids = radiology_reports["note_id"].values
+
+        note_names = []
+        for note_id in note_ids:
+            name = exam_name_map.get(note_id, None)
+            if name is None:
+                parent_note_id = parent_note_map.get(note_id, None)
+                if parent_note_id:
+                    name = exam_name_map.get(parent_note_id, "Unknown")
+                else:
+                    warnings.warn(
+                        "Note ID {} has no exam name and no parent_note_id".format(
+                            note_id
                         )
-                        name = ""
-                note_names.append(name)
-
-            rad_regions = []
-            rad_modalities = []
-            for exam_name in note_names:
-                # Count matches of each modality and region and get most frequent plus counts
-                (
-                    frequent_modality,
-                    frequent_modality_count,
-                    frequent_region,
-                    frequent_region_count,
-                ) = count_radiology_modality_and_organ_matches(exam_name)
-
-                if frequent_modality_count == 0:
-                    frequent_modality = None
-                if frequent_region_count == 0:
-                    frequent_region = None
-
-                rad_modalities.append(frequent_modality)
-                rad_regions.append(frequent_region)
-
-            rad_data = []
-            for i in range(len(rad)):
-                rad_data.append(
-                    {
-                        "Report": rad[i],
-                        "Modality": rad_modalities[i],
-                        "Region": rad_regions[i],
-                        "Exam Name": note_names[i],
-                        "Note ID": note_ids[i],
-                    }
-                )
-
-            hadm_info[_id] = {
-                "Discharge": discharge_text,
-                "Patient History": history,
-                "Physical Examination": pe,
-                "Laboratory Tests": le,
-                "Microbiology": microbio,
-                "Microbiology Spec": microbio_spec,
-                "Reference Range Lower": ref_r_low,
-                "Reference Range Upper": ref_r_up,
-                "Radiology": rad_data,
-            }
-        else:
-            skipped += 1
+                    )
+                    name = ""
+            note_names.append(name)
+
+        rad_regions = []
+        rad_modalities = []
+        for exam_name in note_names:
+            # Count matches of each modality and region and get most frequent plus counts
+            (
+                frequent_modality,
+                frequent_modality_count,
+                frequent_region,
+                frequent_region_count,
+            ) = count_radiology_modality_and_organ_matches(exam_name)
+
+            if frequent_modality_count == 0:
+                frequent_modality = None
+            if frequent_region_count == 0:
+                frequent_region = None
+
+            rad_modalities.append(frequent_modality)
+            rad_regions.append(frequent_region)
+
+        rad_data = []
+        for i in range(len(rad)):
+            rad_data.append(
+                {
+                    "Report": rad[i],
+                    "Modality": rad_modalities[i],
+                    "Region": rad_regions[i],
+                    "Exam Name": note_names[i],
+                    "Note ID": note_ids[i],
+                }
+            )
+
+        return {
+            "Discharge": discharge_text,
+            "Patient History": history,
+            "Physical Examination": pe,
+            "Laboratory Tests": le,
+            "Microbiology": microbio,
+            "Microbiology Spec": microbio_spec,
+            "Reference Range Lower": ref_r_low,
+            "Reference Range Upper": ref_r_up,
+            "Radiology": rad_data,
+        }
+
+    admission_ids = [_id for _id in disease_ids if _id in discharge_dict]
+    skipped += len(disease_ids) - len(admission_ids)
+
+    hadm_info = {}
+    for _id, admission in map_hadm_ids(
+        extract_admission, admission_ids, num_workers
+    ).items():
+        if admission is not None:
+            hadm_info[_id] = admission
     print("Skipped {} hadm_ids".format(skipped))
     return hadm_info
 
@@ -712,34 +1060,44 @@ def pathology_in_primary_diagnosis(pathology, discharge_diagnosis):
     return False
 
 
-def sanitize_hadm_texts(hadm_info, disease_names):
+def sanitize_hadm_text(admission, disease_names):
+    """
+    Remove mentions of the disease names from one admission. Returns the admission and whether its history had to
+    be invalidated.
+    """
+    for disease_name in disease_names:
+        # Sanitize history - if history contains disease name, invalidate the visit
+        if re.search(
+            re.compile(disease_name, re.IGNORECASE),
+            admission["Patient History"],
+        ):
+            admission["Patient History"] = ""
+            return admission, True
+
+        # Sanitize physical examination
+        admission["Physical Examination"] = re.sub(
+            re.compile(disease_name, re.IGNORECASE),
+            "____",
+            admission["Physical Examination"],
+        )
+
+        # Sanitize rads
+        for i, rad in enumerate(admission["Radiology"]):
+            admission["Radiology"][i]["Report"] = re.sub(
+                re.compile(disease_name, re.IGNORECASE), "____", rad["Report"]
+            )
+    return admission, False
+
+
+def sanitize_hadm_texts(hadm_info, disease_names, num_workers=1):
     invalid_visits = 0
-    for _id in hadm_info:
-        inval = False
-        for disease_name in disease_names:
-            if not inval:
-                # Sanitize history - if history contains disease name, invalidate the visit
-                if re.search(
-                    re.compile(disease_name, re.IGNORECASE),
-                    hadm_info[_id]["Patient History"],
-                ):
-                    hadm_info[_id]["Patient History"] = ""
-                    invalid_visits += 1
-                    inval = True
-                    continue
-
-                # Sanitize physical examination
-                hadm_info[_id]["Physical Examination"] = re.sub(
-                    re.compile(disease_name, re.IGNORECASE),
-                    "____",
-                    hadm_info[_id]["Physical Examination"],
-                )
-
-                # Sanitize rads
-                for i, rad in enumerate(hadm_info[_id]["Radiology"]):
-                    hadm_info[_id]["Radiology"][i]["Report"] = re.sub(
-                        re.compile(disease_name, re.IGNORECASE), "____", rad["Report"]
-                    )
+    for _id, (admission, inval) in map_hadm_ids(
+        lambda _id: sanitize_hadm_text(hadm_info[_id], disease_names),
+        hadm_info,
+        num_workers,
+    ).items():
+        hadm_info[_id] = admission
+        invalid_visits += inval
     print(
         "Invalidated {} visits due to pathology reference in patient history".format(
             invalid_visits
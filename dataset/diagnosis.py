@@ -1,5 +1,9 @@
+from dataset.utils import group_rows_by_hadm_id, select_hadm_rows
+
+
 def extract_diagnosis_from_diag_df(hadm_info, diag_df):
+    diag_groups = group_rows_by_hadm_id(diag_df)
     for _id in hadm_info:
-        diagnoses = diag_df[diag_df["hadm_id"] == _id]["long_title"].values
+        diagnoses = select_hadm_rows(diag_df, diag_groups, _id)["long_title"].values
         hadm_info[_id]["ICD Diagnosis"] = diagnoses.tolist()
     return hadm_info
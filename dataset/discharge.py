@@ -1,6 +1,11 @@
 import re
 
-from dataset.utils import regex_extracter, last_substring_index
+from dataset.utils import (
+    regex_extracter,
+    last_substring_index,
+    group_rows_by_hadm_id,
+    select_hadm_rows,
+)
 
 
 def extract_chief_complaints(hadm_ids, discharge_df):
@@ -19,11 +24,13 @@ def extract_chief_complaints(hadm_ids, discharge_df):
     ccs = []
     discharge_cntr = 0
     cc_ids = []
+    discharge_groups = group_rows_by_hadm_id(discharge_df)
     for _id in hadm_ids:
-        if len(discharge_df[discharge_df["hadm_id"] == _id]) == 0:
+        discharge_id_df = select_hadm_rows(discharge_df, discharge_groups, _id)
+        if len(discharge_id_df) == 0:
             continue
         discharge_cntr += 1
-        discharge = discharge_df[discharge_df["hadm_id"] == _id]["text"].values[0]
+        discharge = discharge_id_df["text"].values[0]
         cc = extract_cc(discharge)
         if len(cc) > 0:
             ccs.append(cc[0].strip())
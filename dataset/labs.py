@@ -4,6 +4,7 @@ import os
 import pandas as pd
 
 from utils.nlp import extract_short_and_long_name
+from dataset.utils import group_rows_by_hadm_id
 from tools.utils import (
     LAB_TEST_MAPPING_ALTERATIONS,
     ADDITIONAL_LAB_TEST_MAPPING,
@@ -16,7 +17,9 @@ def parse_lab_events(lab_events_df_sf, _id):
     filtered_lab_events = lab_events_df_sf[lab_events_df_sf["hadm_id"] == _id]
     le, ref_r_low, ref_r_up = {}, {}, {}
     if not filtered_lab_events.empty:
-        sorted_df = filtered_lab_events.sort_values(by="charttime", ascending=True)
+        sorted_df = filtered_lab_events.sort_values(
+            by="charttime", ascending=True, kind="stable"
+        )
         unique_lab_events_df = sorted_df.drop_duplicates(subset="itemid", keep="first")
         le = unique_lab_events_df.set_index("itemid")["valuestr"].to_dict()
         ref_r_low = unique_lab_events_df.set_index("itemid")[
@@ -52,7 +55,7 @@ def parse_microbio(microbio_df_sf, _id):
         result.columns = ["test_itemid", "charttime", "valuestr", "spec_itemid"]
 
         # Sort and drop duplicates, creating new DataFrames
-        sorted_df = result.sort_values(by="charttime", ascending=True)
+        sorted_df = result.sort_values(by="charttime", ascending=True, kind="stable")
         unique_microbio_df = sorted_df.drop_duplicates(
             subset="test_itemid", keep="first"
         )
@@ -64,6 +67,77 @@ def parse_microbio(microbio_df_sf, _id):
     return microbio, microbio_spec
 
 
+def parse_lab_events_grouped(lab_events_df_sf, hadm_ids):
+    """
+    parse_lab_events for all hadm_ids in one pass over the lab events.
+
+    Returns:
+        lab_results (dict): Mapping of hadm_id to (le, ref_r_low, ref_r_up), identical to parse_lab_events(df, _id).
+            Admissions without lab events are left out
+    """
+    df = lab_events_df_sf[lab_events_df_sf["hadm_id"].isin(hadm_ids)]
+    # Earliest result of every test per admission
+    df = df.sort_values(by=["hadm_id", "charttime"], kind="stable")
+    df = df.drop_duplicates(subset=["hadm_id", "itemid"], keep="first")
+
+    itemids = df["itemid"].tolist()
+    valuestrs = df["valuestr"].tolist()
+    ref_range_lowers = df["ref_range_lower"].tolist()
+    ref_range_uppers = df["ref_range_upper"].tolist()
+
+    lab_results = {}
+    for _id, positions in group_rows_by_hadm_id(df).items():
+        lab_results[_id] = (
+            {itemids[i]: valuestrs[i] for i in positions},
+            {itemids[i]: ref_range_lowers[i] for i in positions},
+            {itemids[i]: ref_range_uppers[i] for i in positions},
+        )
+    return lab_results
+
+
+def parse_microbio_grouped(microbio_df_sf, hadm_ids):
+    """
+    parse_microbio for all hadm_ids in one pass over the microbiology events.
+
+    Returns:
+        microbio_results (dict): Mapping of hadm_id to (microbio, microbio_spec), identical to
+            parse_microbio(df, _id). Admissions without microbiology events are left out
+    """
+    keys = ["hadm_id", "test_itemid"]
+    df = microbio_df_sf[microbio_df_sf["hadm_id"].isin(hadm_ids)]
+    df = df.dropna(subset=["test_itemid", "charttime"])
+
+    # Only the earliest charttime of every test is kept
+    first_charttime = df.groupby(keys, sort=False)["charttime"].transform("min")
+    df = df[df["charttime"] == first_charttime]
+
+    # If the first row has an organism, merge all positive bacteria of the test, else use the value of the first row
+    first_rows = df.drop_duplicates(subset=keys, keep="first")
+    organisms = (
+        df.dropna(subset=["org_itemid"])
+        .drop_duplicates(subset=keys + ["valuestr"], keep="first")
+        .groupby(keys, sort=False)["valuestr"]
+        .agg(", ".join)
+    )
+    first_rows = first_rows.join(organisms.rename("organisms"), on=keys)
+    first_rows["valuestr"] = first_rows["valuestr"].where(
+        first_rows["org_itemid"].isna(), first_rows["organisms"]
+    )
+    first_rows = first_rows.sort_values(by=["hadm_id", "charttime", "test_itemid"])
+
+    test_itemids = first_rows["test_itemid"].tolist()
+    valuestrs = first_rows["valuestr"].tolist()
+    spec_itemids = first_rows["spec_itemid"].tolist()
+
+    microbio_results = {}
+    for _id, positions in group_rows_by_hadm_id(first_rows).items():
+        microbio_results[_id] = (
+            {test_itemids[i]: valuestrs[i] for i in positions},
+            {test_itemids[i]: spec_itemids[i] for i in positions},
+        )
+    return microbio_results
+
+
 def find_and_append_abreviations(df):
     abbreviations = []
     for idx, row in df.iterrows():
@@ -0,0 +1,131 @@
+import mmap
+import os
+import pickle
+from collections.abc import Mapping
+from os.path import join
+
+STORE_SUFFIX = ".store"
+INDEX_SUFFIX = ".idx"
+
+
+class PatientStore(Mapping):
+    """
+    Read-only, lazily loaded mapping of hadm_id to patient record.
+
+    Each patient is pickled individually into one data file. A small index file maps every hadm_id to the
+    (offset, length) of its record. Only the index is read on open, the data file is memory-mapped and a record is
+    unpickled when it is accessed. Startup time and memory are therefore independent of the cohort size and
+    `store[_id]["Laboratory Tests"]` behaves exactly like the dict loaded from the pickle files.
+
+    Every access returns a freshly unpickled record, so modifying it does not change the store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + INDEX_SUFFIX, "rb") as f:
+            self._index = pickle.load(f)
+        self._file = None
+        self._mmap = None
+
+    def _buffer(self):
+        # Open lazily so that forked workers and unpickled copies map the file themselves
+        if self._mmap is None:
+            self._file = open(self.path, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def __getitem__(self, hadm_id):
+        offset, length = self._index[hadm_id]
+        return pickle.loads(self._buffer()[offset : offset + length])
+
+    def __contains__(self, hadm_id):
+        return hadm_id in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+        self._mmap = None
+        self._file = None
+
+    def __getstate__(self):
+        # Memory maps cannot be pickled. Ship only the path and index and re-map on first access
+        return {"path": self.path, "_index": self._index, "_file": None, "_mmap": None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def store_path(filename, base_mimic=""):
+    return join(base_mimic, filename + STORE_SUFFIX)
+
+
+def write_hadm_to_store(hadm_info, filename, base_mimic=""):
+    """
+    Write a hadm_info dict as a patient store. Records keep the insertion order of hadm_info.
+
+    Args:
+        hadm_info (dict): Mapping of hadm_id to patient record
+        filename (str): Name of the store without suffix
+        base_mimic (str): Directory to write the store to
+    """
+    path = store_path(filename, base_mimic)
+    index = {}
+    offset = 0
+    # Write to temporary files first so that readers never see a half written store
+    with open(path + ".tmp", "wb") as f:
+        for _id, record in hadm_info.items():
+            data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(data)
+            index[_id] = (offset, len(data))
+            offset += len(data)
+    with open(path + INDEX_SUFFIX + ".tmp", "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    os.replace(path + INDEX_SUFFIX + ".tmp", path + INDEX_SUFFIX)
+
+
+def load_hadm_from_store(filename, base_mimic=""):
+    return PatientStore(store_path(filename, base_mimic))
+
+
+def hadm_store_exists(filename, base_mimic=""):
+    path = store_path(filename, base_mimic)
+    return os.path.exists(path) and os.path.exists(path + INDEX_SUFFIX)
+
+
+def hadm_store_is_stale(filename, base_mimic=""):
+    """
+    Whether the {filename}.pkl pickle was written after the patient store, e.g. when it was regenerated or edited
+    without writing the store again.
+    """
+    pickle_path = join(base_mimic, filename + ".pkl")
+    if not os.path.exists(pickle_path):
+        return False
+    path = store_path(filename, base_mimic)
+    store_mtime = min(
+        os.stat(path).st_mtime_ns, os.stat(path + INDEX_SUFFIX).st_mtime_ns
+    )
+    return os.stat(pickle_path).st_mtime_ns > store_mtime
+
+
+def convert_hadm_file_to_store(filename, base_mimic=""):
+    """
+    Convert an existing {filename}.pkl hadm_info pickle into a patient store next to it.
+    """
+    with open(join(base_mimic, filename + ".pkl"), "rb") as f:
+        hadm_info = pickle.load(f)
+    write_hadm_to_store(hadm_info, filename, base_mimic)
+    return load_hadm_from_store(filename, base_mimic)
@@ -1,5 +1,6 @@
 import re
 from icd.procedure_mappings import icd_converter, uniqueify_lists
+from dataset.utils import group_rows_by_hadm_id, select_hadm_rows, map_hadm_ids
 
 
 def extract_procedure_from_discharge_summary(discharge_summary):
@@ -36,35 +37,40 @@ def extract_procedure_from_discharge_summary(discharge_summary):
     return []
 
 
-def extract_procedures(hadm_info, procedures_df_icd9, procedures_df_icd10):
-    for _id in hadm_info:
-        discharge_procedures = extract_procedure_from_discharge_summary(
+def extract_procedures(
+    hadm_info, procedures_df_icd9, procedures_df_icd10, num_workers=1
+):
+    procedures_icd9_groups = group_rows_by_hadm_id(procedures_df_icd9)
+    procedures_icd10_groups = group_rows_by_hadm_id(procedures_df_icd10)
+    all_discharge_procedures = map_hadm_ids(
+        lambda _id: extract_procedure_from_discharge_summary(
             hadm_info[_id]["Discharge"]
-        )
+        ),
+        hadm_info,
+        num_workers,
+    )
+    for _id in hadm_info:
+        discharge_procedures = all_discharge_procedures[_id]
         if len(discharge_procedures) == 0:
             print("No procedures found for {}".format(_id))
         hadm_info[_id]["Procedures Discharge"] = discharge_procedures
 
-        procedures_icd9 = procedures_df_icd9[procedures_df_icd9["hadm_id"] == _id][
-            "icd_code"
-        ].values
-        hadm_info[_id]["Procedures ICD9"] = procedures_icd9.tolist()
+        procedures_df_icd9_id = select_hadm_rows(
+            procedures_df_icd9, procedures_icd9_groups, _id
+        )
+        procedures_icd9 = procedures_df_icd9_id["icd_code"].values
         hadm_info[_id]["Procedures ICD9"] = [int(p) for p in procedures_icd9]
 
-        procedures_str = procedures_df_icd9[procedures_df_icd9["hadm_id"] == _id][
-            "long_title"
-        ].values
+        procedures_str = procedures_df_icd9_id["long_title"].values
         hadm_info[_id]["Procedures ICD9 Title"] = procedures_str.tolist()
 
-        procedures_icd10 = procedures_df_icd10[procedures_df_icd10["hadm_id"] == _id][
-            "icd_code"
-        ].values
-        hadm_info[_id]["Procedures ICD10"] = procedures_icd10.tolist()
+        procedures_df_icd10_id = select_hadm_rows(
+            procedures_df_icd10, procedures_icd10_groups, _id
+        )
+        procedures_icd10 = procedures_df_icd10_id["icd_code"].values
         hadm_info[_id]["Procedures ICD10"] = [str(p) for p in procedures_icd10]
 
-        procedures_str = procedures_df_icd10[procedures_df_icd10["hadm_id"] == _id][
-            "long_title"
-        ].values
+        procedures_str = procedures_df_icd10_id["long_title"].values
         hadm_info[_id]["Procedures ICD10 Title"] = procedures_str.tolist()
     return hadm_info
 
@@ -1,7 +1,16 @@
 from os.path import join
+import multiprocessing
 import pickle
 import re
 
+from dataset.patient_store import (
+    write_hadm_to_store,
+    load_hadm_from_store,
+    hadm_store_exists,
+    hadm_store_is_stale,
+    convert_hadm_file_to_store,
+)
+
 
 def regex_extracter(text, regex):
     """
@@ -31,15 +40,96 @@ def last_substring_index(larger_string, substring):
     return last_index
 
 
+def group_rows_by_hadm_id(df):
+    """
+    Positions of the rows of every hadm_id in a single groupby pass. Rows keep their original order and rows without
+    hadm_id are left out. Use with select_hadm_rows instead of df[df["hadm_id"] == _id] inside loops over hadm_ids.
+    """
+    return df.groupby("hadm_id", sort=False).indices
+
+
+def select_hadm_rows(df, groups, _id):
+    """
+    Rows of df belonging to _id, identical to df[df["hadm_id"] == _id]. groups is the result of group_rows_by_hadm_id.
+    """
+    return df.iloc[groups.get(_id, [])]
+
+
+# Task of the current map_hadm_ids call. Forked workers inherit it together with all data it references
+_FORKED_TASK = None
+
+
+def _run_forked_shard(shard):
+    return [(_id, _FORKED_TASK(_id)) for _id in shard]
+
+
+def map_hadm_ids(task, hadm_ids, num_workers=1):
+    """
+    Apply task to every hadm_id, optionally in parallel.
+
+    With num_workers > 1 the hadm_ids are split into contiguous shards that are processed by a pool of forked
+    processes. The workers inherit task and the frames it references from the parent without pickling them, so task
+    can be a closure over large read-only data. Only the results are sent back. Platforms without fork fall back to
+    serial execution.
+
+    Args:
+        task (callable): Function of a single hadm_id
+        hadm_ids (list): Admission ids
+        num_workers (int): Number of processes
+
+    Returns:
+        results (dict): Mapping of hadm_id to task(hadm_id) in the order of hadm_ids
+    """
+    global _FORKED_TASK
+    hadm_ids = list(hadm_ids)
+    if num_workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("Processes cannot be forked on this platform, running serially")
+        num_workers = 1
+    if num_workers <= 1 or len(hadm_ids) < 2:
+        return {_id: task(_id) for _id in hadm_ids}
+
+    # A few shards per worker balance admissions with long texts
+    num_shards = min(len(hadm_ids), num_workers * 4)
+    shard_size = -(-len(hadm_ids) // num_shards)
+    shards = [
+        hadm_ids[i : i + shard_size] for i in range(0, len(hadm_ids), shard_size)
+    ]
+
+    _FORKED_TASK = task
+    try:
+        with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+            shard_results = pool.map(_run_forked_shard, shards)
+    finally:
+        _FORKED_TASK = None
+
+    # Pool.map keeps the order of the shards, so the merged results follow hadm_ids
+    results = {}
+    for shard_result in shard_results:
+        results.update(shard_result)
+    return results
+
+
 # Write fields as csv with $ separator
 def write_hadm_to_file(hadm_info, filename, base_mimic=""):
     # Write pickle for easy loading
     with open(join(base_mimic, filename + ".pkl"), "wb") as f:
         pickle.dump(hadm_info, f)
 
+    # Write indexed patient store for lazy loading
+    write_hadm_to_store(hadm_info, filename, base_mimic)
+
 
-# Load from pickle
+# Load from patient store if available, otherwise from pickle. A store older than the pickle is rebuilt from it
 def load_hadm_from_file(filename, base_mimic=""):
+    if hadm_store_exists(filename, base_mimic):
+        if not hadm_store_is_stale(filename, base_mimic):
+            return load_hadm_from_store(filename, base_mimic)
+        try:
+            print(f"Rebuilding patient store of {filename}, the pickle is newer")
+            return convert_hadm_file_to_store(filename, base_mimic)
+        except OSError:
+            print(f"Patient store of {filename} cannot be rebuilt, loading the pickle")
+
     with open(join(base_mimic, filename + ".pkl"), "rb") as f:
         hadm_info = pickle.load(f)
     return hadm_info
@@ -0,0 +1,145 @@
+import importlib.metadata
+import inspect
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+from hashlib import sha256
+
+# Top level packages of this repository. Changes to their modules can change the scores of an evaluator
+REPO_PACKAGES = ("evaluators", "utils", "icd", "tools", "agents", "models")
+
+
+def _is_repo_module(module_name):
+    return module_name is not None and module_name.split(".")[0] in REPO_PACKAGES
+
+
+def nlp_version():
+    """Versions of the spaCy pipeline and negspacy, which find the entities and negations the evaluators score"""
+    from utils.nlp import get_nlp
+
+    meta = get_nlp().meta
+    negspacy_version = importlib.metadata.version("negspacy")
+    return f"{meta['lang']}_{meta['name']} {meta['version']} negspacy {negspacy_version}"
+
+
+def evaluator_version(evaluator_class):
+    """
+    Hash of the source of the modules that define the evaluator and its base classes, and of the modules of this
+    repository they use, e.g. utils.nlp and icd.procedure_mappings, together with the versions of the spaCy pipeline
+    and negspacy. Changing any of them invalidates cached evaluations.
+    """
+    modules = {}
+    for cls in evaluator_class.__mro__:
+        if not _is_repo_module(cls.__module__):
+            continue
+        module = sys.modules[cls.__module__]
+        modules[module.__name__] = module
+        for value in vars(module).values():
+            module_name = (
+                value.__name__
+                if inspect.ismodule(value)
+                else getattr(value, "__module__", None)
+            )
+            if isinstance(module_name, str) and _is_repo_module(module_name):
+                modules[module_name] = sys.modules[module_name]
+
+    version = sha256(nlp_version().encode())
+    for module_name in sorted(modules):
+        source_file = getattr(modules[module_name], "__file__", None)
+        # Namespace packages have no source
+        if source_file is None:
+            continue
+        version.update(module_name.encode())
+        with open(source_file, "rb") as f:
+            version.update(f.read())
+    return version.hexdigest()
+
+
+def trajectory_hash(evaluation_kwargs):
+    # Covers the prediction, input, trajectory and reference the evaluator sees
+    return sha256(
+        pickle.dumps(evaluation_kwargs, protocol=pickle.HIGHEST_PROTOCOL)
+    ).hexdigest()
+
+
+class EvaluationCache:
+    """
+    SQLite cache of the evaluations of admissions, shared between evaluation runs. Entries are keyed by evaluator
+    class, evaluator version, hadm_id and the hash of everything the evaluator is called with. Only trajectories whose
+    result, reference or evaluator code changed are evaluated again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+
+    def connect(self):
+        # SQLite connections must not be shared with forked processes, so every process opens its own
+        if self.connection is None or self.connection_pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self.connection_pid = os.getpid()
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Every evaluation is committed on its own. A lost last commit only means evaluating the admission again
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS evaluations ("
+                "evaluator TEXT NOT NULL, "
+                "version TEXT NOT NULL, "
+                "hadm_id TEXT NOT NULL, "
+                "trajectory_hash TEXT NOT NULL, "
+                "evaluation BLOB NOT NULL, "
+                "PRIMARY KEY (evaluator, version, hadm_id, trajectory_hash))"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def key(self, evaluator_class, hadm_id, evaluation_kwargs):
+        if evaluator_class not in self.versions:
+            self.versions[evaluator_class] = evaluator_version(evaluator_class)
+        return (
+            evaluator_class.__qualname__,
+            self.versions[evaluator_class],
+            str(hadm_id),
+            trajectory_hash(evaluation_kwargs),
+        )
+
+    def get(self, key):
+        with self.lock:
+            row = (
+                self.connect()
+                .execute(
+                    "SELECT evaluation FROM evaluations WHERE evaluator = ? AND version = ? "
+                    "AND hadm_id = ? AND trajectory_hash = ?",
+                    key,
+                )
+                .fetchone()
+            )
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def add(self, key, evaluation):
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?)",
+                (*key, pickle.dumps(evaluation, protocol=pickle.HIGHEST_PROTOCOL)),
+            )
+            connection.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
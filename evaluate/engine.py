@@ -0,0 +1,360 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import pickle
+from pprint import pprint
+
+from dataset.utils import load_hadm_from_file
+from evaluate.cache import EvaluationCache
+from evaluate.utils import calculate_average, count_unnecessary
+from settings import (
+    CDM_DATASET_DIR,
+    EVALUATION_CACHE_PATH,
+    FIELDS,
+    LOGS_SOTA_DIR,
+    MODELS,
+    PATHOLOGIES,
+)
+from utils.nlp import warmup
+from utils.results_log import RESULTS_LOG_SUFFIX, load_results
+from run import load_evaluator
+
+###
+# Scores the results of runs on a process pool. Used by evaluate_cdm.py and evaluate_fi.py
+###
+
+# Fields that count the answers instead of averaging a score
+UNNECESSARY_FIELDS = ["Unnecessary Laboratory Tests", "Unnecessary Imaging"]
+
+
+class EvaluationJob:
+    """Arguments of the evaluation of one admission"""
+
+    def __init__(self, model, pathology, hadm_id, result, evaluation_kwargs):
+        self.model = model
+        self.pathology = pathology
+        self.hadm_id = hadm_id
+        self.result = result
+        self.evaluation_kwargs = evaluation_kwargs
+
+
+def evaluate_job(job):
+    # Reload every time to ensure no state is carried over
+    evaluator = load_evaluator(job.pathology)
+    return evaluator._evaluate_agent_trajectory(**job.evaluation_kwargs)
+
+
+def reference_of(hadm):
+    return (
+        hadm["Discharge Diagnosis"],
+        hadm["ICD Diagnosis"],
+        hadm["Procedures ICD9"],
+        hadm["Procedures ICD10"],
+        hadm["Procedures Discharge"],
+    )
+
+
+def cdm_job(model, pathology, hadm_id, result, hadm):
+    return EvaluationJob(
+        model,
+        pathology,
+        hadm_id,
+        result,
+        dict(
+            prediction=result["output"],
+            input=result["input"],
+            reference=reference_of(hadm),
+            agent_trajectory=result["intermediate_steps"],
+        ),
+    )
+
+
+def fi_job(model, pathology, hadm_id, result, hadm, probabilities=False):
+    if probabilities:
+        result = "Final Diagnosis: " + result["Diagnosis"]
+    else:
+        result = "Final Diagnosis: " + result
+    return EvaluationJob(
+        model,
+        pathology,
+        hadm_id,
+        result,
+        dict(
+            prediction=result,
+            input="",
+            reference=reference_of(hadm),
+            agent_trajectory=[],
+            # Probabilities of the diagnosis are not scored
+            diagnosis_probabilities=None,
+        ),
+    )
+
+
+# Settings of the two tasks: glob of the results file after the pathology, patient data, job constructor and the
+# difficulties whose evaluations are written to the experiment directory
+TASKS = {
+    "cdm": {
+        "run": "_ZeroShot_{model}_*_results.*",
+        "hadm_info": "{pathology}_hadm_info_clean",
+        "job": cdm_job,
+        "saved_difficulties": ["first_diag"],
+    },
+    "fi": {
+        "run": "_{model}_*_FULL_INFO_*results.*",
+        "hadm_info": "{pathology}_hadm_info_first_diag",
+        "job": fi_job,
+        "saved_difficulties": ["first_diag", "dr_eval"],
+    },
+}
+
+
+def find_results_file(pattern):
+    """
+    Results log or results pickle of a run matching the glob pattern. A converted results pickle is read from its
+    results log. Other matches, e.g. the temporary file of an interrupted conversion, are ignored.
+    """
+    return sorted(
+        (
+            path
+            for path in glob.glob(pattern)
+            if path.endswith(RESULTS_LOG_SUFFIX) or path.endswith("_results.pkl")
+        ),
+        key=lambda path: path.endswith(".pkl"),
+    )[0]
+
+
+def collect_jobs(task, experiment, models, pathologies, id_difficulty, difficulty):
+    """Jobs of all admissions of the given difficulty that have a result, in the order of id_difficulty"""
+    settings = TASKS[task]
+    jobs = []
+    for model in models:
+        run = settings["run"].format(model=model)
+        assert "result" in run
+        for patho in pathologies:
+            # Load patient data
+            hadm_info_clean = load_hadm_from_file(
+                settings["hadm_info"].format(pathology=patho), base_mimic="cdm-dataset"
+            )
+
+            results_log_path = str(LOGS_SOTA_DIR / experiment / f"{patho}{run}")
+            print(results_log_path)
+            results_log_file = find_results_file(results_log_path)
+            results = load_results(results_log_file)
+
+            for _id in id_difficulty[patho][difficulty]:
+                if _id not in results:
+                    print(f"Skipping {_id} | {results_log_file}")
+                    continue
+                kwargs = {}
+                if task == "fi":
+                    kwargs["probabilities"] = (
+                        "PROBS" in experiment or "SELFCONSISTENCY" in experiment
+                    )
+                jobs.append(
+                    settings["job"](
+                        model, patho, _id, results[_id], hadm_info_clean[_id], **kwargs
+                    )
+                )
+    return jobs
+
+
+# Jobs of the current iter_evaluations call. Forked workers inherit them instead of receiving them pickled
+_FORKED_JOBS = None
+
+
+def _evaluate_forked_chunk(chunk):
+    return [(indx, evaluate_job(_FORKED_JOBS[indx])) for indx in chunk]
+
+
+def iter_evaluations(jobs, num_workers=1, chunk_size=8):
+    """
+    Evaluate all jobs, optionally on a pool of forked processes. The spaCy pipeline is loaded before forking so that
+    every worker starts with a warm model.
+
+    Yields:
+        (index, eval): Index of the job and its evaluation as soon as it is done, in any order
+    """
+    global _FORKED_JOBS
+    if num_workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("Processes cannot be forked on this platform, running serially")
+        num_workers = 1
+    if num_workers <= 1 or len(jobs) < 2:
+        for indx, job in enumerate(jobs):
+            yield indx, evaluate_job(job)
+        return
+
+    warmup()
+    chunks = [
+        list(range(i, min(i + chunk_size, len(jobs))))
+        for i in range(0, len(jobs), chunk_size)
+    ]
+    _FORKED_JOBS = jobs
+    try:
+        with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+            for chunk_evals in pool.imap_unordered(_evaluate_forked_chunk, chunks):
+                yield from chunk_evals
+    finally:
+        _FORKED_JOBS = None
+
+
+def evaluate_jobs(jobs, num_workers=1, chunk_size=8, evaluation_cache=None):
+    """
+    Args:
+        evaluation_cache (EvaluationCache): Evaluations of unchanged trajectories are taken from the cache, new ones
+            are added to it
+
+    Returns:
+        evals (list): Evaluation of every job in the order of jobs
+    """
+    evals = [None] * len(jobs)
+    keys = [None] * len(jobs)
+    if evaluation_cache is not None:
+        evaluator_classes = {}
+        for indx, job in enumerate(jobs):
+            if job.pathology not in evaluator_classes:
+                evaluator_classes[job.pathology] = type(load_evaluator(job.pathology))
+            keys[indx] = evaluation_cache.key(
+                evaluator_classes[job.pathology], job.hadm_id, job.evaluation_kwargs
+            )
+            evals[indx] = evaluation_cache.get(keys[indx])
+        print(f"Evaluation cache: {evaluation_cache.stats()}")
+
+    uncached = [indx for indx, eval in enumerate(evals) if eval is None]
+    uncached_jobs = [jobs[indx] for indx in uncached]
+    for done, (indx, eval) in enumerate(
+        iter_evaluations(uncached_jobs, num_workers, chunk_size), start=1
+    ):
+        evals[uncached[indx]] = eval
+        if evaluation_cache is not None:
+            evaluation_cache.add(keys[uncached[indx]], eval)
+        if done % 500 == 0:
+            print(f"Evaluated {done}/{len(uncached_jobs)} admissions")
+    return evals
+
+
+def score_model(all_evals, fields, pathologies, count_unnecessary_fields):
+    avg_scores = {}
+    avg_samples = {}
+    for field in fields:
+        avg_scores[field] = {}
+        avg_samples[field] = {}
+        for patho in pathologies:
+            if count_unnecessary_fields and field in UNNECESSARY_FIELDS:
+                all_evals[patho] = count_unnecessary(all_evals[patho], field)
+
+            avg, n = calculate_average(all_evals[patho], field, patho)
+
+            avg_scores[field][patho] = avg
+            avg_samples[field][patho] = n
+    return avg_scores
+
+
+def dump(obj, path):
+    with open(str(path), "wb") as f:
+        pickle.dump(obj, f)
+
+
+def evaluate_experiment(
+    task,
+    experiment,
+    id_difficulty,
+    difficulty="first_diag",
+    models=MODELS,
+    pathologies=PATHOLOGIES,
+    fields=FIELDS,
+    num_workers=1,
+    evaluation_cache=None,
+):
+    """
+    Evaluate the results of all models on all pathologies of an experiment in LOGS_SOTA_DIR and write the evals,
+    results and scores per model and of the whole experiment.
+
+    Args:
+        task (str): "cdm" for runs of run.py, "fi" for runs of run_full_info.py
+        experiment (str): Directory of the experiment in LOGS_SOTA_DIR
+        id_difficulty (dict): Admissions of every pathology by difficulty
+        difficulty (str): Difficulty to evaluate
+        num_workers (int): Number of processes
+        evaluation_cache (EvaluationCache): Cache of evaluations of unchanged trajectories
+
+    Returns:
+        model_evals (dict), model_results (dict), model_scores (dict): Keyed by model and then pathology
+    """
+    print(experiment)
+    jobs = collect_jobs(task, experiment, models, pathologies, id_difficulty, difficulty)
+    evals = evaluate_jobs(jobs, num_workers, evaluation_cache=evaluation_cache)
+
+    model_evals = {model: {patho: {} for patho in pathologies} for model in models}
+    model_results = {model: {patho: {} for patho in pathologies} for model in models}
+    for job, eval in zip(jobs, evals):
+        model_evals[job.model][job.pathology][job.hadm_id] = eval
+        model_results[job.model][job.pathology][job.hadm_id] = job.result
+
+    model_scores = {}
+    save = difficulty in TASKS[task]["saved_difficulties"]
+    for model in models:
+        model_scores[model] = score_model(
+            model_evals[model], fields, pathologies, count_unnecessary_fields=task == "cdm"
+        )
+        if save:
+            dump(model_evals[model], LOGS_SOTA_DIR / experiment / f"{model}_evals.pkl")
+            dump(
+                model_results[model], LOGS_SOTA_DIR / experiment / f"{model}_results.pkl"
+            )
+            dump(model_scores[model], LOGS_SOTA_DIR / experiment / f"{model}_scores.pkl")
+    if save:
+        dump(model_evals, LOGS_SOTA_DIR / experiment / "evals.pkl")
+        dump(model_results, LOGS_SOTA_DIR / experiment / "results.pkl")
+        dump(model_scores, LOGS_SOTA_DIR / experiment / "scores.pkl")
+    return model_evals, model_results, model_scores
+
+
+def load_id_difficulty():
+    with open(str(CDM_DATASET_DIR / "id_difficulty.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate the results of experiments in the SOTA log directory"
+    )
+    parser.add_argument("task", choices=list(TASKS), help="cdm or fi")
+    parser.add_argument("experiments", nargs="+", help="Experiment directories")
+    parser.add_argument("--difficulty", default="first_diag")
+    parser.add_argument("--models", nargs="+", default=MODELS)
+    parser.add_argument("--pathologies", nargs="+", default=PATHOLOGIES)
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes, defaults to all cores",
+    )
+    parser.add_argument(
+        "--evaluation_cache",
+        default=str(EVALUATION_CACHE_PATH),
+        help="SQLite cache of evaluations. Empty to evaluate everything again",
+    )
+    args = parser.parse_args()
+
+    evaluation_cache = None
+    if args.evaluation_cache:
+        evaluation_cache = EvaluationCache(args.evaluation_cache)
+    id_difficulty = load_id_difficulty()
+    experiment_scores = {}
+    for experiment in args.experiments:
+        _, _, experiment_scores[experiment] = evaluate_experiment(
+            args.task,
+            experiment,
+            id_difficulty,
+            difficulty=args.difficulty,
+            models=args.models,
+            pathologies=args.pathologies,
+            num_workers=args.num_workers,
+            evaluation_cache=evaluation_cache,
+        )
+    pprint(experiment_scores)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,14 @@
-import pickle
-import glob
+import os
 from pprint import pprint
 
-from dataset.utils import load_hadm_from_file
-from evaluate.utils import calculate_average, count_unnecessary
-from settings import CDM_DATASET_DIR, FIELDS, LOGS_SOTA_DIR, MODELS, PATHOLOGIES
-from utils.logging import read_from_pickle_file
-from run import load_evaluator
+from evaluate.cache import EvaluationCache
+from evaluate.engine import evaluate_experiment, load_id_difficulty
+from settings import EVALUATION_CACHE_PATH
 
 
-id_difficulty = pickle.load(open(str(CDM_DATASET_DIR / "id_difficulty.pkl"), "rb"))
+id_difficulty = load_id_difficulty()
 difficulty = "first_diag"
+evaluation_cache = EvaluationCache(str(EVALUATION_CACHE_PATH))
 
 experiment_results = {}
 experiment_evals = {}
@@ -19,115 +17,14 @@ experiment_scores = {}
 for experiment in [
     "CDM_VANILLA",
 ]:
-    print(experiment)
-    model_scores = {}
-    model_evals = {}
-    model_results = {}
-
-    for model in MODELS:
-        run = f"_ZeroShot_{model}_*_results.pkl"
-        assert "result" in run
-
-        all_evals = {}
-        all_results = {}
-        for patho in PATHOLOGIES:
-            # Load patient data
-            hadm_info_clean = load_hadm_from_file(f"{patho}_hadm_info_clean", base_mimic="cdm-dataset")
-            all_evals[patho] = {}
-            all_results[patho] = {}
-
-            results_log_path = str(LOGS_SOTA_DIR / experiment / f"{patho}{run}")
-            print(results_log_path)
-
-            results = []
-            for r in read_from_pickle_file(glob.glob(results_log_path)[0]):
-                results.append(r)
-            results = {k: v for d in results for k, v in d.items()}
-
-            for _id in id_difficulty[patho][difficulty]:
-                if _id not in results:
-                    print(f"Skipping {_id} | {glob.glob(results_log_path)[0]}")
-                    continue
-                result = results[_id]
-                evaluator = load_evaluator(patho)  # Reload every time to ensure no state is carried over
-                eval = evaluator._evaluate_agent_trajectory(
-                    prediction=result["output"],
-                    input=result["input"],
-                    reference=(
-                        hadm_info_clean[_id]["Discharge Diagnosis"],
-                        hadm_info_clean[_id]["ICD Diagnosis"],
-                        hadm_info_clean[_id]["Procedures ICD9"],
-                        hadm_info_clean[_id]["Procedures ICD10"],
-                        hadm_info_clean[_id]["Procedures Discharge"],
-                    ),
-                    agent_trajectory=result["intermediate_steps"],
-                )
-                all_evals[patho][_id] = eval
-                all_results[patho][_id] = result
-
-        model_evals[model] = all_evals
-        model_results[model] = all_results
-        avg_scores = {}
-        avg_samples = {}
-
-        for field in FIELDS:
-            avg_scores[field] = {}
-            avg_samples[field] = {}
-            for patho in PATHOLOGIES:
-                if field in ["Unnecessary Laboratory Tests", "Unnecessary Imaging"]:
-                    all_evals[patho] = count_unnecessary(all_evals[patho], field)
-
-                avg, n = calculate_average(all_evals[patho], field, patho)
-
-                avg_scores[field][patho] = avg
-                avg_samples[field][patho] = n
-
-        model_scores[model] = avg_scores
-
-        if difficulty == "first_diag":
-            pickle.dump(
-                all_evals,
-                open(
-                    str(LOGS_SOTA_DIR / experiment / f"{model}_evals.pkl"),
-                    "wb",
-                ),
-            )
-            pickle.dump(
-                all_results,
-                open(
-                    str(LOGS_SOTA_DIR / experiment / f"{model}_results.pkl"),
-                    "wb",
-                ),
-            )
-            pickle.dump(
-                avg_scores,
-                open(
-                    str(LOGS_SOTA_DIR / experiment / f"{model}_scores.pkl"),
-                    "wb",
-                ),
-            )
-    if difficulty == "first_diag":
-        pickle.dump(
-            model_evals,
-            open(
-                str(LOGS_SOTA_DIR / experiment / "evals.pkl"),
-                "wb",
-            ),
-        )
-        pickle.dump(
-            model_results,
-            open(
-                str(LOGS_SOTA_DIR / experiment / "results.pkl"),
-                "wb",
-            ),
-        )
-        pickle.dump(
-            model_scores,
-            open(
-                str(LOGS_SOTA_DIR / experiment / "scores.pkl"),
-                "wb",
-            ),
-        )
+    model_evals, model_results, model_scores = evaluate_experiment(
+        "cdm",
+        experiment,
+        id_difficulty,
+        difficulty=difficulty,
+        num_workers=os.cpu_count(),
+        evaluation_cache=evaluation_cache,
+    )
     experiment_results[experiment] = model_results
     experiment_evals[experiment] = model_evals
     experiment_scores[experiment] = model_scores
@@ -46,6 +46,52 @@ class ExLlamaV2BaseGenerator:
         loras=None,
         stop_criteria=None,
     ):
+        """
+        Returns:
+            sequence_ids: Prompt and generated ids of shape (1, length), or a list of them if prompt is a list
+            probabilities: Probabilities of the generated tokens of shape (1, length), or a list of them
+        """
+        sequence_ids, probabilities = self.generate_batch(
+            [prompt] if isinstance(prompt, str) else prompt,
+            gen_settings,
+            num_tokens,
+            seed=seed,
+            token_healing=token_healing,
+            encode_special_tokens=encode_special_tokens,
+            loras=loras,
+            stop_criteria=stop_criteria,
+        )
+        if isinstance(prompt, str):
+            self.sequence_ids = sequence_ids[0]
+            return sequence_ids[0], probabilities[0]
+        return sequence_ids, probabilities
+
+    def generate_batch(
+        self,
+        prompts: list,
+        gen_settings: ExLlamaV2Sampler.Settings,
+        num_tokens: int or list,
+        seed=None,
+        token_healing=False,
+        encode_special_tokens=True,
+        loras=None,
+        stop_criteria=None,
+    ):
+        """
+        Generate for several prompts at once with one forward pass per token. Prompts are padded on the left and
+        masked. Every row stops on its own stop criteria and finished rows are retired, so the remaining rows are
+        processed with a smaller batch. The cache must have been created with a batch size of at least len(prompts).
+
+        Args:
+            num_tokens: Maximum number of tokens to generate for all rows or a list with one per prompt. The padded
+                prompts and the largest number of tokens must fit into max_seq_len
+            stop_criteria: One stop criteria for all rows or a list with one per prompt. Criteria that keep the
+                state of their row, like KeywordsStoppingCriteria, must be given per prompt
+
+        Returns:
+            sequence_ids (list): Prompt and generated ids of every prompt without padding, each of shape (1, length)
+            probabilities (list): Probabilities of the generated tokens of every prompt, each of shape (1, length)
+        """
         # Accept LoRA or list of LoRAs
         if loras is not None and isinstance(loras, ExLlamaV2Lora):
             loras = [loras]
@@ -55,16 +101,29 @@ class ExLlamaV2BaseGenerator:
         if seed is not None:
             random.seed(seed)
 
-        # Tokenize input and produce padding mask if needed
+        batch_size = len(prompts)
+        assert (
+            batch_size <= self.cache.batch_size
+        ), "Batch size exceeds the batch size of the cache"
+        if not isinstance(stop_criteria, list):
+            stop_criteria = [stop_criteria] * batch_size
+        if not isinstance(num_tokens, list):
+            num_tokens = [num_tokens] * batch_size
+        # Prompts longer than the context leave a negative number of tokens, they generate nothing
+        num_tokens = [max(n, 0) for n in num_tokens]
+        max_tokens = torch.tensor(num_tokens)
+        num_tokens = max(num_tokens)
+
+        # Tokenize input and produce padding mask
 
-        batch_size = 1 if isinstance(prompt, str) else len(prompt)
-        ids = self.tokenizer.encode(prompt, encode_special_tokens=encode_special_tokens)
+        ids = self.tokenizer.encode(prompts, encode_special_tokens=encode_special_tokens)
 
         overflow = ids.shape[-1] + num_tokens - self.model.config.max_seq_len
         if overflow > 0:
             ids = ids[:, overflow:]
 
         mask = self.tokenizer.padding_mask(ids) if batch_size > 1 else None
+        padding = (ids == self.tokenizer.pad_token_id).int().cumprod(dim=-1).sum(dim=-1)
 
         # Prepare for healing
 
@@ -77,60 +136,159 @@ class ExLlamaV2BaseGenerator:
 
         # Process prompt and begin gen
 
-        self._gen_begin_base(ids, mask, loras)
-
-        # Begin filters
+        self.cache.current_seq_len = 0
+        self.model.forward(
+            ids[:, :-1],
+            self.cache,
+            input_mask=mask,
+            preprocess_only=True,
+            loras=loras,
+        )
 
         gen_settings.begin_filters(
             self.tokenizer.get_id_to_piece_list()[unhealed_token]
-            if unhealed_token is not None
+            if unhealed_token is not None and batch_size == 1
             else None
         )
 
+        # Output buffers are allocated once. Rows are kept in the order of the cache, the first num_active rows are
+        # still generating
+        seq_len = ids.shape[-1]
+        sequence_ids = torch.empty(
+            (batch_size, seq_len + num_tokens), dtype=torch.long
+        )
+        sequence_ids[:, :seq_len] = ids
+        probabilities_sequence = torch.empty((batch_size, num_tokens), dtype=torch.float)
+        generated = torch.zeros(batch_size, dtype=torch.long)
+        rows = torch.arange(batch_size)
+        num_active = batch_size
+        buffers = [sequence_ids, probabilities_sequence, generated, rows, max_tokens]
+
+        # Tokens in the sequence of every row, for the repetition penalty of greedy sampling on the device
+        sample_on_device = self._greedy_on_device(gen_settings)
+        seen_tokens = None
+
         # Generate tokens
 
-        probabilities_sequence = torch.tensor([[]])
-        for _ in range(num_tokens):
-            logits = (
-                self.model.forward(
-                    self.sequence_ids[:, -1:], self.cache, input_mask=mask, loras=loras
-                )
-                .float()
-                .cpu()
-            )
-            token, probabilities, eos = ExLlamaV2Sampler.sample(
-                logits,
-                gen_settings,
-                self.sequence_ids,
-                random.random(),
-                self.tokenizer,
-                prefix_token=unhealed_token,
-            )
-            self.sequence_ids = torch.cat([self.sequence_ids, token], dim=1)
-            probabilities_sequence = torch.cat(
-                [probabilities_sequence, probabilities], dim=1
+        for step in range(num_tokens):
+            logits = self.model.forward(
+                sequence_ids[:num_active, seq_len - 1 : seq_len].contiguous(),
+                self.cache,
+                input_mask=mask,
+                loras=loras,
             )
-            gen_settings.feed_filters(token)
-
-            # Check for stop tokens
-            if stop_criteria(self.sequence_ids, None):
-                break
+            if sample_on_device and seen_tokens is None:
+                seen_tokens = torch.zeros(
+                    (batch_size, logits.shape[-1]), dtype=torch.bool, device=logits.device
+                )
+                seen_tokens.scatter_(1, ids.to(logits.device), True)
+                buffers.append(seen_tokens)
 
+            if sample_on_device and unhealed_token is None:
+                token, probabilities = self._sample_greedy(
+                    logits, gen_settings, seen_tokens[:num_active]
+                )
+                eos = False
+            else:
+                token, probabilities, eos = ExLlamaV2Sampler.sample(
+                    logits.float().cpu(),
+                    gen_settings,
+                    # The repetition penalty reads the ids as a contiguous tensor
+                    sequence_ids[:num_active, :seq_len].contiguous(),
+                    random.random(),
+                    self.tokenizer,
+                    prefix_token=unhealed_token,
+                )
+            if seen_tokens is not None:
+                seen_tokens[:num_active].scatter_(1, token.to(seen_tokens.device), True)
+            sequence_ids[:num_active, seq_len] = token[:, 0]
+            probabilities_sequence[:num_active, step] = probabilities[:, 0]
+            seq_len += 1
+            generated[:num_active] = step + 1
+            if batch_size == 1:
+                gen_settings.feed_filters(token)
             unhealed_token = None
-            if eos:
-                break
-
-        return self.sequence_ids, probabilities_sequence
 
-        # Decode
-
-        text = self.tokenizer.decode(
-            self.sequence_ids, decode_special_tokens=decode_special_tokens
+            # Check for stop tokens and rows that generated their number of tokens
+            finished = [
+                row
+                for row in range(num_active)
+                if eos
+                or generated[row] >= max_tokens[row]
+                or stop_criteria[rows[row].item()](
+                    sequence_ids[row : row + 1, :seq_len], None
+                )
+            ]
+            if len(finished) == num_active:
+                num_active = 0
+                break
+            if finished:
+                keep = [row for row in range(num_active) if row not in finished]
+                self._retire_rows(keep, finished, buffers)
+                if mask is not None:
+                    mask = mask[keep]
+                num_active = len(keep)
+
+        # Return rows in the order of the prompts without padding
+        outputs = [None] * batch_size
+        output_probabilities = [None] * batch_size
+        prompt_len = ids.shape[-1]
+        for row in range(batch_size):
+            prompt = rows[row].item()
+            length = max(min(generated[row].item(), max_tokens[row].item()), 0)
+            outputs[prompt] = sequence_ids[
+                row : row + 1, padding[prompt] : prompt_len + length
+            ]
+            output_probabilities[prompt] = probabilities_sequence[
+                row : row + 1, :length
+            ]
+        return outputs, output_probabilities
+
+    @staticmethod
+    def _greedy_on_device(gen_settings):
+        # Settings of greedy_clone. ExLlamaV2Sampler would need all logits on the host for them
+        return (
+            gen_settings.top_k == 1
+            and not gen_settings.filters
+            and gen_settings.token_bias is None
+            and not gen_settings.mirostat
+            and gen_settings.token_repetition_range == -1
+            and gen_settings.token_repetition_decay == 0
         )
 
-        if isinstance(prompt, str):
-            return text[0]
-        return text
+    @staticmethod
+    def _sample_greedy(logits, gen_settings, seen_tokens):
+        """
+        Greedy sampling on the device of the logits, equivalent to ExLlamaV2Sampler for greedy settings: the
+        repetition penalty applies once to every token in the sequence, token 0 is never sampled and the probability
+        is the softmax at the sampling temperature. Only the sampled tokens and their probabilities are moved to the
+        host.
+        """
+        logits = logits[:, -1, :].float()
+        penalty = gen_settings.token_repetition_penalty
+        if penalty != 1.0:
+            penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+            logits = torch.where(seen_tokens, penalized, logits)
+        token = logits[:, 1:].argmax(dim=-1, keepdim=True) + 1
+        probabilities = torch.softmax(
+            logits * (1.0 / gen_settings.temperature), dim=-1
+        ).gather(-1, token)
+        return token.cpu(), probabilities.cpu()
+
+    def _retire_rows(self, keep, finished, buffers):
+        # Move the rows that keep generating to the front of the cache and the buffers. Finished rows are kept behind
+        # them in the buffers until the end of generation
+        order = torch.tensor(keep + finished)
+        for buffer in buffers:
+            buffer[: len(order)] = buffer[order.to(buffer.device)]
+
+        keep_index = torch.tensor(keep)
+        seq_len = self.cache.current_seq_len
+        for states in (self.cache.key_states, self.cache.value_states):
+            for layer_states in states:
+                layer_states[: len(keep), :seq_len] = layer_states[
+                    keep_index.to(layer_states.device), :seq_len
+                ]
 
     def _gen_begin_base(self, input_ids, mask=None, loras=None):
         self.cache.current_seq_len = 0
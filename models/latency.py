@@ -0,0 +1,42 @@
+import time
+from typing import List
+
+
+class LatencyTracker:
+    """Wall clock duration of every call, e.g. of every generation of a run"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+
+    def track(self):
+        return _TrackedCall(self)
+
+    def stats(self):
+        if not self.latencies:
+            return {"calls": 0}
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            "calls": len(latencies),
+            "total": sum(latencies),
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "max": latencies[-1],
+        }
+
+
+class _TrackedCall:
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracker.latencies.append(time.perf_counter() - self.start)
+        return False
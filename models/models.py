@@ -3,12 +3,6 @@ from os.path import join
 from typing import Any, List, Mapping, Dict
 
 import torch
-import openai
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-)
 from transformers import GenerationConfig, StoppingCriteriaList
 from auto_gptq import exllama_set_max_input_length
 from langchain.llms.base import LLM
@@ -16,6 +10,7 @@ from exllamav2.generator import ExLlamaV2Sampler
 import tiktoken
 
 from models.utils import create_stop_criteria, create_stop_criteria_exllama
+from models.latency import LatencyTracker
 from agents.agent import STOP_WORDS
 from utils.nlp import extract_sections
 
@@ -33,9 +28,18 @@ class CustomLLM(LLM):
     tokenizer: Any
     seed: int
     self_consistency: bool = False
+    # Number of prompts generate_batch processes at once. Sets the batch size of the exllama cache
+    batch_size: int = 1
 
     openai_api_key: str = None
     openai_api_base: str = None
+    openai_timeout: float = 600
+    openai_connect_timeout: float = 10
+    openai_max_attempts: int = 10
+    # Number of generations run at the same time. Sizes the connection pool of the OpenAI client
+    concurrency: int = 1
+    client: Any = None
+    latency_tracker: LatencyTracker = LatencyTracker()
     tags: Dict[str, str] = None
 
     @property
@@ -68,7 +72,19 @@ class CustomLLM(LLM):
         if self.model_name == "Human":
             return
 
-        elif self.model_name in ["gpt-3.5-turbo", "gpt-4"]:
+        # One client for the whole run so that connections are reused between generations
+        if self.openai_api_key:
+            from models.openai_client import create_openai_client
+
+            self.client = create_openai_client(
+                api_key=self.openai_api_key,
+                base_url=self.openai_api_base,
+                timeout=self.openai_timeout,
+                connect_timeout=self.openai_connect_timeout,
+                max_connections=max(16, self.concurrency),
+            )
+
+        if self.model_name in ["gpt-3.5-turbo", "gpt-4"]:
             self.tokenizer = tiktoken.encoding_for_model(self.model_name)
             return
 
@@ -112,13 +128,18 @@ class CustomLLM(LLM):
                 config.model_dir = join(base_models, self.model_name)
                 config.prepare()
                 config.max_seq_len = self.max_context_length
+                if self.batch_size > 1:
+                    # Shorter prompts of a batch are padded up to the longest one. Room for the padding lets every
+                    # prompt generate up to max_context_length tokens in total, as when generated alone
+                    config.max_seq_len = 2 * self.max_context_length
                 config.scale_pos_emb = 1.0
                 config.scale_alpha_value = 1.0
                 config.no_flash_attn = False
+                config.max_batch_size = self.batch_size
                 self.model = ExLlamaV2(config)
                 self.model.load()
                 self.tokenizer = ExLlamaV2Tokenizer(config)
-                cache = ExLlamaV2Cache(self.model)
+                cache = ExLlamaV2Cache(self.model, batch_size=self.batch_size)
                 self.generator = ExLlamaV2BaseGenerator(self.model, cache, self.tokenizer)
                 self.generator.warmup()
 
@@ -151,9 +172,12 @@ class CustomLLM(LLM):
 
         self.tokenizer.truncation_side = "left"
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(10))
     def completion_with_backoff(self, **kwargs):
-        return openai.ChatCompletion.create(**kwargs)
+        from models.openai_client import chat_completion_with_retry
+
+        return chat_completion_with_retry(
+            self.client, max_attempts=self.openai_max_attempts, **kwargs
+        )
 
     def remove_input_tokens(self, output_tokens, ids):
         # Truncate the larger tensor to match the size of the smaller one
@@ -178,6 +202,33 @@ class CustomLLM(LLM):
         repetition_penalty=1.2,
         length_penalty=1.0,
         **kwargs,
+    ) -> str:
+        with self.latency_tracker.track():
+            return self._generate_output(
+                prompt,
+                stop,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                num_beams=num_beams,
+                repetition_penalty=repetition_penalty,
+                length_penalty=length_penalty,
+                **kwargs,
+            )
+
+    def _generate_output(
+        self,
+        prompt: str,
+        stop: List[str],
+        do_sample,
+        temperature,
+        top_k,
+        top_p,
+        num_beams,
+        repetition_penalty,
+        length_penalty,
+        **kwargs,
     ) -> str:
         self.probabilities = None
 
@@ -185,25 +236,12 @@ class CustomLLM(LLM):
             output = input(prompt)
 
         elif self.openai_api_key:
-            from openai import OpenAI
-
             messages = extract_sections(
                 prompt,
                 self.tags,
             )
 
-            # response = self.completion_with_backoff(
-            #     model=self.model_name,
-            #     messages=messages,
-            #     stop=STOP_WORDS,
-            #     temperature=0.0,
-            #     seed=self.seed,
-            # )
-            client = OpenAI(
-                api_key=self.openai_api_key,
-                base_url=self.openai_api_base,
-            )
-            completion = client.chat.completions.create(
+            completion = self.completion_with_backoff(
                 messages=messages,
                 model=self.model_name,
             )
@@ -229,7 +267,7 @@ class CustomLLM(LLM):
                 output_tokens, self.probabilities = self.generator.generate_simple(
                     prompt,
                     gen_settings=settings,
-                    num_tokens=self.max_context_length - tokens_prompt,
+                    num_tokens=[self.max_context_length - prompt_ids.shape[-1] for prompt_ids in ids],
                     seed=seed,
                     token_healing=True,
                     encode_special_tokens=True,
@@ -276,12 +314,83 @@ class CustomLLM(LLM):
             s_no_input = s[:, input_ids.shape[1] :]
             output = self.tokenizer.batch_decode(s_no_input, skip_special_tokens=True)[0]
 
+        return self.clean_output(output, stop)
+
+    def clean_output(self, output: str, stop: List[str]) -> str:
         # Remove observations strings from output if generated
         for stop_word in STOP_WORDS + stop:
             output = output.replace(stop_word, "")
 
         return output.strip()
 
+    def generate_batch(self, prompts: List[str], stop: List[str]):
+        """
+        Generate for several prompts at once. Local exllama models decode up to batch_size prompts per forward pass,
+        all other models generate for one prompt after another.
+
+        Returns:
+            outputs (list): Generated text of every prompt
+            probabilities (list): Probabilities of the generated tokens of every prompt or None
+        """
+        if not self.exllama or self.openai_api_key or len(prompts) == 1:
+            outputs = []
+            probabilities = []
+            for prompt in prompts:
+                outputs.append(self._call(prompt, stop))
+                probabilities.append(self.probabilities)
+            return outputs, probabilities
+
+        outputs = []
+        probabilities = []
+        for i in range(0, len(prompts), self.batch_size):
+            with self.latency_tracker.track():
+                batch_outputs, batch_probabilities = self._generate_batch_exllama(
+                    prompts[i : i + self.batch_size], stop
+                )
+            outputs.extend(batch_outputs)
+            probabilities.extend(batch_probabilities)
+        self.probabilities = None
+        return outputs, probabilities
+
+    def _generate_batch_exllama(self, prompts: List[str], stop: List[str]):
+        with torch.inference_mode():
+            ids = [
+                self.tokenizer.encode(prompt, encode_special_tokens=True)
+                for prompt in prompts
+            ]
+
+            settings = ExLlamaV2Sampler.Settings()
+            if self.self_consistency:
+                settings = settings.clone()
+                settings.temperature = 0.7
+                seed = None
+            else:
+                settings = settings.greedy_clone()
+                seed = self.seed
+
+            # The criteria keep the state of their row
+            stop_criteria = [
+                create_stop_criteria_exllama(stop, self.tokenizer.eos_token_id, self.tokenizer)
+                for _ in prompts
+            ]
+
+            output_tokens, probabilities = self.generator.generate_batch(
+                prompts,
+                gen_settings=settings,
+                num_tokens=[self.max_context_length - prompt_ids.shape[-1] for prompt_ids in ids],
+                seed=seed,
+                token_healing=True,
+                encode_special_tokens=True,
+                stop_criteria=stop_criteria,
+            )
+
+            outputs = []
+            for prompt_ids, prompt_output_tokens in zip(ids, output_tokens):
+                prompt_output_tokens = self.remove_input_tokens(prompt_output_tokens, prompt_ids)
+                output = self.tokenizer.decode(prompt_output_tokens, decode_special_tokens=False)[0]
+                outputs.append(self.clean_output(output, stop))
+        return outputs, probabilities
+
     @property
     def _identifying_params(self) -> Mapping[str, Any]:
         """Get the identifying parameters."""
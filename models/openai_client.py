@@ -0,0 +1,58 @@
+import httpx
+import openai
+from tenacity import (
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+# Errors that are worth retrying. Everything else, e.g. a wrong model name, fails immediately
+RETRYABLE_OPENAI_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+def create_openai_client(
+    api_key: str,
+    base_url: str,
+    timeout: float = 600,
+    connect_timeout: float = 10,
+    max_connections: int = 16,
+) -> openai.OpenAI:
+    """
+    Long-lived OpenAI compatible client. The underlying httpx pool keeps connections alive between calls so that only
+    the first generation pays for the TCP and TLS handshake. Retries are done by chat_completion_with_retry.
+    """
+    http_client = httpx.Client(
+        timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+    )
+    return openai.OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        max_retries=0,
+        http_client=http_client,
+    )
+
+
+def chat_completion_with_retry(
+    client: openai.OpenAI,
+    max_attempts: int = 10,
+    min_wait: float = 1,
+    max_wait: float = 60,
+    **kwargs,
+):
+    for attempt in Retrying(
+        wait=wait_random_exponential(min=min_wait, max=max_wait),
+        stop=stop_after_attempt(max_attempts),
+        retry=retry_if_exception_type(RETRYABLE_OPENAI_ERRORS),
+        reraise=True,
+    ):
+        with attempt:
+            return client.chat.completions.create(**kwargs)
@@ -1,4 +1,7 @@
+import weakref
+from collections import deque
 from typing import List
+
 import torch
 from transformers import StoppingCriteria
 
@@ -17,42 +20,175 @@ def calculate_log_prob_confidence(probs: torch.Tensor):
 
 
 def create_stop_criteria(stop_words: List[str], tokenizer, device) -> StoppingCriteria:
-    stop_ids = [
-        tokenizer.encode(w, add_special_tokens=False, return_tensors="pt").to(device)
-        for w in stop_words
-    ]
-    # When a word occurs within a continuous string its encoding changes. To account for this, we add a period to the beginning of the word and remove it from encoding.
-    stop_ids_2 = [
-        tokenizer.encode("." + w, add_special_tokens=False, return_tensors="pt")[
-            :, 1:
-        ].to(device)
-        for w in stop_words
-    ]
-    stop_ids.extend(stop_ids_2)
-    stop_ids = [s[0] for s in stop_ids]
-    return KeywordsStoppingCriteria(stop_ids)
+    # The stop words are matched on the text of the generated tokens, so the criteria works on any device
+    return KeywordsStoppingCriteria(get_stop_matcher(stop_words, tokenizer))
 
 
 def create_stop_criteria_exllama(
     stop_words: List[str], stop_token: int, tokenizer
 ) -> StoppingCriteria:
-    stop_ids = [tokenizer.encode(w) for w in stop_words]
-    # When a word occurs within a continuous string its encoding changes. To account for this, we add a period to the beginning of the word and remove it from encoding.
-    stop_ids_2 = [tokenizer.encode("." + w)[:, 1:] for w in stop_words]
-    stop_ids.extend(stop_ids_2)
-    stop_ids = [s[0] for s in stop_ids]
-    stop_ids.append(torch.tensor([stop_token]))
-    return KeywordsStoppingCriteria(stop_ids)
+    return KeywordsStoppingCriteria(
+        get_stop_matcher(stop_words, tokenizer, stop_tokens=(stop_token,))
+    )
+
+
+def token_piece(tokenizer, token: int) -> str:
+    """Text a token adds to the decoded output"""
+    if hasattr(tokenizer, "get_id_to_piece_list"):
+        # exllama tokenizers cache the pieces of the whole vocabulary
+        return tokenizer.get_id_to_piece_list()[token]
+    piece = tokenizer.convert_ids_to_tokens(token)
+    if piece is None:
+        return ""
+    if piece.startswith("<0x") and piece.endswith(">"):
+        # Byte fallback tokens of sentencepiece
+        return tokenizer.decode([token])
+    if "▁" in piece:
+        # Sentencepiece marks spaces, which convert_tokens_to_string would strip at the start of the text
+        return piece.replace("▁", " ")
+    return tokenizer.convert_tokens_to_string([piece])
+
+
+class StopMatcher:
+    """
+    Aho-Corasick automaton over the characters of the stop words, advanced by one generated token at a time. Matching
+    the text of the tokens instead of the token ids of the stop words finds stop words however they are split into
+    tokens, e.g. "Observation:" within "sentence.Observation:" or ending within a token like ":\n".
+
+    The state after a token and whether a stop word ended within it only depend on the previous state and the token,
+    so they are computed once per state and token and looked up afterwards.
+    """
+
+    def __init__(self, stop_words: List[str], tokenizer, stop_tokens=()):
+        # The shared matchers are keyed by their tokenizer, see get_stop_matcher
+        self.tokenizer_ref = weakref.ref(tokenizer)
+        self.stop_tokens = set(stop_tokens)
+        self.max_length = max((len(w) for w in stop_words), default=0)
+        self.pieces = {}
+        self.transitions = {}
+
+        # Trie of the stop words. State 0 is the root
+        self.goto = [{}]
+        self.matches = [False]
+        for word in stop_words:
+            if not word:
+                continue
+            state = 0
+            for char in word:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.matches.append(False)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.matches[state] = True
+
+        # Failure links point to the state of the longest proper suffix that is also in the trie
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.matches[next_state] = (
+                    self.matches[next_state] or self.matches[self.fail[next_state]]
+                )
+                queue.append(next_state)
+
+    @property
+    def tokenizer(self):
+        tokenizer = self.tokenizer_ref()
+        if tokenizer is None:
+            raise ReferenceError("The tokenizer of the stop matcher no longer exists")
+        return tokenizer
+
+    def piece(self, token: int) -> str:
+        if token not in self.pieces:
+            self.pieces[token] = token_piece(self.tokenizer, token)
+        return self.pieces[token]
+
+    def advance(self, state: int, token: int):
+        """
+        Returns:
+            state (int): State after the token
+            matched (bool): Whether a stop word or stop token ended with the token
+        """
+        key = (state, token)
+        if key not in self.transitions:
+            matched = token in self.stop_tokens
+            for char in self.piece(token):
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                state = self.goto[state].get(char, 0)
+                matched = matched or self.matches[state]
+            self.transitions[key] = (state, matched)
+        return self.transitions[key]
+
+    def match_tail(self, tokens: List[int]):
+        """
+        State after the tokens and whether a stop word ended with the last token. Only the last tokens are read, as
+        every token has at least one character unless it is special.
+        """
+        state = 0
+        matched = False
+        for token in tokens[-(self.max_length + 1) :]:
+            state, matched = self.advance(state, token)
+        return state, matched
+
+
+# Stop matchers of the tokenizers in use by stop words and stop tokens. Dropped together with their tokenizer
+STOP_MATCHERS = weakref.WeakKeyDictionary()
+
+
+def get_stop_matcher(stop_words: List[str], tokenizer, stop_tokens=()) -> StopMatcher:
+    """Shared StopMatcher of a tokenizer and stop words, created on first use"""
+    matchers = STOP_MATCHERS.setdefault(tokenizer, {})
+    key = (tuple(stop_words), tuple(stop_tokens))
+    if key not in matchers:
+        matchers[key] = StopMatcher(stop_words, tokenizer, stop_tokens)
+    return matchers[key]
 
 
 class KeywordsStoppingCriteria(StoppingCriteria):
-    def __init__(self, keywords: torch.Tensor):
-        self.keywords = keywords
+    """
+    Stops when a stop word ends with the last token of a row. Every row keeps the state of the matcher after its
+    last token, so a call after one more token was generated only advances the matcher by that token. Other inputs,
+    e.g. the first call with the prompt, match the tail of the row again. Rows that stopped stay stopped.
+
+    Holds the state of one generation, create one per generation and, when rows are checked one at a time, per row.
+    """
+
+    def __init__(self, matcher: StopMatcher):
+        self.matcher = matcher
+        # Length, last token, matcher state and whether it stopped of every row
+        self.rows = {}
+
+    def rows_stopped(self, input_ids: torch.LongTensor) -> List[bool]:
+        # One transfer of the tail of all rows instead of one per token
+        tails = input_ids[:, -(self.matcher.max_length + 1) :].tolist()
+        length = input_ids.shape[-1]
+        stopped = []
+        for row, tail in enumerate(tails):
+            previous = self.rows.get(row)
+            if previous is not None and previous[3]:
+                stopped.append(True)
+                continue
+            if (
+                previous is not None
+                and previous[0] + 1 == length
+                and len(tail) > 1
+                and previous[1] == tail[-2]
+            ):
+                state, matched = self.matcher.advance(previous[2], tail[-1])
+            else:
+                state, matched = self.matcher.match_tail(tail)
+            self.rows[row] = (length, tail[-1], state, matched)
+            stopped.append(matched)
+        return stopped
 
     def __call__(
         self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
     ) -> bool:
-        for k in self.keywords:
-            if torch.equal(input_ids[0][-len(k) :], k):
-                return True
-        return False
+        return all(self.rows_stopped(input_ids))
@@ -1,5 +1,7 @@
 import os
 from os.path import join
+import pickle
+import queue
 import random
 from datetime import datetime
 import time
@@ -13,13 +15,15 @@ from loguru import logger
 import langchain
 
 from dataset.utils import load_hadm_from_file
-from utils.logging import append_to_pickle_file
+from utils.results_log import RESULTS_LOG_SUFFIX, open_results_log
+from utils.runner import run_patients
 from evaluators.appendicitis_evaluator import AppendicitisEvaluator
 from evaluators.cholecystitis_evaluator import CholecystitisEvaluator
 from evaluators.diverticulitis_evaluator import DiverticulitisEvaluator
 from evaluators.pancreatitis_evaluator import PancreatitisEvaluator
 from models.models import CustomLLM
-from agents.agent import build_agent_executor_ZeroShot
+from agents.agent import AgentSession
+from agents.summary_cache import create_summary_cache
 
 
 def load_evaluator(pathology):
@@ -68,6 +72,10 @@ def run(args: DictConfig):
         self_consistency=args.self_consistency,
         openai_api_key=args.openai_api_key,
         openai_api_base=args.openai_api_base,
+        openai_timeout=args.openai_timeout,
+        openai_connect_timeout=args.openai_connect_timeout,
+        openai_max_attempts=args.openai_max_attempts,
+        concurrency=args.concurrency,
         tags=tags,
     )
     llm.load_model(args.base_models)
@@ -92,12 +100,16 @@ def run(args: DictConfig):
         run_name += "_NOSUMMARY"
     if args.run_descr:
         run_name += str(args.run_descr)
+    if args.resume_run:
+        run_name = args.resume_run
     run_dir = join(args.local_logging_dir, run_name)
+    if args.resume_run and not os.path.isdir(run_dir):
+        raise ValueError(f"Run to resume not found: {run_dir}")
 
     os.makedirs(run_dir, exist_ok=True)
 
     # Setup logfile and logpickle
-    results_log_path = join(run_dir, f"{run_name}_results.pkl")
+    results_log_path = join(run_dir, f"{run_name}{RESULTS_LOG_SUFFIX}")
     eval_log_path = join(run_dir, f"{run_name}_eval.pkl")
     log_path = join(run_dir, f"{run_name}.log")
     logger.add(log_path, enqueue=True, backtrace=True, diagnose=True)
@@ -106,36 +118,82 @@ def run(args: DictConfig):
     # Set langsmith project name
     # os.environ["LANGCHAIN_PROJECT"] = run_name
 
-    # Predict for all patients
-    first_patient_seen = False
-    for _id in hadm_info_clean.keys():
-        if args.first_patient and not first_patient_seen:
-            if _id == args.first_patient:
-                first_patient_seen = True
-            else:
-                continue
+    summary_cache = None
+    if args.summary_cache_path:
+        summary_cache = create_summary_cache(
+            args.summary_cache_path, args.model_name, args.summary_cache_max_entries
+        )
 
-        logger.info(f"Processing patient: {_id}")
+    if args.concurrency > 1 and not args.openai_api_key:
+        raise ValueError(
+            "Concurrent patients are only supported for OpenAI compatible backends."
+        )
 
-        # Build
-        agent_executor = build_agent_executor_ZeroShot(
-            patient=hadm_info_clean[_id],
-            llm=llm,
-            lab_test_mapping_path=args.lab_test_mapping_path,
-            logfile=log_path,
-            max_context_length=args.max_context_length,
-            tags=tags,
-            include_ref_range=args.include_ref_range,
-            bin_lab_results=args.bin_lab_results,
-            include_tool_use_examples=args.include_tool_use_examples,
-            provide_diagnostic_criteria=args.provide_diagnostic_criteria,
-            summarize=args.summarize,
-            model_stop_words=args.stop_words,
+    # Load the lab test mapping once, all agents share it and its indexes
+    with open(args.lab_test_mapping_path, "rb") as f:
+        lab_test_mapping_df = pickle.load(f)
+
+    # Build agents once, only the patient specific tool state changes between admissions. Every concurrently processed patient needs an agent of its own
+    sessions = queue.Queue()
+    for _ in range(max(1, args.concurrency)):
+        sessions.put(
+            AgentSession(
+                llm=llm,
+                lab_test_mapping_df=lab_test_mapping_df,
+                logfile=log_path,
+                max_context_length=args.max_context_length,
+                tags=tags,
+                include_ref_range=args.include_ref_range,
+                bin_lab_results=args.bin_lab_results,
+                include_tool_use_examples=args.include_tool_use_examples,
+                provide_diagnostic_criteria=args.provide_diagnostic_criteria,
+                summarize=args.summarize,
+                model_stop_words=args.stop_words,
+                summary_cache=summary_cache,
+            )
         )
 
-        # Run
-        result = agent_executor({"input": hadm_info_clean[_id]["Patient History"].strip()})
-        append_to_pickle_file(results_log_path, {_id: result})
+    # Skip patients until the first patient if provided
+    hadm_ids = list(hadm_info_clean.keys())
+    if args.first_patient:
+        if args.first_patient in hadm_ids:
+            hadm_ids = hadm_ids[hadm_ids.index(args.first_patient) :]
+        else:
+            hadm_ids = []
+
+    # Skip patients that a resumed run already completed
+    results_log = open_results_log(results_log_path)
+    if len(results_log):
+        hadm_ids = [_id for _id in hadm_ids if _id not in results_log]
+        logger.info(
+            f"Resuming {run_name}: {len(results_log)} patients done, {len(hadm_ids)} remaining"
+        )
+
+    def predict(_id):
+        logger.info(f"Processing patient: {_id}")
+        hadm = hadm_info_clean[_id]
+
+        session = sessions.get()
+        try:
+            # Bind patient
+            agent_executor = session.build_agent_executor(hadm)
+
+            # Run
+            return agent_executor({"input": hadm["Patient History"].strip()})
+        finally:
+            sessions.put(session)
+
+    # Predict for all patients
+    run_patients(
+        hadm_ids,
+        predict,
+        results_log.append,
+        concurrency=args.concurrency,
+    )
+
+    logger.info(f"Generation latency: {llm.latency_tracker.stats()}")
+    if summary_cache is not None:
+        logger.info(f"Summary cache: {summary_cache.stats()}")
 
 
 if __name__ == "__main__":
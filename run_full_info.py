@@ -7,6 +7,7 @@ from datetime import datetime
 import time
 import pickle
 import fcntl
+import threading
 
 import numpy as np
 import hydra
@@ -18,13 +19,16 @@ from langchain.chains import LLMChain
 from thefuzz import process
 
 from utils.nlp import calculate_num_tokens, truncate_text, create_lab_test_string
+from tools.utils import get_lab_test_mapping
 from dataset.utils import load_hadm_from_file
-from utils.logging import append_to_pickle_file
+from utils.results_log import RESULTS_LOG_SUFFIX, open_results_log
+from utils.runner import run_patient_batches, run_patients
 from evaluators.appendicitis_evaluator import AppendicitisEvaluator
 from evaluators.cholecystitis_evaluator import CholecystitisEvaluator
 from evaluators.diverticulitis_evaluator import DiverticulitisEvaluator
 from evaluators.pancreatitis_evaluator import PancreatitisEvaluator
 from models.models import CustomLLM
+from agents.summary_cache import create_summary_cache, summarize_with_cache
 from agents.prompts import (
     FULL_INFO_TEMPLATE,
     FULL_INFO_TEMPLATE_SECTION,
@@ -113,6 +117,11 @@ def run(args: DictConfig):
         self_consistency=args.self_consistency,
         openai_api_key=args.openai_api_key,
         openai_api_base=args.openai_api_base,
+        openai_timeout=args.openai_timeout,
+        openai_connect_timeout=args.openai_connect_timeout,
+        openai_max_attempts=args.openai_max_attempts,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
         tags=tags,
     )
     llm.load_model(args.base_models)
@@ -125,6 +134,7 @@ def run(args: DictConfig):
             max_context_length=4096,
             exllama=False,
             seed=2023,
+            concurrency=args.concurrency,
         )
         diag_crit_writer.load_model(args.base_models)
 
@@ -233,12 +243,22 @@ def run(args: DictConfig):
         run_name += "_PROBS"
     if args.run_descr:
         run_name += str(args.run_descr)
+    if args.resume_run:
+        run_name = args.resume_run
     run_dir = join(args.local_logging_dir, run_name)
+    if args.resume_run and not os.path.isdir(run_dir):
+        raise ValueError(f"Run to resume not found: {run_dir}")
 
     os.makedirs(run_dir, exist_ok=True)
 
+    summary_cache = None
+    if args.summary_cache_path:
+        summary_cache = create_summary_cache(
+            args.summary_cache_path, args.model_name, args.summary_cache_max_entries
+        )
+
     # Setup logfile and logpickle
-    results_log_path = join(run_dir, f"{run_name}_results.pkl")
+    results_log_path = join(run_dir, f"{run_name}{RESULTS_LOG_SUFFIX}")
     log_path = join(run_dir, f"{run_name}.log")
     logger.add(log_path, enqueue=True, backtrace=True, diagnose=True)
     logger.info(args)
@@ -246,9 +266,10 @@ def run(args: DictConfig):
     # Set langsmith project name
     # os.environ["LANGCHAIN_PROJECT"] = run_name
 
-    # Load lab test mapping
+    # Load lab test mapping and build its indexes once for all lab test reports
     with open(args.lab_test_mapping_path, "rb") as f:
         lab_test_mapping_df = pickle.load(f)
+    lab_test_mapping = get_lab_test_mapping(lab_test_mapping_df)
 
     # Load patient data
     # for patho in ["appendicitis", "cholecystitis", "diverticulitis", "pancreatitis"]:
@@ -263,13 +284,37 @@ def run(args: DictConfig):
         with open(args.patient_list_path, "rb") as f:
             patient_list = pickle.load(f)
 
-    first_patient_seen = False
-    for _id in patient_list:
-        if args.first_patient and not first_patient_seen:
-            if _id == args.first_patient:
-                first_patient_seen = True
-            else:
-                continue
+    if args.concurrency > 1 and not args.openai_api_key:
+        raise ValueError(
+            "Concurrent patients are only supported for OpenAI compatible backends."
+        )
+    if args.concurrency > 1 and args.save_probabilities:
+        raise ValueError(
+            "Saving probabilities of concurrently processed patients is not supported."
+        )
+    if args.batch_size > 1 and not args.exllama:
+        raise ValueError("Batched generation is only supported for exllama models.")
+    if args.batch_size > 1 and args.concurrency > 1:
+        raise ValueError("Batched generation and concurrent patients cannot be combined.")
+    diagnostic_criteria_lock = threading.Lock()
+
+    # Skip patients until the first patient if provided
+    hadm_ids = list(patient_list)
+    if args.first_patient:
+        if args.first_patient in hadm_ids:
+            hadm_ids = hadm_ids[hadm_ids.index(args.first_patient) :]
+        else:
+            hadm_ids = []
+
+    # Skip patients that a resumed run already completed
+    results_log = open_results_log(results_log_path)
+    if len(results_log):
+        hadm_ids = [_id for _id in hadm_ids if _id not in results_log]
+        logger.info(
+            f"Resuming {run_name}: {len(results_log)} patients done, {len(hadm_ids)} remaining"
+        )
+
+    def prepare(_id):
         logger.info(f"Processing patient: {_id}")
         hadm = hadm_info_clean[_id]
 
@@ -344,7 +389,7 @@ def run(args: DictConfig):
                 ),
                 "include_laboratory_tests": (
                     add_laboratory_tests,
-                    [input, hadm, evaluator, lab_test_mapping_df, args],
+                    [input, hadm, evaluator, lab_test_mapping, args],
                 ),
             }
 
@@ -374,14 +419,26 @@ def run(args: DictConfig):
             hadm_info_clean,
             diagnostic_criteria,
             args.summarize,
+            summary_cache,
         )
+        return {
+            "input": input,
+            "rad_reports": rad_reports,
+            "fewshot_examples": fewshot_examples,
+            "diagnostic_criteria": diagnostic_criteria,
+        }
 
-        result = chain.predict(
-            input=input.format(rad_reports=rad_reports),
-            fewshot_examples=fewshot_examples,
-            diagnostic_criteria=diagnostic_criteria,
-            stop=STOP_WORDS,
-        )
+    def chain_inputs(patient):
+        return {
+            "input": patient["input"].format(rad_reports=patient["rad_reports"]),
+            "fewshot_examples": patient["fewshot_examples"],
+            "diagnostic_criteria": patient["diagnostic_criteria"],
+        }
+
+    def finish(patient, result):
+        input = patient["input"]
+        rad_reports = patient["rad_reports"]
+        diagnostic_criteria = patient["diagnostic_criteria"]
 
         if args.prompt_template == "COT":
             # input = input.format(rad_reports=rad_reports)
@@ -419,24 +476,25 @@ def run(args: DictConfig):
 
             # If the length of the diagnosis is too long, the model didnt follow directions and we just take its answer
             if len(diagnosis.split()) > 10:
-                append_to_pickle_file(results_log_path, {_id: result})
-                continue
-
-            DIAGNOSTIC_CRITERIA = read_dict(args.diagnostic_criteria_path)
-            # Check if we have the diagnostic criteria for this pathology
-            patho_match, score = process.extractOne(
-                diagnosis, DIAGNOSTIC_CRITERIA.keys()
-            )
-            if score >= 80:
-                patho = patho_match
-                diagnostic_criteria = DIAGNOSTIC_CRITERIA.get(patho, None)
-            else:
-                # If not, let GPT write it for us
-                diagnostic_criteria = write_diagnostic_criteria(
-                    diagnosis, diag_crit_writer
+                return result
+
+            # Concurrently processed patients share the file of diagnostic criteria
+            with diagnostic_criteria_lock:
+                DIAGNOSTIC_CRITERIA = read_dict(args.diagnostic_criteria_path)
+                # Check if we have the diagnostic criteria for this pathology
+                patho_match, score = process.extractOne(
+                    diagnosis, DIAGNOSTIC_CRITERIA.keys()
                 )
-                DIAGNOSTIC_CRITERIA[diagnosis] = diagnostic_criteria
-                write_dict(args.diagnostic_criteria_path, DIAGNOSTIC_CRITERIA)
+                if score >= 80:
+                    patho = patho_match
+                    diagnostic_criteria = DIAGNOSTIC_CRITERIA.get(patho, None)
+                else:
+                    # If not, let GPT write it for us
+                    diagnostic_criteria = write_diagnostic_criteria(
+                        diagnosis, diag_crit_writer
+                    )
+                    DIAGNOSTIC_CRITERIA[diagnosis] = diagnostic_criteria
+                    write_dict(args.diagnostic_criteria_path, DIAGNOSTIC_CRITERIA)
 
             prompt_confirm = PromptTemplate(
                 template=CONFIRM_DIAG_TEMPLATE,
@@ -481,12 +539,47 @@ def run(args: DictConfig):
             )
 
         if args.save_probabilities:
-            append_to_pickle_file(
-                results_log_path,
-                {_id: {"Diagnosis": result, "Probabilities": llm.probabilities}},
-            )
-        else:
-            append_to_pickle_file(results_log_path, {_id: result})
+            return {"Diagnosis": result, "Probabilities": llm.probabilities}
+        return result
+
+    def predict(_id):
+        patient = prepare(_id)
+        result = chain.predict(**chain_inputs(patient), stop=STOP_WORDS)
+        return finish(patient, result)
+
+    def predict_batch(ids):
+        patients = [prepare(_id) for _id in ids]
+        outputs, probabilities = llm.generate_batch(
+            [prompt.format(**chain_inputs(patient)) for patient in patients],
+            STOP_WORDS,
+        )
+        results = []
+        for _id, patient, output, output_probabilities in zip(
+            ids, patients, outputs, probabilities
+        ):
+            logger.info(f"Generated for patient {_id}: {output}")
+            llm.probabilities = output_probabilities
+            results.append(finish(patient, output))
+        return results
+
+    if args.batch_size > 1:
+        run_patient_batches(
+            hadm_ids,
+            predict_batch,
+            results_log.append,
+            batch_size=args.batch_size,
+        )
+    else:
+        run_patients(
+            hadm_ids,
+            predict,
+            results_log.append,
+            concurrency=args.concurrency,
+        )
+
+    logger.info(f"Generation latency: {llm.latency_tracker.stats()}")
+    if summary_cache is not None:
+        logger.info(f"Summary cache: {summary_cache.stats()}")
 
 
 def write_diagnostic_criteria(pathology, diag_crit_writer):
@@ -547,7 +640,7 @@ def add_physical_examination(input, hadm, abbreviated=True):
     return input
 
 
-def add_laboratory_tests(input, hadm, evaluator, lab_test_mapping_df, args):
+def add_laboratory_tests(input, hadm, evaluator, lab_test_mapping, args):
     input += "\n\n@@@ LABORATORY RESULTS @@@\n"
     # input += "\n\nLABORATORY RESULTS\n"
     if args.include_ref_range:
@@ -569,7 +662,7 @@ def add_laboratory_tests(input, hadm, evaluator, lab_test_mapping_df, args):
         if test in hadm["Laboratory Tests"].keys():
             input += create_lab_test_string(
                 test,
-                lab_test_mapping_df,
+                lab_test_mapping,
                 hadm,
                 include_ref_range=args.include_ref_range,
                 bin_lab_results=args.bin_lab_results,
@@ -604,6 +697,7 @@ def control_context_length(
     hadm_info_clean,
     diagnostic_criteria,
     summarize,
+    summary_cache=None,
 ):
     global STOP_WORDS
     max_context_length = args.max_context_length
@@ -741,8 +835,8 @@ def control_context_length(
                         and rad["Modality"] not in seen_modalities
                     ):
                         summarize_chain = LLMChain(llm=llm, prompt=summarize_prompt)
-                        summary = summarize_chain.predict(
-                            observation=rad["Report"], stop=STOP_WORDS
+                        summary = summarize_with_cache(
+                            summarize_chain, rad["Report"], STOP_WORDS, summary_cache
                         )
                         rad_reports += f"\n {summary}"
                         seen_modalities.add(rad["Modality"])
@@ -790,9 +884,8 @@ def control_context_length(
                             rad_reports,
                             max_context_length - prompt_tokens_summary - max_new_tokens,
                         )
-                    rad_reports = summarize_chain.predict(
-                        observation=rad_reports,
-                        stop=STOP_WORDS,
+                    rad_reports = summarize_with_cache(
+                        summarize_chain, rad_reports, STOP_WORDS, summary_cache
                     )
                 rad_reports = truncate_text(
                     llm.tokenizer,
@@ -4,6 +4,7 @@ REPO_DIR = Path(__file__).parent
 CDM_DATASET_DIR = REPO_DIR / "cdm-dataset"
 LOGS_DIR = REPO_DIR / "logs"
 LOGS_SOTA_DIR = LOGS_DIR / "SOTA"
+EVALUATION_CACHE_PATH = LOGS_DIR / "evaluation_cache.sqlite"
 
 MODELS = [
     "TheBloke_Llama-2-70B-Chat-GPTQ",
@@ -3,7 +3,12 @@ import pickle
 from unittest.mock import patch
 from typing import Any
 
-from agents.agent import TextSummaryCache, CustomZeroShotAgent
+from agents.agent import (
+    TextSummaryCache,
+    CustomZeroShotAgent,
+    AgentSession,
+    ScratchpadTokenCounter,
+)
 from langchain.schema import AgentAction
 from langchain.chains import LLMChain
 from langchain.llms.fake import FakeListLLM
@@ -75,6 +80,67 @@ class TestAgent(unittest.TestCase):
         self.assertEqual(cache.get_summary(text), summary)
         self.assertEqual(cache.get_summary("This is not a test"), None)
 
+    @patch("agents.agent.calculate_num_tokens")
+    def test_scratchpad_token_counter(self, mock_calculate_num_tokens):
+        # One token per character
+        mock_calculate_num_tokens.side_effect = lambda tokenizer, inputs: sum(
+            len(input) for input in inputs
+        )
+        prompt = PromptTemplate(
+            template="Prompt {input}{agent_scratchpad}",
+            input_variables=["input", "agent_scratchpad"],
+        )
+        counter = ScratchpadTokenCounter()
+
+        self.assertEqual(counter.estimate(None, prompt, "input", ["step 1"]), 18)
+        self.assertEqual(
+            counter.estimate(None, prompt, "input", ["step 1", "step 22"]), 25
+        )
+        self.assertEqual(counter.total_tokens, 25)
+        # Prompt and input and every step are only tokenized once
+        self.assertEqual(
+            [call.args[1] for call in mock_calculate_num_tokens.call_args_list],
+            [["Prompt input"], ["step 1"], ["step 22"]],
+        )
+
+        # A new input starts over
+        self.assertEqual(counter.estimate(None, prompt, "new", ["step 3"]), 16)
+        self.assertEqual(mock_calculate_num_tokens.call_count, 5)
+
+    def test_agent_session_rebinds_patient(self):
+        llm = FakeLLM()
+        llm.load_model(responses=[], tokenizer=None)
+        session = AgentSession(
+            llm=llm,
+            lab_test_mapping_df=self.lab_test_mapping_df,
+            logfile=None,
+            max_context_length=4096,
+            tags=self.tags,
+            include_ref_range=False,
+            bin_lab_results=False,
+            include_tool_use_examples=False,
+            provide_diagnostic_criteria=False,
+            summarize=False,
+            model_stop_words=[],
+        )
+
+        patient_1 = {"Patient History": "Patient 1", "Radiology": []}
+        patient_2 = {"Patient History": "Patient 2", "Radiology": []}
+
+        agent_executor_1 = session.build_agent_executor(patient_1)
+        imaging = [t for t in agent_executor_1.tools if t.name == "Imaging"][0]
+        imaging.already_requested_scans["CT Abdomen"] = 1
+        agent_executor_1.agent.observation_summary_cache.add_summary("a", "b")
+
+        agent_executor_2 = session.build_agent_executor(patient_2)
+        self.assertIs(agent_executor_1, agent_executor_2)
+        for tool in agent_executor_2.tools:
+            self.assertIs(tool.action_results, patient_2)
+        self.assertEqual(imaging.already_requested_scans, {})
+        self.assertIsNone(
+            agent_executor_2.agent.observation_summary_cache.get_summary("a")
+        )
+
     @patch("agents.agent.action_input_pretty_printer")
     def test_summarize_steps(self, mock_pretty_print):
         intermediate_steps = [
@@ -813,7 +879,7 @@ anti-COL: N/A"""
             ),
         ]
 
-        responses = ["Good PE."]
+        responses = ["Good PE.", "Shorter PE."]
         tokenizer = LlamaTokenizer.from_pretrained("models/WizardLM-70B-V1.0-GPTQ")
         fake_llm = FakeLLM()
         fake_llm.load_model(responses=responses, tokenizer=tokenizer)
@@ -845,6 +911,25 @@ Thought:"""
 
         self.assertEqual(summary, expected_output)
 
+        # The summary is cached under the observation before truncation
+        stats = agent.observation_summary_cache.stats()
+        self.assertEqual(agent._summarize_steps(intermediate_steps), expected_output)
+        self.assertEqual(
+            agent.observation_summary_cache.stats(),
+            {"hits": stats["hits"] + 1, "misses": stats["misses"]},
+        )
+
+        # A smaller context length truncates the observation further and does not reuse the summary
+        agent.max_context_length = 400
+        self.assertEqual(
+            agent._summarize_steps(intermediate_steps),
+            expected_output.replace("Good PE.", "Shorter PE."),
+        )
+        self.assertEqual(
+            agent.observation_summary_cache.stats(),
+            {"hits": stats["hits"] + 1, "misses": stats["misses"] + 1},
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,155 @@
+import os
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from dataset.cache import (
+    fingerprint_raw_files,
+    write_frames_to_cache,
+    load_frames_from_cache,
+    FRAME_NAMES,
+)
+from dataset.dataset import load_data
+
+
+def write_dummy_mimic(base_mimic):
+    os.makedirs(join(base_mimic, "hosp"))
+    os.makedirs(join(base_mimic, "note"))
+    tables = {
+        join("hosp", "admissions.csv"): {
+            "subject_id": [10, 20],
+            "hadm_id": [1, 2],
+            "admittime": ["2150-01-01 10:00:00", "2150-02-01 10:00:00"],
+            "dischtime": ["2150-01-05 10:00:00", "2150-02-05 10:00:00"],
+        },
+        join("hosp", "transfers.csv"): {
+            "subject_id": [10, 20],
+            "hadm_id": [1, 2],
+            "intime": ["2150-01-01 10:00:00", "2150-02-01 10:00:00"],
+        },
+        join("hosp", "diagnoses_icd.csv"): {
+            "subject_id": [10, 20],
+            "hadm_id": [1, 2],
+            "icd_code": ["5409", "K3580"],
+            "icd_version": [9, 10],
+        },
+        join("hosp", "d_icd_diagnoses.csv"): {
+            "icd_code": ["5409", "K3580"],
+            "icd_version": [9, 10],
+            "long_title": ["Acute appendicitis", "Other acute appendicitis"],
+        },
+        join("hosp", "procedures_icd.csv"): {
+            "subject_id": [10],
+            "hadm_id": [1],
+            "icd_code": ["4701"],
+            "icd_version": [9],
+        },
+        join("hosp", "d_icd_procedures.csv"): {
+            "icd_code": ["4701"],
+            "icd_version": [9],
+            "long_title": ["Laparoscopic appendectomy"],
+        },
+        join("hosp", "microbiologyevents.csv"): {
+            "subject_id": [10, 20],
+            "hadm_id": [1, np.nan],
+            "charttime": ["2150-01-02 10:00:00", "2150-02-02 10:00:00"],
+            "spec_itemid": [70012, 70012],
+            "test_itemid": [90201, 90201],
+            "org_itemid": [np.nan, 80002],
+            "org_name": [np.nan, "ESCHERICHIA COLI"],
+            "comments": ["No growth.", np.nan],
+        },
+        join("hosp", "labevents.csv"): {
+            "subject_id": [10, 20],
+            "hadm_id": [1, np.nan],
+            "itemid": [50861, 50862],
+            "charttime": ["2150-01-02 10:00:00", "2150-02-02 10:00:00"],
+            "value": ["12", "3.1"],
+            "valuenum": [12, 3.1],
+            "valueuom": ["IU/L", "g/dL"],
+            "ref_range_lower": [0, 3.5],
+            "ref_range_upper": [40, 5.2],
+            "flag": [np.nan, "abnormal"],
+            "comments": [np.nan, np.nan],
+        },
+        join("hosp", "d_labitems.csv"): {
+            "itemid": [50861, 50862],
+            "label": ["Alanine Aminotransferase (ALT)", "Albumin"],
+            "fluid": ["Blood", "Blood"],
+        },
+        join("note", "discharge.csv"): {
+            "note_id": ["10-DS-1", "20-DS-1"],
+            "subject_id": [10, 20],
+            "hadm_id": [1, 2],
+            "charttime": ["2150-01-05 10:00:00", "2150-02-05 10:00:00"],
+            "text": ["History of Present Illness: pain", "Chief Complaint: pain"],
+        },
+        join("note", "radiology.csv"): {
+            "note_id": ["10-RR-1", "20-RR-1"],
+            "subject_id": [10, 20],
+            "hadm_id": [1, 2],
+            "charttime": ["2150-01-02 10:00:00", "2150-02-02 10:00:00"],
+            "text": ["CT abdomen: appendicitis", "US abdomen: normal"],
+        },
+        join("note", "radiology_detail.csv"): {
+            "note_id": ["10-RR-1", "20-RR-1"],
+            "subject_id": [10, 20],
+            "field_name": ["exam_name", "exam_name"],
+            "field_value": ["CT ABD & PELVIS", "US ABD"],
+            "field_ordinal": [1, 1],
+        },
+    }
+    for path, table in tables.items():
+        pd.DataFrame(table).to_csv(join(base_mimic, path), index=False)
+
+
+class TestDatasetCache(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base_mimic = join(self.tmp_dir.name, "mimic")
+        self.cache_dir = join(self.tmp_dir.name, "cache")
+        write_dummy_mimic(self.base_mimic)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cache_roundtrip(self):
+        frames = load_data(self.base_mimic)
+        key = fingerprint_raw_files(self.base_mimic)
+        self.assertIsNone(load_frames_from_cache(self.cache_dir, key))
+
+        write_frames_to_cache(frames, self.cache_dir, key)
+        cached_frames = load_frames_from_cache(self.cache_dir, key)
+        self.assertEqual(len(cached_frames), len(FRAME_NAMES))
+        for df, cached_df in zip(frames, cached_frames):
+            pd.testing.assert_frame_equal(df, cached_df)
+
+    def test_load_data_uses_cache(self):
+        frames = load_data(self.base_mimic, cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        cached_frames = load_data(self.base_mimic, cache_dir=self.cache_dir)
+        for df, cached_df in zip(frames, cached_frames):
+            pd.testing.assert_frame_equal(df, cached_df)
+
+    def test_fingerprint_changes_with_raw_files(self):
+        key = fingerprint_raw_files(self.base_mimic)
+        self.assertEqual(key, fingerprint_raw_files(self.base_mimic))
+        self.assertNotEqual(key, fingerprint_raw_files(self.base_mimic, [1]))
+        self.assertEqual(
+            fingerprint_raw_files(self.base_mimic, [2, 1]),
+            fingerprint_raw_files(self.base_mimic, [1, 2, 2]),
+        )
+
+        lab_events_path = join(self.base_mimic, "hosp", "labevents.csv")
+        stat = os.stat(lab_events_path)
+        os.utime(lab_events_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertNotEqual(key, fingerprint_raw_files(self.base_mimic))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,28 @@
+import os
+import tempfile
 import unittest
+
+import numpy as np
+import pandas as pd
+
 from dataset.discharge import extract_diagnosis_from_discharge
+from dataset.utils import group_rows_by_hadm_id, select_hadm_rows, map_hadm_ids
+from dataset.labs import (
+    parse_lab_events,
+    parse_lab_events_grouped,
+    parse_microbio,
+    parse_microbio_grouped,
+)
+from dataset.dataset import (
+    fill_nan_hadm,
+    fill_nan_hadm_iterative,
+    read_csv_chunked,
+    LAB_EVENTS_DTYPES,
+    create_valuestr_lab,
+    create_valuestr_lab_vectorized,
+    create_valuestr_microbio,
+    create_valuestr_microbio_vectorized,
+)
 
 
 class TestDataset(unittest.TestCase):
@@ -144,6 +167,266 @@ Acute Pancreatitis
 Gastroesophageal Reflux Disease"""
         self.assertEqual(output, expected)
 
+    def create_fill_nan_hadm_inputs(self):
+        transfers_df = pd.DataFrame(
+            {
+                "hadm_id": [1, 1, 2, 3, 3],
+                "intime": pd.to_datetime(
+                    [
+                        "2150-01-05",
+                        "2150-01-02",
+                        "2150-01-04",
+                        "2150-03-01",
+                        "2150-03-03",
+                    ]
+                ),
+            }
+        )
+        # Subject 10 has two overlapping admissions, subject 30 has no disease admission
+        hadm_to_subject_id = {1: 10, 2: 10, 3: 20}
+        events_df = pd.DataFrame(
+            {
+                "subject_id": [10, 10, 10, 10, 10, 20, 20, 20, 30],
+                "hadm_id": [np.nan, np.nan, np.nan, 5, np.nan, np.nan, np.nan, np.nan, np.nan],
+                "charttime": pd.to_datetime(
+                    [
+                        "2150-01-01 00:00",
+                        "2150-01-03 12:00",
+                        "2150-01-04 00:00",
+                        "2150-01-04 00:00",
+                        "2150-01-06 00:00",
+                        "2150-02-28 00:00",
+                        "2150-03-03 00:00",
+                        None,
+                        "2150-01-03 00:00",
+                    ]
+                ),
+            }
+        )
+        return events_df, transfers_df, hadm_to_subject_id
+
+    def test_fill_nan_hadm(self):
+        events_df, transfers_df, hadm_to_subject_id = self.create_fill_nan_hadm_inputs()
+        lab_events_df, radiology_df, microbiology_df = fill_nan_hadm(
+            events_df.copy(),
+            events_df.copy(),
+            events_df.copy(),
+            [2, 1, 3],
+            transfers_df,
+            hadm_to_subject_id,
+        )
+        expected = [1, 2, 2, 5, np.nan, 3, 3, np.nan, np.nan]
+        for df in [lab_events_df, radiology_df, microbiology_df]:
+            np.testing.assert_array_equal(df["hadm_id"].to_numpy(), expected)
+
+    def test_fill_nan_hadm_matches_iterative(self):
+        events_df, transfers_df, hadm_to_subject_id = self.create_fill_nan_hadm_inputs()
+        for disease_ids in [[1, 2, 3], [2, 1, 3], [3]]:
+            vectorized = fill_nan_hadm(
+                events_df.copy(),
+                events_df.copy(),
+                events_df.copy(),
+                disease_ids,
+                transfers_df,
+                hadm_to_subject_id,
+            )
+            iterative = fill_nan_hadm_iterative(
+                events_df.copy(),
+                events_df.copy(),
+                events_df.copy(),
+                disease_ids,
+                transfers_df,
+                hadm_to_subject_id,
+            )
+            for vectorized_df, iterative_df in zip(vectorized, iterative):
+                pd.testing.assert_frame_equal(vectorized_df, iterative_df)
+
+    def test_read_csv_chunked(self):
+        lab_events_df = pd.DataFrame(
+            {
+                "labevent_id": range(7),
+                "subject_id": [10, 20, 10, 30, 10, 20, 10],
+                "hadm_id": [1, np.nan, 1, 3, np.nan, 2, 1],
+                "specimen_id": range(7),
+                "itemid": [50861, 50862, 50863, 50861, 50862, 50863, 50861],
+                "charttime": [
+                    "2150-01-01 00:00:00",
+                    "2150-01-02 00:00:00",
+                    "2150-01-03 00:00:00",
+                    "2150-01-04 00:00:00",
+                    "2150-01-05 00:00:00",
+                    "2150-01-06 00:00:00",
+                    "2150-01-07 00:00:00",
+                ],
+                "value": ["1", "2", "___", "4", "5", "6", "7"],
+                "valuenum": [1, 2, np.nan, 4, 5, 6, 7],
+                "valueuom": ["IU/L", "g/dL", np.nan, "IU/L", "mg/dL", "g/dL", "mg/dL"],
+                "ref_range_lower": [0, 1, 2, 3, 4, 5, 6],
+                "ref_range_upper": [10, 11, 12, 13, 14, 15, 16],
+                "flag": [np.nan, "abnormal", np.nan, np.nan, "abnormal", np.nan, np.nan],
+                "priority": ["ROUTINE"] * 7,
+                "comments": [np.nan, np.nan, "comment", np.nan, np.nan, np.nan, np.nan],
+            }
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "labevents.csv")
+            lab_events_df.to_csv(path, index=False)
+
+            df = read_csv_chunked(
+                path,
+                LAB_EVENTS_DTYPES,
+                subject_ids=[10, 20],
+                chunk_filter=lambda chunk: chunk[chunk["itemid"] != 50863],
+                parse_dates=["charttime"],
+                chunksize=2,
+            )
+            full_df = read_csv_chunked(path, LAB_EVENTS_DTYPES, chunksize=100)
+
+        expected = lab_events_df[
+            lab_events_df["subject_id"].isin([10, 20])
+            & (lab_events_df["itemid"] != 50863)
+        ]
+        self.assertEqual(set(df.columns), set(LAB_EVENTS_DTYPES))
+        self.assertNotIn("labevent_id", df.columns)
+        self.assertEqual(df["itemid"].tolist(), expected["itemid"].tolist())
+        self.assertEqual(df["subject_id"].dtype, np.int64)
+        self.assertEqual(df["hadm_id"].dtype, np.float64)
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(df["charttime"]))
+        self.assertIsInstance(df["valueuom"].dtype, pd.CategoricalDtype)
+        self.assertEqual(
+            df["valueuom"].astype(object).tolist(), expected["valueuom"].tolist()
+        )
+        self.assertEqual(
+            df["flag"].astype(object).fillna("").tolist(),
+            expected["flag"].fillna("").tolist(),
+        )
+        self.assertEqual(len(full_df), len(lab_events_df))
+
+    def create_lab_events_sample(self, n=2000):
+        rng = np.random.default_rng(0)
+        valuenum = rng.choice(
+            [np.nan, 0.0, 1.0, 0.1, 12.5, -3.25, 1e-05, 1e16, 123456.789], size=n
+        )
+        value = rng.choice([np.nan, "___", "POS", "<0.5", "12", "  text "], size=n)
+        valueuom = rng.choice([np.nan, "mg/dL", "IU/L", "%", ""], size=n)
+        flag = rng.choice([np.nan, "abnormal"], size=n)
+        comments = rng.choice([np.nan, "___", "Hemolyzed.", "See note"], size=n)
+        lab_events_df = pd.DataFrame(
+            {
+                "valuenum": valuenum.astype(float),
+                "value": pd.Series(value, dtype=object).replace("nan", np.nan),
+                "valueuom": pd.Series(valueuom, dtype=object).replace("nan", np.nan),
+                "flag": pd.Series(flag, dtype=object).replace("nan", np.nan),
+                "comments": pd.Series(comments, dtype=object).replace("nan", np.nan),
+            },
+            index=rng.permutation(n),
+        )
+        return lab_events_df
+
+    def test_create_valuestr_lab_vectorized(self):
+        lab_events_df = self.create_lab_events_sample()
+        expected = lab_events_df.apply(create_valuestr_lab, axis=1)
+        pd.testing.assert_series_equal(
+            create_valuestr_lab_vectorized(lab_events_df), expected
+        )
+
+        # Loader dtypes
+        lab_events_df["valueuom"] = lab_events_df["valueuom"].astype("category")
+        lab_events_df["flag"] = lab_events_df["flag"].astype("category")
+        pd.testing.assert_series_equal(
+            create_valuestr_lab_vectorized(lab_events_df), expected
+        )
+
+    def test_create_valuestr_microbio_vectorized(self):
+        rng = np.random.default_rng(0)
+        org_name = rng.choice([np.nan, "E. COLI", "STAPH AUREUS"], size=500)
+        comments = rng.choice([np.nan, "No growth.", "___"], size=500)
+        microbiology_df = pd.DataFrame(
+            {
+                "org_name": pd.Series(org_name, dtype=object).replace("nan", np.nan),
+                "comments": pd.Series(comments, dtype=object).replace("nan", np.nan),
+            }
+        )
+        expected = microbiology_df.apply(create_valuestr_microbio, axis=1)
+        pd.testing.assert_series_equal(
+            create_valuestr_microbio_vectorized(microbiology_df), expected
+        )
+
+    def test_select_hadm_rows(self):
+        df = pd.DataFrame(
+            {
+                "hadm_id": [2, np.nan, 1, 2, 3, 1, np.nan, 2],
+                "value": ["a", "b", "c", "d", "e", "f", "g", "h"],
+            },
+            index=[0, 0, 1, 1, 2, 2, 3, 3],
+        )
+        groups = group_rows_by_hadm_id(df)
+        for _id in [1, 2, 3, 4, np.int64(2), 2.0]:
+            pd.testing.assert_frame_equal(
+                select_hadm_rows(df, groups, _id), df[df["hadm_id"] == _id]
+            )
+
+    def create_events_sample(self, n=5000, n_hadm_ids=100):
+        rng = np.random.default_rng(0)
+        hadm_id = rng.choice(np.r_[np.arange(n_hadm_ids), np.nan], size=n)
+        # Coarse charttimes so that many tests share a charttime
+        charttime = pd.Timestamp("2150-01-01") + pd.to_timedelta(
+            rng.integers(0, 5, n), "h"
+        )
+        charttime = charttime.where(rng.random(n) > 0.05, pd.NaT)
+        lab_events_df = pd.DataFrame(
+            {
+                "hadm_id": hadm_id,
+                "itemid": rng.integers(50800, 50815, n),
+                "charttime": charttime,
+                "valuestr": rng.integers(0, 100, n).astype(str),
+                "ref_range_lower": rng.choice([np.nan, 1.0, 2.0], size=n),
+                "ref_range_upper": rng.choice([np.nan, 5.0], size=n),
+            }
+        )
+        microbiology_df = pd.DataFrame(
+            {
+                "hadm_id": hadm_id,
+                "test_itemid": rng.integers(90000, 90006, n),
+                "charttime": charttime,
+                "spec_itemid": rng.integers(70000, 70003, n),
+                "org_itemid": rng.choice([np.nan, 80002.0, 80004.0], size=n),
+                "valuestr": rng.choice(["E. COLI", "STAPH", "CANDIDA", "neg"], size=n),
+            }
+        )
+        return lab_events_df, microbiology_df, list(range(n_hadm_ids + 5))
+
+    def test_parse_lab_events_grouped(self):
+        lab_events_df, _, hadm_ids = self.create_events_sample()
+        lab_results = parse_lab_events_grouped(lab_events_df, hadm_ids)
+        for _id in hadm_ids:
+            expected = parse_lab_events(lab_events_df, _id)
+            result = lab_results.get(_id, ({}, {}, {}))
+            # repr also compares the order of the tests and treats NaN as equal
+            self.assertEqual(repr(result), repr(expected))
+
+    def test_parse_microbio_grouped(self):
+        _, microbiology_df, hadm_ids = self.create_events_sample()
+        microbio_results = parse_microbio_grouped(microbiology_df, hadm_ids)
+        for _id in hadm_ids:
+            expected = parse_microbio(microbiology_df, _id)
+            result = microbio_results.get(_id, ({}, {}))
+            self.assertEqual(repr(result), repr(expected))
+
+    def test_map_hadm_ids(self):
+        texts = {_id: "History of Present Illness: {}".format(_id) for _id in range(50)}
+        hadm_ids = list(reversed(range(50)))
+
+        def task(_id):
+            return texts[_id].upper()
+
+        serial = map_hadm_ids(task, hadm_ids)
+        parallel = map_hadm_ids(task, hadm_ids, num_workers=3)
+        self.assertEqual(list(serial.items()), list(parallel.items()))
+        self.assertEqual(list(parallel), hadm_ids)
+        self.assertEqual(parallel[7], "HISTORY OF PRESENT ILLNESS: 7")
+        self.assertEqual(map_hadm_ids(task, [], num_workers=3), {})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,70 @@
+import tempfile
+import unittest
+from os.path import join
+from unittest.mock import patch
+
+from agents.AgentAction import AgentAction
+from evaluate.cache import EvaluationCache, evaluator_version, trajectory_hash
+
+
+class FakeEvaluator:
+    pass
+
+
+class TestEvaluationCache(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = join(self.tmp_dir.name, "evaluation_cache.sqlite")
+        self.kwargs = dict(
+            prediction="Final Diagnosis: Acute appendicitis",
+            input="",
+            reference=("Acute appendicitis", [], [], [], []),
+            agent_trajectory=[
+                (
+                    AgentAction(
+                        tool="Laboratory Tests",
+                        tool_input={"action_input": [51301]},
+                        log="",
+                        custom_parsings=0,
+                    ),
+                    "White Blood Cells: 15.0 K/uL",
+                )
+            ],
+        )
+        self.evaluation = {"scores": {"Diagnosis": 1}, "answers": {"Diagnosis": ""}}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cached_evaluation(self):
+        cache = EvaluationCache(self.cache_path)
+        key = cache.key(FakeEvaluator, 101, self.kwargs)
+        self.assertIsNone(cache.get(key))
+        cache.add(key, self.evaluation)
+
+        # Shared between evaluation runs
+        cache = EvaluationCache(self.cache_path)
+        key = cache.key(FakeEvaluator, 101, dict(self.kwargs))
+        self.assertEqual(cache.get(key), self.evaluation)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 0})
+
+    def test_changed_trajectory(self):
+        cache = EvaluationCache(self.cache_path)
+        cache.add(cache.key(FakeEvaluator, 101, self.kwargs), self.evaluation)
+
+        changed_kwargs = dict(self.kwargs, prediction="Final Diagnosis: Colitis")
+        self.assertNotEqual(trajectory_hash(changed_kwargs), trajectory_hash(self.kwargs))
+        self.assertIsNone(cache.get(cache.key(FakeEvaluator, 101, changed_kwargs)))
+        self.assertIsNone(cache.get(cache.key(FakeEvaluator, 102, self.kwargs)))
+
+    def test_nlp_upgrade_changes_version(self):
+        nlp_version = "evaluate.cache.nlp_version"
+        with patch(nlp_version, return_value="en_core_sci_lg 0.5.3 negspacy 1.0.4"):
+            version = evaluator_version(FakeEvaluator)
+        with patch(nlp_version, return_value="en_core_sci_lg 0.5.4 negspacy 1.0.4"):
+            self.assertNotEqual(evaluator_version(FakeEvaluator), version)
+
+
+if __name__ == "__main__":
+    unittest.main()
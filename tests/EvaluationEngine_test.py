@@ -0,0 +1,85 @@
+import tempfile
+import unittest
+from os.path import join
+
+from evaluate.cache import EvaluationCache
+from evaluate.engine import (
+    TASKS,
+    evaluate_jobs,
+    fi_job,
+    find_results_file,
+    score_model,
+)
+
+
+class TestEvaluationEngine(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        hadm = {
+            "Discharge Diagnosis": "Acute appendicitis",
+            "ICD Diagnosis": ["Acute appendicitis without mention of peritonitis"],
+            "Procedures ICD9": [],
+            "Procedures ICD10": [],
+            "Procedures Discharge": [],
+        }
+        predictions = [
+            "Acute appendicitis",
+            "Acute cholecystitis",
+            "Perforated appendicitis",
+            "Diverticulitis",
+        ] * 3
+        self.jobs = [
+            fi_job("model", "appendicitis", _id, prediction, hadm)
+            for _id, prediction in enumerate(predictions)
+        ]
+
+    def test_parallel_equals_serial(self):
+        serial_evals = evaluate_jobs(self.jobs, num_workers=1)
+        parallel_evals = evaluate_jobs(self.jobs, num_workers=2, chunk_size=2)
+        self.assertEqual(parallel_evals, serial_evals)
+        self.assertEqual(
+            [eval["scores"]["Diagnosis"] for eval in serial_evals],
+            [1, 0, 1, 0] * 3,
+        )
+
+    def test_evaluation_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            evaluation_cache = EvaluationCache(join(tmp_dir, "evaluation_cache.sqlite"))
+            evals = evaluate_jobs(self.jobs, evaluation_cache=evaluation_cache)
+            self.assertEqual(evaluation_cache.stats(), {"hits": 0, "misses": 12})
+
+            self.jobs[0].evaluation_kwargs["prediction"] = "Final Diagnosis: Colitis"
+            cached_evals = evaluate_jobs(self.jobs, evaluation_cache=evaluation_cache)
+            self.assertEqual(evaluation_cache.stats(), {"hits": 11, "misses": 13})
+            self.assertEqual(cached_evals[1:], evals[1:])
+            self.assertEqual(cached_evals[0]["scores"]["Diagnosis"], 0)
+
+    def test_find_results_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pattern = join(tmp_dir, "appendicitis" + TASKS["cdm"]["run"].format(model="model"))
+            run = join(tmp_dir, "appendicitis_ZeroShot_model_run")
+            for suffix in ["_results.pkl", "_results.rlog.tmp"]:
+                open(run + suffix, "w").close()
+            # An interrupted conversion leaves the pickle to be read
+            self.assertEqual(find_results_file(pattern), run + "_results.pkl")
+
+            open(run + "_results.rlog", "w").close()
+            self.assertEqual(find_results_file(pattern), run + "_results.rlog")
+
+    def test_saved_difficulties(self):
+        self.assertEqual(TASKS["cdm"]["saved_difficulties"], ["first_diag"])
+        self.assertEqual(TASKS["fi"]["saved_difficulties"], ["first_diag", "dr_eval"])
+
+    def test_score_model(self):
+        evals = evaluate_jobs(self.jobs, num_workers=2, chunk_size=2)
+        all_evals = {
+            "appendicitis": {job.hadm_id: eval for job, eval in zip(self.jobs, evals)}
+        }
+        scores = score_model(
+            all_evals, ["Diagnosis"], ["appendicitis"], count_unnecessary_fields=False
+        )
+        self.assertEqual(scores, {"Diagnosis": {"appendicitis": 0.5}})
+
+
+if __name__ == "__main__":
+    unittest.main()
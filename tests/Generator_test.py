@@ -0,0 +1,209 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import torch
+
+from models.exllamav2_generator_base_custom import ExLlamaV2BaseGenerator
+
+VOCAB_SIZE = 10
+STOP_TOKEN = 7
+
+
+class TinyCache:
+    # Same layout as ExLlamaV2Cache, one layer that stores the token ids themselves
+    def __init__(self, batch_size, max_seq_len):
+        self.batch_size = batch_size
+        self.current_seq_len = 0
+        self.key_states = [torch.zeros((batch_size, max_seq_len, 1, 1))]
+        self.value_states = [torch.zeros((batch_size, max_seq_len, 1, 1))]
+
+
+class TinyModel:
+    """Predicts the sum of all ids of a row seen so far modulo the vocabulary size. Padding ids are 0"""
+
+    def __init__(self, max_seq_len=64):
+        self.config = SimpleNamespace(max_seq_len=max_seq_len)
+        self.forward_batch_sizes = []
+
+    def forward(self, input_ids, cache, input_mask=None, preprocess_only=False, loras=None):
+        bsz, q_len = input_ids.shape
+        start = cache.current_seq_len
+        cache.key_states[0][:bsz, start : start + q_len, 0, 0] = input_ids.float()
+        cache.current_seq_len += q_len
+        if preprocess_only:
+            return None
+        self.forward_batch_sizes.append(bsz)
+        sums = cache.key_states[0][:bsz, : cache.current_seq_len, 0, 0].sum(dim=-1)
+        next_ids = sums.long() % VOCAB_SIZE
+        return torch.nn.functional.one_hot(next_ids, VOCAB_SIZE).float().unsqueeze(1)
+
+
+class TinyTokenizer:
+    # Prompts are space separated ids
+    pad_token_id = 0
+
+    def encode(self, text, encode_special_tokens=False):
+        if isinstance(text, str):
+            return torch.tensor([[int(i) for i in text.split()]])
+        ids = [[int(i) for i in t.split()] for t in text]
+        max_length = max(len(i) for i in ids)
+        return torch.tensor([[0] * (max_length - len(i)) + i for i in ids])
+
+    def padding_mask(self, ids):
+        return (ids == self.pad_token_id).int().half() * -65504
+
+
+def greedy_sample(logits, settings, sequence_ids, random, tokenizer, prefix_token=None):
+    probabilities = torch.softmax(logits[:, 0], dim=-1)
+    token = probabilities.argmax(dim=-1, keepdim=True)
+    return token, probabilities.gather(-1, token), False
+
+
+def stop_at_token(input_ids, scores):
+    return input_ids[0, -1].item() == STOP_TOKEN
+
+
+class TestGenerator(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.model = TinyModel()
+        self.generator = ExLlamaV2BaseGenerator(
+            self.model, TinyCache(4, 64), TinyTokenizer()
+        )
+        # Sampled on the host with greedy_sample
+        self.settings = self.make_settings(top_k=0)
+
+    @staticmethod
+    def make_settings(**kwargs):
+        # Fields of ExLlamaV2Sampler.Settings that the generator reads
+        settings = dict(
+            top_k=1,
+            temperature=0.9,
+            token_repetition_penalty=1.0,
+            token_repetition_range=-1,
+            token_repetition_decay=0,
+            token_bias=None,
+            mirostat=False,
+            filters=[],
+            begin_filters=lambda prefix: None,
+            feed_filters=lambda token: None,
+        )
+        settings.update(kwargs)
+        return SimpleNamespace(**settings)
+
+    def generate(self, prompts, num_tokens=12, stop_criteria=stop_at_token):
+        with patch(
+            "models.exllamav2_generator_base_custom.ExLlamaV2Sampler.sample",
+            greedy_sample,
+        ):
+            return self.generator.generate_batch(
+                prompts,
+                self.settings,
+                num_tokens,
+                stop_criteria=stop_criteria,
+            )
+
+    def test_batch_equals_single_prompts(self):
+        # "5 1 1" finishes first and is retired while the other rows keep generating
+        prompts = ["5 1 1", "1 2", "3", "2 2 1 1"]
+        batch_ids, batch_probabilities = self.generate(prompts)
+
+        for prompt, ids, probabilities in zip(prompts, batch_ids, batch_probabilities):
+            single_ids, single_probabilities = self.generate([prompt])
+            self.assertEqual(ids.tolist(), single_ids[0].tolist())
+            self.assertEqual(probabilities.shape, single_probabilities[0].shape)
+        # Prompts keep their ids without padding
+        self.assertEqual(batch_ids[0].tolist(), [[5, 1, 1, 7]])
+        self.assertEqual(
+            batch_ids[1].tolist(), [[1, 2, 3, 6, 2, 4, 8, 6, 2, 4, 8, 6, 2, 4]]
+        )
+
+    def test_rows_generate_their_own_number_of_tokens(self):
+        # Every prompt fills a context of 16 tokens, as when generated alone. Padding needs room in the cache
+        prompts = ["5 1 1", "1 2", "3", "2 2 1 1 4 4"]
+        num_tokens = [16 - len(prompt.split()) for prompt in prompts]
+        never_stop = lambda input_ids, scores: False
+        batch_ids, batch_probabilities = self.generate(
+            prompts, num_tokens, stop_criteria=never_stop
+        )
+
+        for prompt, tokens, ids, probabilities in zip(
+            prompts, num_tokens, batch_ids, batch_probabilities
+        ):
+            single_ids, _ = self.generate([prompt], tokens, stop_criteria=never_stop)
+            self.assertEqual(ids.tolist(), single_ids[0].tolist())
+            self.assertEqual(ids.shape, (1, 16))
+            self.assertEqual(probabilities.shape, (1, tokens))
+
+    def test_prompt_longer_than_context(self):
+        # A context of 4 tokens leaves none to generate for a prompt of 6 tokens, the prompt is returned unchanged
+        ids, probabilities = self.generate(["1 2", "2 2 1 1 4 4"], num_tokens=[2, -2])
+        self.assertEqual(ids[0].tolist(), [[1, 2, 3, 6]])
+        self.assertEqual(ids[1].tolist(), [[2, 2, 1, 1, 4, 4]])
+        self.assertEqual(probabilities[1].shape, (1, 0))
+
+        ids, probabilities = self.generate(["2 2 1 1 4 4"], num_tokens=-2)
+        self.assertEqual(ids[0].tolist(), [[2, 2, 1, 1, 4, 4]])
+        self.assertEqual(probabilities[0].shape, (1, 0))
+        self.assertEqual(self.model.forward_batch_sizes, [2, 1])
+
+    def test_finished_rows_are_retired(self):
+        # "1 2 4" stops after its first token 7, "3" runs for all tokens
+        ids, probabilities = self.generate(["1 2 4", "3"], num_tokens=6)
+        self.assertEqual(ids[0].tolist(), [[1, 2, 4, 7]])
+        self.assertEqual(probabilities[0].shape, (1, 1))
+        self.assertEqual(ids[1].shape, (1, 7))
+        self.assertEqual(self.model.forward_batch_sizes, [2, 1, 1, 1, 1, 1])
+
+    def test_greedy_on_device_matches_sampler(self):
+        # Reference of the greedy sampling of the exllamav2 extension: every token in the sequence is penalized once,
+        # the first maximum from token 1 on is sampled
+        def reference_sample(logits, settings, sequence_ids, random, tokenizer, prefix_token=None):
+            tokens, probabilities = [], []
+            for row_logits, row_ids in zip(logits[:, 0].tolist(), sequence_ids.tolist()):
+                penalty = settings.token_repetition_penalty
+                for i in set(row_ids):
+                    logit = row_logits[i]
+                    row_logits[i] = logit / penalty if logit > 0 else logit * penalty
+                token = max(range(1, VOCAB_SIZE), key=lambda i: (row_logits[i], -i))
+                row_probabilities = torch.softmax(
+                    torch.tensor(row_logits) / settings.temperature, dim=-1
+                )
+                tokens.append([token])
+                probabilities.append([row_probabilities[token].item()])
+            return torch.tensor(tokens), torch.tensor(probabilities), False
+
+        def noisy_forward(*args, **kwargs):
+            logits = forward(*args, **kwargs)
+            if logits is not None:
+                # Ties and negative logits exercise the penalty and the first maximum. The padding token 0 often has
+                # the largest logit but is never sampled
+                logits = logits * 3 - torch.arange(VOCAB_SIZE).remainder(3).float()
+                logits[..., 0] += 2.5
+            return logits
+
+        prompts = ["5 1 1", "1 2", "3", "2 2 1 1"]
+        forward = self.model.forward
+        self.model.forward = noisy_forward
+        self.settings = self.make_settings(token_repetition_penalty=1.15)
+        self.assertTrue(self.generator._greedy_on_device(self.settings))
+        device_ids, device_probabilities = self.generator.generate_batch(
+            prompts, self.settings, 12, stop_criteria=stop_at_token
+        )
+        with patch(
+            "models.exllamav2_generator_base_custom.ExLlamaV2Sampler.sample",
+            reference_sample,
+        ), patch.object(self.generator, "_greedy_on_device", return_value=False):
+            host_ids, host_probabilities = self.generator.generate_batch(
+                prompts, self.settings, 12, stop_criteria=stop_at_token
+            )
+
+        for device, host in zip(device_ids, host_ids):
+            self.assertEqual(device.tolist(), host.tolist())
+        for device, host in zip(device_probabilities, host_probabilities):
+            self.assertTrue(torch.allclose(device, host))
+
+
+if __name__ == "__main__":
+    unittest.main()
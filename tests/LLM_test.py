@@ -1,8 +1,16 @@
+import gc
+import random
 import unittest
+import weakref
 
+import torch
 from transformers import LlamaTokenizer
 
-from models.utils import create_stop_criteria
+from models.utils import (
+    create_stop_criteria,
+    create_stop_criteria_exllama,
+    get_stop_matcher,
+)
 from agents.agent import STOP_WORDS
 
 
@@ -140,5 +148,144 @@ class TestLLM(unittest.TestCase):
         self.assertTrue(self.stop_criteria(generated_ids, None))
 
 
+class PieceTokenizer:
+    # Pieces like the ones of ExLlamaV2Tokenizer.get_id_to_piece_list
+    pieces = [
+        " ⁇ ",
+        "",
+        " This",
+        " is",
+        " sentence",
+        ".",
+        "Obs",
+        "erv",
+        "ation",
+        ":",
+        "Observation",
+        ":\n",
+        "\n",
+        " observ",
+        "ations",
+        "s",
+        " Observ",
+        "O",
+        "atio",
+        "bserv",
+    ]
+    eos_token_id = 1
+
+    def get_id_to_piece_list(self):
+        return self.pieces
+
+
+class TestStopMatcher(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.tokenizer = PieceTokenizer()
+
+    def create_stop_criteria(self):
+        return create_stop_criteria_exllama(
+            STOP_WORDS, self.tokenizer.eos_token_id, self.tokenizer
+        )
+
+    def ids(self, *pieces):
+        return torch.tensor([[self.tokenizer.pieces.index(p) for p in pieces]])
+
+    def generate(self, prompt, generated):
+        # Calls the criteria after every generated token like the generation loop
+        stop_criteria = self.create_stop_criteria()
+        input_ids = self.ids(*prompt)
+        stops = []
+        for piece in generated:
+            input_ids = torch.cat([input_ids, self.ids(piece)], dim=1)
+            stops.append(stop_criteria(input_ids, None))
+        return stops
+
+    def test_stop_word_split_across_tokens(self):
+        stops = self.generate([" This", " is"], [".", "Obs", "erv", "ation", ":"])
+        self.assertEqual(stops, [False, False, False, False, True])
+
+    def test_stop_word_ends_within_token(self):
+        stops = self.generate([" This"], [".", "Observation", ":\n", " is"])
+        self.assertEqual(stops, [False, False, True, True])
+
+    def test_stop_word_lower_case_plural(self):
+        stops = self.generate(["\n"], [" observ", "ations", ":"])
+        self.assertEqual(stops, [False, False, True])
+
+    def test_stop_word_starts_within_partial_match(self):
+        # "o" at the end of "observatio" starts the stop word
+        stops = self.generate(["\n"], [" observ", "atio", "bserv", "ation", ":"])
+        self.assertEqual(stops, [False, False, False, False, True])
+
+    def test_no_colon(self):
+        stops = self.generate([" This"], [".", "Observation", "\n", "O", "s"])
+        self.assertEqual(stops, [False] * 5)
+
+    def test_stop_word_in_prompt(self):
+        stops = self.generate(["Observation", ":"], [" This", " is"])
+        self.assertEqual(stops, [False, False])
+
+    def test_stop_token(self):
+        stops = self.generate([" This"], [" is", ""])
+        self.assertEqual(stops, [False, True])
+
+    def test_first_call_matches_tail(self):
+        stop_criteria = self.create_stop_criteria()
+        self.assertTrue(
+            stop_criteria(self.ids(" This", ".", " Observ", "ation", ":"), None)
+        )
+
+    def test_batched_rows(self):
+        stop_criteria = self.create_stop_criteria()
+        input_ids = torch.cat(
+            [self.ids(" This", "Obs", "erv"), self.ids(" is", "Obs", " is")]
+        )
+        self.assertEqual(stop_criteria.rows_stopped(input_ids), [False, False])
+        input_ids = torch.cat([input_ids, torch.tensor([[8], [8]])], dim=1)
+        self.assertEqual(stop_criteria.rows_stopped(input_ids), [False, False])
+        self.assertFalse(stop_criteria(input_ids, None))
+        input_ids = torch.cat([input_ids, torch.tensor([[9], [9]])], dim=1)
+        self.assertEqual(stop_criteria.rows_stopped(input_ids), [True, False])
+        self.assertFalse(stop_criteria(input_ids, None))
+
+    def test_incremental_equals_text_search(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            prompt = [rng.randrange(2, len(self.tokenizer.pieces)) for _ in range(3)]
+            generated = [rng.randrange(2, len(self.tokenizer.pieces)) for _ in range(12)]
+            stops = self.generate(
+                [self.tokenizer.pieces[t] for t in prompt],
+                [self.tokenizer.pieces[t] for t in generated],
+            )
+
+            expected = []
+            text = "".join(self.tokenizer.pieces[t] for t in prompt)
+            for token in generated:
+                piece = self.tokenizer.pieces[token]
+                text += piece
+                # A stop word ends within the last piece
+                stopped = any(
+                    w in text[max(0, len(text) - len(piece) - len(w) + 1) :]
+                    for w in STOP_WORDS
+                )
+                expected.append(stopped or bool(expected and expected[-1]))
+            self.assertEqual(stops, expected)
+
+    def test_matcher_is_shared(self):
+        matcher = get_stop_matcher(STOP_WORDS, self.tokenizer, (1,))
+        self.assertIs(self.create_stop_criteria().matcher, matcher)
+        self.assertIsNot(get_stop_matcher(STOP_WORDS[:1], self.tokenizer, (1,)), matcher)
+
+    def test_matcher_is_dropped_with_tokenizer(self):
+        tokenizer = PieceTokenizer()
+        tokenizer_ref = weakref.ref(tokenizer)
+        matcher_ref = weakref.ref(get_stop_matcher(STOP_WORDS, tokenizer))
+        del tokenizer
+        gc.collect()
+        self.assertIsNone(tokenizer_ref())
+        self.assertIsNone(matcher_ref())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,49 @@
+import os
+import pickle
+import tempfile
+import unittest
+from os.path import join
+
+from utils.logging import (
+    append_to_pickle_file,
+    load_completed_ids,
+    read_from_pickle_file,
+)
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.results_path = join(self.tmp_dir.name, "results.pkl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_missing_results_file(self):
+        self.assertEqual(load_completed_ids(self.results_path), set())
+
+    def test_completed_ids(self):
+        for _id in [101, 102, 103]:
+            append_to_pickle_file(self.results_path, {_id: {"output": "Appendicitis"}})
+        self.assertEqual(load_completed_ids(self.results_path), {101, 102, 103})
+
+    def test_truncated_last_record(self):
+        append_to_pickle_file(self.results_path, {101: {"output": "Appendicitis"}})
+        complete_size = os.path.getsize(self.results_path)
+        with open(self.results_path, "ab") as f:
+            f.write(pickle.dumps({102: {"output": "Pancreatitis"}})[:-5])
+
+        self.assertEqual(load_completed_ids(self.results_path), {101})
+        self.assertEqual(os.path.getsize(self.results_path), complete_size)
+
+        # Results of the resumed run follow the last complete record
+        append_to_pickle_file(self.results_path, {102: {"output": "Pancreatitis"}})
+        self.assertEqual(
+            list(read_from_pickle_file(self.results_path)),
+            [{101: {"output": "Appendicitis"}}, {102: {"output": "Pancreatitis"}}],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
 import copy
 import pickle
 import unittest
+from unittest.mock import patch, Mock
+
+from thefuzz import process, fuzz
 
 from utils.nlp import (
     convert_labs_to_itemid,
@@ -8,6 +11,15 @@ from utils.nlp import (
     extract_sections,
     extract_primary_diagnosis,
     create_lab_test_string,
+    calculate_num_tokens,
+    truncate_text,
+    LabelIndex,
+    get_lab_name_resolver,
+    keyword_positive,
+    keyword_positive_many,
+    treatment_alternative_procedure_checker,
+    get_nlp,
+    ENTITY_NEGATION_CACHE,
 )
 from tests.DummyData import patient_x
 
@@ -188,6 +200,54 @@ secondary diagnoses: portal vein thrombosis, gerd, depression"""
 
         self.assertEqual(output, "perforated sigmoid colonic diverticulitis")
 
+    def test_unsupported_tokenizer(self):
+        with self.assertRaises(ValueError):
+            calculate_num_tokens(Mock(), ["test"])
+        with self.assertRaises(ValueError):
+            truncate_text(Mock(), "test", 1)
+
+    ##############################
+    # keyword_positive_many tests #
+    ##############################
+
+    def test_keyword_positive_many(self):
+        sentences = ["No signs of appendicitis", "Acute appendicitis", "Appendectomy"]
+        keywords = ["appendicitis", "appendectomy"]
+        ENTITY_NEGATION_CACHE.clear()
+        nlp = get_nlp()
+        with patch.object(nlp, "pipe", wraps=nlp.pipe) as mock_pipe:
+            output = keyword_positive_many(sentences, keywords)
+            for sentence, positives in zip(sentences, output):
+                self.assertEqual(
+                    positives,
+                    [keyword_positive(sentence, keyword) for keyword in keywords],
+                )
+
+        # Every sentence is parsed once, later checks are answered from the cache
+        self.assertEqual(mock_pipe.call_count, 1)
+        self.assertFalse(output[0][0])
+        self.assertEqual(output[1], [True, False])
+        self.assertEqual(output[2], [False, True])
+
+    def test_treatment_alternative_procedure_checker_parses_location_sentences(self):
+        operation_keywords = [
+            {"location": "gallbladder", "modifiers": ["drainage", "removal"]}
+        ]
+        text = "Patient is stable. Percutaneous gallbladder drainage. Gallbladder is distended. No fever"
+        ENTITY_NEGATION_CACHE.clear()
+        nlp = get_nlp()
+        with patch.object(nlp, "pipe", wraps=nlp.pipe) as mock_pipe:
+            self.assertTrue(
+                treatment_alternative_procedure_checker(operation_keywords, text)
+            )
+
+        # Sentences without a location are never parsed
+        self.assertEqual(mock_pipe.call_count, 1)
+        self.assertEqual(
+            set(ENTITY_NEGATION_CACHE),
+            {" Percutaneous gallbladder drainage", " Gallbladder is distended"},
+        )
+
     #########################################
     # convert_labs_to_itemid tests #
     #########################################
@@ -325,6 +385,35 @@ secondary diagnoses: portal vein thrombosis, gerd, depression"""
         self.assertNotIn("CBD", list(self.lab_test_mapping_df["label"]))
         self.assertEqual(output, expected_output)
 
+    def test_label_index_matches_extract_one(self):
+        labels = list(self.lab_test_mapping_df["label"])
+        index = LabelIndex(labels)
+        queries = ["Amylase", "amylase", "Lipse", "White Blod Cells", "CBD", "A", ""]
+        for threshold in [90, 100]:
+            for query in queries:
+                test_match, score = process.extractOne(
+                    query, labels, scorer=fuzz.ratio
+                )
+                expected_output = test_match if score >= threshold else None
+
+                self.assertEqual(index.extract_one(query, threshold), expected_output)
+            self.assertEqual(
+                index.extract_many(queries, threshold),
+                [index.extract_one(query, threshold) for query in queries],
+            )
+
+    def test_lab_name_resolver_cache(self):
+        resolver = get_lab_name_resolver(self.lab_test_mapping_df)
+        self.assertIs(resolver, get_lab_name_resolver(self.lab_test_mapping_df))
+
+        tests = ["Amylase", "Blood Amylase", "CBD", "Amylase"]
+        output = resolver.resolve_many(tests)
+
+        self.assertEqual(output[0], ("Amylase", None))
+        self.assertEqual(output[0], output[3])
+        self.assertEqual(output[2], ("", None))
+        self.assertEqual(output, [resolver.resolve(test) for test in tests])
+
     ##########################
     # extract_sections tests #
     ##########################
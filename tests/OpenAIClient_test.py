@@ -0,0 +1,165 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+
+from models.openai_client import create_openai_client, chat_completion_with_retry
+from models.latency import LatencyTracker
+
+
+class StubChatCompletionHandler(BaseHTTPRequestHandler):
+    # Keep connections alive like a real OpenAI compatible server
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server.requests.append((self.client_address, body))
+        if server.barrier is not None:
+            # Only answers once all expected requests are in flight at the same time
+            try:
+                server.barrier.wait()
+            except threading.BrokenBarrierError:
+                self.send_json(503, {"error": {"message": "not concurrent"}})
+                return
+        if server.failures > 0:
+            server.failures -= 1
+            self.send_json(500, {"error": {"message": "overloaded"}})
+            return
+        self.send_json(
+            200,
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "Appendicitis"},
+                        "finish_reason": "stop",
+                    }
+                ],
+            },
+        )
+
+    def send_json(self, status, content):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOpenAIClient(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubChatCompletionHandler)
+        self.server.requests = []
+        self.server.failures = 0
+        self.server.barrier = None
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = create_openai_client(
+            api_key="stub",
+            base_url=f"http://127.0.0.1:{self.server.server_port}/v1/",
+            timeout=5,
+        )
+        self.messages = [{"role": "user", "content": "Diagnosis?"}]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            completion = chat_completion_with_retry(
+                self.client, messages=self.messages, model="stub-model"
+            )
+            self.assertEqual(completion.choices[0].message.content, "Appendicitis")
+
+        # All requests arrive over the same kept alive connection
+        client_addresses = {address for address, _ in self.server.requests}
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(client_addresses), 1)
+
+    def test_retry(self):
+        self.server.failures = 2
+        completion = chat_completion_with_retry(
+            self.client,
+            max_attempts=3,
+            min_wait=0,
+            max_wait=0,
+            messages=self.messages,
+            model="stub-model",
+        )
+
+        self.assertEqual(completion.choices[0].message.content, "Appendicitis")
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retry_gives_up(self):
+        self.server.failures = 5
+        with self.assertRaises(openai.InternalServerError):
+            chat_completion_with_retry(
+                self.client,
+                max_attempts=2,
+                min_wait=0,
+                max_wait=0,
+                messages=self.messages,
+                model="stub-model",
+            )
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_concurrent_requests(self):
+        num_requests = 24
+        self.server.barrier = threading.Barrier(num_requests, timeout=5)
+        client = create_openai_client(
+            api_key="stub",
+            base_url=f"http://127.0.0.1:{self.server.server_port}/v1/",
+            timeout=10,
+            max_connections=num_requests,
+        )
+        contents = []
+
+        def request():
+            completion = chat_completion_with_retry(
+                client, max_attempts=1, messages=self.messages, model="stub-model"
+            )
+            contents.append(completion.choices[0].message.content)
+
+        threads = [threading.Thread(target=request) for _ in range(num_requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.close()
+
+        self.assertEqual(contents, ["Appendicitis"] * num_requests)
+        client_addresses = {address for address, _ in self.server.requests}
+        self.assertEqual(len(client_addresses), num_requests)
+
+    def test_latency_tracker(self):
+        tracker = LatencyTracker()
+        self.assertEqual(tracker.stats(), {"calls": 0})
+
+        for _ in range(2):
+            with tracker.track():
+                chat_completion_with_retry(
+                    self.client, messages=self.messages, model="stub-model"
+                )
+
+        stats = tracker.stats()
+        self.assertEqual(stats["calls"], 2)
+        self.assertGreater(stats["total"], 0)
+        self.assertLessEqual(stats["p50"], stats["max"])
+
+
+if __name__ == "__main__":
+    unittest.main()
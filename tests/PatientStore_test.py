@@ -0,0 +1,106 @@
+import copy
+import os
+import pickle
+import tempfile
+import unittest
+
+from dataset.patient_store import (
+    PatientStore,
+    write_hadm_to_store,
+    load_hadm_from_store,
+    convert_hadm_file_to_store,
+)
+from dataset.utils import load_hadm_from_file, write_hadm_to_file
+from tests.DummyData import patient_x
+
+
+class TestPatientStore(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.hadm_info = {}
+        for i, _id in enumerate([20000003, 20000001, 20000002]):
+            patient = copy.deepcopy(patient_x)
+            patient["Patient History"] += str(i)
+            # NaN never compares equal after unpickling, so use plain values for the roundtrip checks
+            patient["Reference Range Lower"][50861] = None
+            patient["Reference Range Upper"][50861] = None
+            self.hadm_info[_id] = patient
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_store_roundtrip(self):
+        write_hadm_to_store(self.hadm_info, "test_hadm_info", self.tmp_dir.name)
+        with load_hadm_from_store("test_hadm_info", self.tmp_dir.name) as store:
+            self.assertEqual(len(store), 3)
+            self.assertEqual(list(store.keys()), list(self.hadm_info.keys()))
+            for _id in self.hadm_info:
+                self.assertEqual(store[_id], self.hadm_info[_id])
+            self.assertEqual(
+                store[20000001]["Laboratory Tests"][51301],
+                patient_x["Laboratory Tests"][51301],
+            )
+
+    def test_store_membership(self):
+        write_hadm_to_store(self.hadm_info, "test_hadm_info", self.tmp_dir.name)
+        with load_hadm_from_store("test_hadm_info", self.tmp_dir.name) as store:
+            self.assertIn(20000002, store)
+            self.assertNotIn(1, store)
+            with self.assertRaises(KeyError):
+                store[1]
+
+    def test_store_records_are_copies(self):
+        write_hadm_to_store(self.hadm_info, "test_hadm_info", self.tmp_dir.name)
+        with load_hadm_from_store("test_hadm_info", self.tmp_dir.name) as store:
+            store[20000001]["Patient History"] = ""
+            self.assertEqual(
+                store[20000001]["Patient History"],
+                self.hadm_info[20000001]["Patient History"],
+            )
+
+    def test_store_is_picklable(self):
+        write_hadm_to_store(self.hadm_info, "test_hadm_info", self.tmp_dir.name)
+        store = load_hadm_from_store("test_hadm_info", self.tmp_dir.name)
+        store[20000001]
+        store_copy = pickle.loads(pickle.dumps(store))
+        self.assertIsInstance(store_copy, PatientStore)
+        self.assertEqual(store_copy[20000003], self.hadm_info[20000003])
+        store.close()
+        store_copy.close()
+
+    def test_empty_store(self):
+        write_hadm_to_store({}, "test_hadm_info", self.tmp_dir.name)
+        with load_hadm_from_store("test_hadm_info", self.tmp_dir.name) as store:
+            self.assertEqual(len(store), 0)
+            self.assertEqual(list(store), [])
+
+    def test_convert_hadm_file_to_store(self):
+        with open(os.path.join(self.tmp_dir.name, "test_hadm_info.pkl"), "wb") as f:
+            pickle.dump(self.hadm_info, f)
+        with convert_hadm_file_to_store("test_hadm_info", self.tmp_dir.name) as store:
+            self.assertEqual(dict(store.items()), self.hadm_info)
+
+    def test_load_hadm_from_file_rebuilds_stale_store(self):
+        write_hadm_to_file(self.hadm_info, "test_hadm_info", self.tmp_dir.name)
+        with load_hadm_from_file("test_hadm_info", self.tmp_dir.name) as store:
+            self.assertEqual(dict(store.items()), self.hadm_info)
+
+        # Pickle regenerated without writing the store
+        del self.hadm_info[20000001]
+        pickle_path = os.path.join(self.tmp_dir.name, "test_hadm_info.pkl")
+        with open(pickle_path, "wb") as f:
+            pickle.dump(self.hadm_info, f)
+        store_mtime = os.stat(pickle_path).st_mtime_ns - 10**9
+        for suffix in [".store", ".store.idx"]:
+            path = os.path.join(self.tmp_dir.name, "test_hadm_info" + suffix)
+            os.utime(path, ns=(store_mtime, store_mtime))
+
+        with load_hadm_from_file("test_hadm_info", self.tmp_dir.name) as store:
+            self.assertEqual(dict(store.items()), self.hadm_info)
+        with load_hadm_from_store("test_hadm_info", self.tmp_dir.name) as store:
+            self.assertEqual(list(store.keys()), [20000003, 20000002])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+import pickle
+import tempfile
+import unittest
+from os.path import join
+
+from utils.logging import append_to_pickle_file
+from utils.results_log import (
+    ResultsLog,
+    convert_pickle_log,
+    load_results,
+    open_results_log,
+)
+
+
+def append_results(path, ids):
+    results_log = ResultsLog(path)
+    for _id in ids:
+        results_log.append(_id, {"output": f"Diagnosis {_id}"})
+
+
+class TestResultsLog(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_path = join(self.tmp_dir.name, "run_results.rlog")
+        self.pickle_path = join(self.tmp_dir.name, "run_results.pkl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lookup_and_iteration(self):
+        with ResultsLog(self.log_path) as results_log:
+            self.assertEqual(len(results_log), 0)
+            results_log.append(101, {"output": "Appendicitis"})
+            results_log.append(102, {"output": "Pancreatitis"})
+            self.assertEqual(results_log[102], {"output": "Pancreatitis"})
+            self.assertIn(101, results_log)
+            self.assertNotIn(103, results_log)
+
+            # Repeated patients resolve to their last result but are streamed in full
+            results_log.append(101, {"output": "Cholecystitis"})
+            self.assertEqual(list(results_log), [101, 102])
+            self.assertEqual(results_log[101], {"output": "Cholecystitis"})
+            self.assertEqual(
+                list(results_log.records()),
+                [
+                    (101, {"output": "Appendicitis"}),
+                    (102, {"output": "Pancreatitis"}),
+                    (101, {"output": "Cholecystitis"}),
+                ],
+            )
+
+    def test_records_of_other_writers(self):
+        reader = ResultsLog(self.log_path)
+        writer = ResultsLog(self.log_path)
+        writer.append(101, "Appendicitis")
+        self.assertEqual(reader[101], "Appendicitis")
+        writer.append(102, "Pancreatitis")
+        self.assertEqual(dict(reader), {101: "Appendicitis", 102: "Pancreatitis"})
+        reader.close()
+
+    def test_concurrent_processes(self):
+        processes = [
+            multiprocessing.Process(
+                target=append_results, args=(self.log_path, range(i, 200, 4))
+            )
+            for i in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        results_log = ResultsLog(self.log_path)
+        self.assertEqual(len(results_log), 200)
+        for _id in range(200):
+            self.assertEqual(results_log[_id], {"output": f"Diagnosis {_id}"})
+
+    def test_repair_incomplete_record(self):
+        append_results(self.log_path, [101, 102])
+        complete_size = os.path.getsize(self.log_path)
+        with open(self.log_path, "ab") as f:
+            f.write(b"\x05\x00\x00\x00\xff\xff")
+
+        self.assertEqual(list(ResultsLog(self.log_path)), [101, 102])
+        results_log = open_results_log(self.log_path)
+        self.assertEqual(os.path.getsize(self.log_path), complete_size)
+        results_log.append(103, {"output": "Diagnosis 103"})
+        self.assertEqual(list(results_log), [101, 102, 103])
+
+    def test_repair_corrupted_record(self):
+        append_results(self.log_path, [101])
+        complete_size = os.path.getsize(self.log_path)
+        append_results(self.log_path, [102])
+        with open(self.log_path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"\x00")
+
+        ResultsLog(self.log_path).repair()
+        self.assertEqual(os.path.getsize(self.log_path), complete_size)
+
+    def test_convert_pickle_log(self):
+        append_to_pickle_file(self.pickle_path, {101: "Appendicitis"})
+        append_to_pickle_file(self.pickle_path, {102: "Pancreatitis"})
+
+        results_log = convert_pickle_log(self.pickle_path)
+        self.assertEqual(results_log.path, self.log_path)
+        self.assertEqual(dict(results_log), {101: "Appendicitis", 102: "Pancreatitis"})
+        self.assertEqual(
+            dict(load_results(self.pickle_path)), dict(load_results(self.log_path))
+        )
+
+    def test_open_results_log_of_pickle_run(self):
+        append_to_pickle_file(self.pickle_path, {101: "Appendicitis"})
+        with open(self.pickle_path, "ab") as f:
+            f.write(pickle.dumps({102: "Pancreatitis"})[:-3])
+
+        results_log = open_results_log(self.log_path)
+        self.assertEqual(dict(results_log), {101: "Appendicitis"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+
+from utils.runner import run_patients
+
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def predict(self, _id):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        # Earlier patients take longer so that they finish last
+        time.sleep(0.01 * (10 - _id))
+        with self.lock:
+            self.running -= 1
+        return f"Diagnosis {_id}"
+
+    def test_sequential(self):
+        written = []
+        run_patients(
+            range(5),
+            self.predict,
+            lambda _id, result: written.append((_id, result)),
+        )
+        self.assertEqual(written, [(i, f"Diagnosis {i}") for i in range(5)])
+        self.assertEqual(self.max_running, 1)
+
+    def test_concurrent_keeps_order(self):
+        written = []
+        run_patients(
+            range(10),
+            self.predict,
+            lambda _id, result: written.append((_id, result)),
+            concurrency=4,
+        )
+        self.assertEqual(written, [(i, f"Diagnosis {i}") for i in range(10)])
+        self.assertEqual(self.max_running, 4)
+
+    def test_error_is_raised(self):
+        written = []
+
+        def predict(_id):
+            if _id == 2:
+                raise RuntimeError("Server unavailable")
+            return _id
+
+        with self.assertRaises(RuntimeError):
+            run_patients(
+                range(6),
+                predict,
+                lambda _id, result: written.append(_id),
+                concurrency=3,
+            )
+        self.assertEqual(written, [0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from os.path import join
+
+from agents.summary_cache import (
+    TextSummaryCache,
+    DiskSummaryCache,
+    summarize_with_cache,
+)
+
+
+class FakeSummarizeChain:
+    def __init__(self, template):
+        self.prompt = self
+        self.template = template
+        self.predictions = []
+
+    def format(self, observation):
+        return self.template.format(observation=observation)
+
+    def predict(self, observation, stop):
+        self.predictions.append(observation)
+        return f"Summary of {observation}"
+
+
+class TestSummaryCache(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = join(self.tmp_dir.name, "summaries.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_text_summary_cache_template(self):
+        cache = TextSummaryCache()
+        cache.add_summary("Observation", "Summary", "Template A")
+
+        self.assertEqual(cache.get_summary("Observation", "Template A"), "Summary")
+        self.assertIsNone(cache.get_summary("Observation", "Template B"))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_disk_summary_cache_persists(self):
+        cache = DiskSummaryCache(self.cache_path, "model")
+        cache.add_summary("Observation", "Summary", "Template")
+        cache.add_summary("Observation", "Other Summary", "Template")
+
+        reopened_cache = DiskSummaryCache(self.cache_path, "model")
+        self.assertEqual(
+            reopened_cache.get_summary("Observation", "Template"), "Summary"
+        )
+        self.assertIsNone(reopened_cache.get_summary("Observation", "Other"))
+        self.assertIsNone(
+            DiskSummaryCache(self.cache_path, "other model").get_summary(
+                "Observation", "Template"
+            )
+        )
+        self.assertEqual(reopened_cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_disk_summary_cache_eviction(self):
+        cache = DiskSummaryCache(self.cache_path, "model", max_entries=2)
+        cache.EVICTION_INTERVAL = 1
+        cache.add_summary("Observation 1", "Summary 1")
+        cache.add_summary("Observation 2", "Summary 2")
+        # Using the first entry makes the second the least recently used
+        cache.get_summary("Observation 1")
+        cache.add_summary("Observation 3", "Summary 3")
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_summary("Observation 1"), "Summary 1")
+        self.assertIsNone(cache.get_summary("Observation 2"))
+        self.assertEqual(cache.get_summary("Observation 3"), "Summary 3")
+
+    def test_summarize_with_cache(self):
+        cache = DiskSummaryCache(self.cache_path, "model")
+        chain = FakeSummarizeChain("Summarize: {observation}")
+
+        self.assertEqual(
+            summarize_with_cache(chain, "CT", ["Observation:"], cache), "Summary of CT"
+        )
+        self.assertEqual(
+            summarize_with_cache(chain, "CT", ["Observation:"], cache), "Summary of CT"
+        )
+        self.assertEqual(chain.predictions, ["CT"])
+
+        # A different prompt does not reuse the summary
+        other_chain = FakeSummarizeChain("Summarize briefly: {observation}")
+        summarize_with_cache(other_chain, "CT", ["Observation:"], cache)
+        self.assertEqual(other_chain.predictions, ["CT"])
+        self.assertTrue(os.path.exists(self.cache_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import gc
+import unittest
+import weakref
+from unittest.mock import Mock, patch
+
+from utils.tokenizer import TokenizerAdapter, get_tokenizer_adapter
+
+
+class CharacterTokenizerAdapter(TokenizerAdapter):
+    # One token per character
+    def __init__(self, cache_size=4096):
+        super().__init__(tokenizer=None, cache_size=cache_size)
+        self.encoded_texts = []
+
+    def encode(self, text):
+        self.encoded_texts.append(text)
+        return [ord(c) for c in text]
+
+    def decode(self, tokens):
+        return "".join(chr(t) for t in tokens)
+
+
+class TestTokenizer(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+
+    def test_count_many(self):
+        adapter = CharacterTokenizerAdapter()
+
+        self.assertEqual(adapter.count_many(["abc", "de", "abc"]), [3, 2, 3])
+        self.assertEqual(adapter.count("de"), 2)
+        self.assertEqual(adapter.count("fghi"), 4)
+        # Every distinct text is only encoded once
+        self.assertEqual(adapter.encoded_texts, ["abc", "de", "fghi"])
+
+    def test_count_cache_size(self):
+        adapter = CharacterTokenizerAdapter(cache_size=2)
+        adapter.count_many(["a", "bb", "ccc"])
+        self.assertEqual(len(adapter.cache), 2)
+
+        # Least recently used text was evicted and is encoded again
+        adapter.count("a")
+        self.assertEqual(adapter.encoded_texts, ["a", "bb", "ccc", "a"])
+
+    def test_truncate(self):
+        adapter = CharacterTokenizerAdapter()
+
+        self.assertEqual(adapter.truncate_tail("abcdef", 4), "abcd")
+        self.assertEqual(adapter.truncate_head("abcdef", 4), "cdef")
+        self.assertEqual(adapter.truncate_head("abcdef", 0), "")
+        self.assertEqual(adapter.truncate_tail("abc", 10), "abc")
+
+    def test_get_tokenizer_adapter(self):
+        adapter = CharacterTokenizerAdapter()
+        self.assertIs(get_tokenizer_adapter(adapter), adapter)
+
+        with self.assertRaises(ValueError):
+            get_tokenizer_adapter(Mock())
+
+    def test_shared_adapter_is_dropped_with_tokenizer(self):
+        class Tokenizer:
+            pass
+
+        tokenizer = Tokenizer()
+        with patch("utils.tokenizer.create_tokenizer_adapter", TokenizerAdapter):
+            adapter = get_tokenizer_adapter(tokenizer)
+            self.assertIs(get_tokenizer_adapter(tokenizer), adapter)
+        self.assertIs(adapter.tokenizer, tokenizer)
+
+        tokenizer_ref = weakref.ref(tokenizer)
+        adapter_ref = weakref.ref(adapter)
+        del tokenizer, adapter
+        gc.collect()
+        self.assertIsNone(tokenizer_ref())
+        self.assertIsNone(adapter_ref())
+
+
+if __name__ == "__main__":
+    unittest.main()
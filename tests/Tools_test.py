@@ -1,4 +1,6 @@
+import gc
 import unittest
+import weakref
 import pickle
 
 from tools.Actions import (
@@ -9,6 +11,21 @@ from tools.Actions import (
     retrieve_imaging,
 )
 from tools.Tools import RunLaboratoryTests, RunImaging, DoPhysicalExamination
+import pandas as pd
+
+from tools.utils import (
+    LabTestMapping,
+    get_lab_test_mapping,
+    itemid_to_field,
+    count_matches,
+    count_matches_iterative,
+    ADDITIONAL_LAB_TEST_MAPPING,
+    MODALITY_EXACT_DICT,
+    MODALITY_SUBSTR_DICT,
+    MODALITY_SPECIAL_CASES_DICT,
+    REGION_EXACT_DICT,
+    REGION_SUBSTR_DICT,
+)
 from tests.DummyData import patient_x
 from agents.AgentAction import AgentAction
 
@@ -321,5 +338,139 @@ class TestTools(unittest.TestCase):
         self.assertEqual(output, expected_output)
 
 
+class TestCountMatches(unittest.TestCase):
+    maxDiff = None
+
+    texts = [
+        "",
+        "CT ABD & PELVIS WITH CONTRAST",
+        "CHEST (PA & LAT)",
+        "LIVER OR GALLBLADDER US (SINGLE ORGAN)",
+        "MRCP",
+        "MR ABDOMEN W/O CONTRAST T1 T2",
+        "ERCP BILIARY&PANCREAS BY GI UNIT",
+        "UNILAT LOWER EXT VEINS",
+        "PELVIS US, TRANSVAGINAL & TRANSABDOMINAL",
+        "U.S. of the abdomen, abdomen and abdominal wall, supine & supine and upright",
+        "Endoscopic ultrasound of the pancreas",
+        "Upper GI series with barium swallow",
+        "Drainage of abscess",
+        "Ultraschall Abdomen, Größe der Leber",
+        "CT Thorax – Lunge, Kontrastmittel",
+        "Alanine Aminotransferase (ALT), Lipase and the Complete Blood Count",
+    ]
+
+    def test_count_matches_radiology(self):
+        for text in self.texts:
+            modality_args = (
+                MODALITY_EXACT_DICT,
+                MODALITY_SUBSTR_DICT,
+                MODALITY_SPECIAL_CASES_DICT,
+            )
+            self.assertEqual(
+                list(count_matches(text, *modality_args).items()),
+                list(count_matches_iterative(text, *modality_args).items()),
+            )
+            region_args = (REGION_EXACT_DICT, REGION_SUBSTR_DICT)
+            self.assertEqual(
+                list(count_matches(text, *region_args).items()),
+                list(count_matches_iterative(text, *region_args).items()),
+            )
+
+    def test_count_matches_lab_test_names(self):
+        lab_test_names = [
+            name for name in ADDITIONAL_LAB_TEST_MAPPING if len(name) > 1
+        ] + ["Alanine Aminotransferase (ALT)", "pH", "Größe"]
+        for text in self.texts:
+            self.assertEqual(
+                count_matches(text, exact_dict={"names": lab_test_names}),
+                count_matches_iterative(text, exact_dict={"names": lab_test_names}),
+            )
+
+
+class TestLabTestMapping(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.lab_test_mapping_df = pd.DataFrame(
+            {
+                "itemid": pd.array([51301, 50861, 51301, None, 90201], dtype="Int64"),
+                "label": [
+                    "White Blood Cells",
+                    "Alanine Aminotransferase (ALT)",
+                    "WBC",
+                    "Liver Function Tests",
+                    "Blood Culture",
+                ],
+                "fluid": ["Blood", "Blood", "Blood", None, float("nan")],
+                "corresponding_ids": [
+                    [51301, 51755],
+                    [50861],
+                    [51301, 51755],
+                    [50861, 50878],
+                    [90201],
+                ],
+            },
+            index=[0, 1, 1, 2, 2],
+        )
+
+    def test_itemid_to_field(self):
+        lab_test_mapping = LabTestMapping(self.lab_test_mapping_df)
+        df = self.lab_test_mapping_df
+        for itemid in [51301, 50861, 90201]:
+            for field in ["label", "fluid", "corresponding_ids"]:
+                expected = df.loc[df["itemid"] == itemid, field].iloc[0]
+                result = lab_test_mapping.itemid_to_field(itemid, field)
+                self.assertEqual(repr(result), repr(expected))
+        with self.assertRaises(IndexError):
+            lab_test_mapping.itemid_to_field(12345, "label")
+
+    def test_label_lookups(self):
+        lab_test_mapping = LabTestMapping(self.lab_test_mapping_df)
+        self.assertEqual(
+            lab_test_mapping.label_to_field("Liver Function Tests", "corresponding_ids"),
+            [50861, 50878],
+        )
+        self.assertEqual(
+            lab_test_mapping.labels, self.lab_test_mapping_df["label"].tolist()
+        )
+        self.assertEqual(
+            lab_test_mapping.labels_of_fluid("Blood"),
+            ["White Blood Cells", "Alanine Aminotransferase (ALT)", "WBC"],
+        )
+
+    def test_shared_mapping(self):
+        lab_test_mapping = get_lab_test_mapping(self.lab_test_mapping_df)
+        self.assertIs(get_lab_test_mapping(self.lab_test_mapping_df), lab_test_mapping)
+        self.assertIs(get_lab_test_mapping(lab_test_mapping), lab_test_mapping)
+        self.assertEqual(
+            itemid_to_field(50861, "label", self.lab_test_mapping_df),
+            "Alanine Aminotransferase (ALT)",
+        )
+        self.assertIsNot(
+            get_lab_test_mapping(self.lab_test_mapping_df.copy()), lab_test_mapping
+        )
+
+    def test_shared_mapping_is_rebuilt_for_added_rows(self):
+        df = self.lab_test_mapping_df.copy()
+        lab_test_mapping = get_lab_test_mapping(df)
+        df.loc[3] = [50813, "Lactate", "Blood", [50813]]
+
+        self.assertIsNot(get_lab_test_mapping(df), lab_test_mapping)
+        self.assertEqual(itemid_to_field(50813, "label", df), "Lactate")
+        self.assertEqual(
+            get_lab_test_mapping(df).labels_of_fluid("Blood")[-1], "Lactate"
+        )
+
+    def test_shared_mapping_is_dropped_with_dataframe(self):
+        df = self.lab_test_mapping_df.copy()
+        df_ref = weakref.ref(df)
+        lab_test_mapping_ref = weakref.ref(get_lab_test_mapping(df))
+        del df
+        gc.collect()
+        self.assertIsNone(df_ref())
+        self.assertIsNone(lab_test_mapping_ref())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -5,6 +5,7 @@ from langchain.tools import BaseTool
 import pandas as pd
 
 from tools.Actions import get_action_results, Actions
+from tools.utils import LabTestMapping
 
 
 class LaboratoryTests_Input(BaseModel):
@@ -22,7 +23,7 @@ class RunLaboratoryTests(BaseTool):
     description: str = "Laboratory Tests. The specific tests must be specified in the 'Action Input' field."
     args_schema: Type[BaseModel] = LaboratoryTests_Input
     action_results: Dict = {}
-    lab_test_mapping_df: pd.DataFrame = None
+    lab_test_mapping_df: Union[pd.DataFrame, LabTestMapping] = None
     include_ref_range: bool = False
     bin_lab_results: bool = False
 
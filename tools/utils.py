@@ -1,4 +1,6 @@
+from functools import lru_cache
 from typing import Dict
+import weakref
 
 import pandas as pd
 import re
@@ -621,9 +623,150 @@ def action_input_pretty_printer(obj, lab_test_mapping_df: pd.DataFrame):
         raise NotImplementedError
 
 
+class CompiledMatcher:
+    """
+    Compiled version of the patterns used by count_matches, built once per set of dicts.
+
+    Every pattern is compiled once. For ASCII texts, patterns that are plain literals are counted with str.count on
+    the lowercased text and all other patterns are only run if the literal text they start with occurs in the text.
+    For other texts, the patterns of a category are combined into one alternation that is searched first. Patterns
+    that can match are still counted one by one with findall, so overlapping and repeated matches are counted
+    exactly like count_matches_iterative does.
+    """
+
+    def __init__(
+        self, exact_dict: Dict = {}, substr_dict: Dict = {}, special_cases_dict: Dict = {}
+    ):
+        # Same iteration order as the counts of the uncompiled loop so that ties in max() resolve identically
+        self.categories = list(set(list(exact_dict.keys()) + list(substr_dict.keys())))
+
+        self.special_cases = [
+            compile_category(category, patterns)
+            for category, patterns in special_cases_dict.items()
+        ]
+
+        self.count_groups = []
+        for category, words in exact_dict.items():
+            # The word boundaries have to be checked by the regex, so the word is only used as a prefix filter
+            self.count_groups.append(
+                compile_category(
+                    category,
+                    [r"\b" + word + r"\b" for word in words],
+                    prefixes=[literal_prefix(word)[0] for word in words],
+                )
+            )
+        for category, patterns in substr_dict.items():
+            self.count_groups.append(compile_category(category, patterns))
+
+    def count(self, text):
+        lowered = text.lower() if text.isascii() else None
+
+        # If there is a special cases match, return that
+        for category, gate, compiled, literals, prefixed in self.special_cases:
+            if lowered is not None:
+                if any(map(lowered.__contains__, literals)) or any(
+                    prefix in lowered and pattern.search(text)
+                    for pattern, prefix in prefixed
+                ):
+                    return {category: 1}
+            elif gate is None or gate.search(text):
+                if any(pattern.search(text) for pattern in compiled):
+                    return {category: 1}
+
+        counts = {cat: 0 for cat in self.categories}
+        for category, gate, compiled, literals, prefixed in self.count_groups:
+            if lowered is not None:
+                counts[category] += sum(map(lowered.count, literals))
+                for pattern, prefix in prefixed:
+                    if prefix in lowered:
+                        counts[category] += len(pattern.findall(text))
+            elif gate is None or gate.search(text):
+                for pattern in compiled:
+                    counts[category] += len(pattern.findall(text))
+        return counts
+
+
+def compile_category(category, patterns, prefixes=None):
+    """
+    Returns the category with
+        gate: alternation of all patterns, None if there is only one pattern or they cannot be combined
+        compiled: all compiled patterns, used for non-ASCII texts
+        literals: lowercased patterns that are plain ASCII literals
+        prefixed: (compiled pattern, lowercased literal prefix) of the other patterns
+    """
+    compiled = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    literals = []
+    prefixed = []
+    for i, pattern in enumerate(patterns):
+        prefix, is_literal = literal_prefix(pattern)
+        if prefixes is not None:
+            prefix, is_literal = prefixes[i], False
+        if is_literal and pattern.isascii():
+            literals.append(prefix)
+        else:
+            # Prefixes are only compared against lowercased ASCII texts
+            prefixed.append((compiled[i], prefix if prefix.isascii() else ""))
+    return category, compile_gate(patterns), compiled, literals, prefixed
+
+
+REGEX_METACHARACTERS = set("\\.^$*+?{}[]|()")
+
+
+def literal_prefix(pattern):
+    """
+    Lowercased literal text every match of pattern starts with and whether the pattern is only that literal.
+    """
+    if "|" in pattern:
+        return "", False
+    end = 0
+    while end < len(pattern) and pattern[end] not in REGEX_METACHARACTERS:
+        end += 1
+    if end == len(pattern):
+        return pattern.lower(), pattern.isascii()
+    # The last character is optional or repeated if a quantifier follows
+    if pattern[end] in "*+?{":
+        end = max(end - 1, 0)
+    return pattern[:end].lower(), False
+
+
+def compile_gate(patterns):
+    # Matches wherever any of the patterns matches. Without a gate all patterns are always evaluated
+    if len(patterns) < 2:
+        return None
+    try:
+        return re.compile(
+            "|".join("(?:{})".format(pattern) for pattern in patterns), re.IGNORECASE
+        )
+    except re.error:
+        return None
+
+
+def freeze_pattern_dict(pattern_dict: Dict):
+    return tuple((key, tuple(values)) for key, values in pattern_dict.items())
+
+
+@lru_cache(maxsize=32)
+def get_compiled_matcher(exact_items=(), substr_items=(), special_cases_items=()):
+    return CompiledMatcher(
+        dict(exact_items), dict(substr_items), dict(special_cases_items)
+    )
+
+
 # Search for terms using regex and word boundries. Count number of matches
 def count_matches(
     text, exact_dict: Dict = {}, substr_dict: Dict = {}, special_cases_dict: Dict = {}
+):
+    matcher = get_compiled_matcher(
+        freeze_pattern_dict(exact_dict),
+        freeze_pattern_dict(substr_dict),
+        freeze_pattern_dict(special_cases_dict),
+    )
+    return matcher.count(text)
+
+
+# Reference implementation of count_matches. Compiles and runs every pattern on every call
+def count_matches_iterative(
+    text, exact_dict: Dict = {}, substr_dict: Dict = {}, special_cases_dict: Dict = {}
 ):
     counts = {}
 
@@ -655,22 +798,25 @@ def count_matches(
     return counts
 
 
+RADIOLOGY_MODALITY_MATCHER = CompiledMatcher(
+    exact_dict=MODALITY_EXACT_DICT,
+    substr_dict=MODALITY_SUBSTR_DICT,
+    special_cases_dict=MODALITY_SPECIAL_CASES_DICT,
+)
+
+RADIOLOGY_REGION_MATCHER = CompiledMatcher(
+    exact_dict=REGION_EXACT_DICT,
+    substr_dict=REGION_SUBSTR_DICT,
+)
+
+
 def count_radiology_modality_and_organ_matches(text):
-    modality_counts = count_matches(
-        text,
-        exact_dict=MODALITY_EXACT_DICT,
-        substr_dict=MODALITY_SUBSTR_DICT,
-        special_cases_dict=MODALITY_SPECIAL_CASES_DICT,
-    )
+    modality_counts = RADIOLOGY_MODALITY_MATCHER.count(text)
     frequent_modality = max(modality_counts, key=modality_counts.get)
     frequent_modality_count = modality_counts[frequent_modality]
 
     # Count matches of each region
-    organ_counts = count_matches(
-        text,
-        exact_dict=REGION_EXACT_DICT,
-        substr_dict=REGION_SUBSTR_DICT,
-    )
+    organ_counts = RADIOLOGY_REGION_MATCHER.count(text)
     frequent_region = max(organ_counts, key=organ_counts.get)
     frequent_region_count = organ_counts[frequent_region]
 
@@ -688,7 +834,82 @@ def count_radiology_modality_and_organ_matches(text):
     )
 
 
+class LabTestMapping:
+    """
+    Indexes of the lab test mapping DataFrame for constant time lookups by itemid, label and fluid.
+
+    Lookups return the same values as the equivalent DataFrame filters, i.e. the field of the first row with the
+    itemid or label. The DataFrame must not be modified after the mapping was created. get_lab_test_mapping only
+    detects added or removed rows.
+    """
+
+    def __init__(self, lab_test_mapping_df: pd.DataFrame):
+        # The DataFrame owns its shared mapping, see get_lab_test_mapping
+        self.df_ref = weakref.ref(lab_test_mapping_df)
+        self.num_rows = len(lab_test_mapping_df)
+        self.labels = lab_test_mapping_df["label"].tolist()
+
+        # Position of the first row of every itemid and label
+        self.itemid_positions = {}
+        for position, itemid in enumerate(lab_test_mapping_df["itemid"].tolist()):
+            if not pd.isna(itemid):
+                self.itemid_positions.setdefault(itemid, position)
+        self.label_positions = {}
+        for position, label in enumerate(self.labels):
+            self.label_positions.setdefault(label, position)
+
+        self.columns = {}
+        self.fluid_labels = {}
+
+    @property
+    def df(self):
+        df = self.df_ref()
+        if df is None:
+            raise ReferenceError("The lab test mapping DataFrame no longer exists")
+        return df
+
+    def column(self, field: str):
+        if field not in self.columns:
+            self.columns[field] = self.df[field]
+        return self.columns[field]
+
+    def itemid_to_field(self, itemid: int, field: str):
+        if itemid not in self.itemid_positions:
+            raise IndexError("itemid {} not in lab test mapping".format(itemid))
+        return self.column(field).iat[self.itemid_positions[itemid]]
+
+    def label_to_field(self, label: str, field: str):
+        if label not in self.label_positions:
+            raise IndexError("label {} not in lab test mapping".format(label))
+        return self.column(field).iat[self.label_positions[label]]
+
+    def labels_of_fluid(self, fluid: str):
+        if fluid not in self.fluid_labels:
+            self.fluid_labels[fluid] = self.df[self.df["fluid"] == fluid][
+                "label"
+            ].tolist()
+        return self.fluid_labels[fluid]
+
+
+def get_lab_test_mapping(lab_test_mapping_df):
+    """
+    Shared LabTestMapping of a lab test mapping DataFrame, created on first use. Where the DataFrame is loaded, the
+    mapping is created once and passed on to the tools, parser and report builders instead of the DataFrame.
+    """
+    if isinstance(lab_test_mapping_df, LabTestMapping):
+        return lab_test_mapping_df
+    # DataFrames are not hashable, so the mapping is cached on the DataFrame itself and goes away with it. Copies and
+    # unpickled DataFrames do not carry it over
+    lab_test_mapping = getattr(lab_test_mapping_df, "_lab_test_mapping", None)
+    # Rows added to or removed from the DataFrame move the indexed positions
+    if (
+        lab_test_mapping is None
+        or lab_test_mapping.num_rows != len(lab_test_mapping_df)
+    ):
+        lab_test_mapping = LabTestMapping(lab_test_mapping_df)
+        lab_test_mapping_df._lab_test_mapping = lab_test_mapping
+    return lab_test_mapping
+
+
 def itemid_to_field(itemid: int, field: str, lab_test_mapping_df: pd.DataFrame):
-    return lab_test_mapping_df.loc[lab_test_mapping_df["itemid"] == itemid, field].iloc[
-        0
-    ]
+    return get_lab_test_mapping(lab_test_mapping_df).itemid_to_field(itemid, field)
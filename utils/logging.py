@@ -1,4 +1,5 @@
 import ast
+import os
 import pickle
 
 
@@ -41,8 +42,12 @@ def parse_log_file(logfile, debug=False):
 
 # Used for continuous logging
 def append_to_pickle_file(filename, data):
+    # Write the record at once and sync it so that a crash can at most cut off the last record
+    record = pickle.dumps(data)
     with open(filename, "ab") as f:
-        pickle.dump(data, f)
+        f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
 
 
 def read_from_pickle_file(filename):
@@ -52,3 +57,26 @@ def read_from_pickle_file(filename):
                 yield pickle.load(f)
             except EOFError:
                 break
+
+
+def load_completed_ids(filename):
+    """
+    Ids of all admissions in a results file written with append_to_pickle_file. A last record that was cut off by a
+    crash is removed from the file so that the results of the resumed run can be appended.
+    """
+    completed_ids = set()
+    if not os.path.exists(filename):
+        return completed_ids
+    with open(filename, "rb+") as f:
+        size = os.fstat(f.fileno()).st_size
+        end = 0
+        while end < size:
+            try:
+                record = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                break
+            completed_ids.update(record.keys())
+            end = f.tell()
+        if end < size:
+            f.truncate(end)
+    return completed_ids
@@ -2,29 +2,50 @@ import logging
 from typing import List
 import string
 import copy
+import threading
+import weakref
+from collections import OrderedDict
 
+import numpy as np
 import pandas as pd
-import spacy
-from negspacy.negation import Negex  # noqa: F401
 import nltk
 import re
-from thefuzz import process, fuzz
+from rapidfuzz import process as rf_process, fuzz as rf_fuzz, utils as rf_utils
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
-from transformers import LlamaTokenizer
-from exllamav2 import ExLlamaV2Tokenizer
-import tiktoken
-
-from tools.utils import FLUID_MAPPING, itemid_to_field
-
-nlp = spacy.load("en_core_sci_lg")
-nlp.add_pipe(
-    "negex",
-    config={
-        "chunk_prefix": ["no"],
-    },
-    last=True,
-)
+
+from tools.utils import FLUID_MAPPING, itemid_to_field, get_lab_test_mapping
+from utils.tokenizer import get_tokenizer_adapter
+
+# spaCy pipeline with negex. Loaded on first use because loading en_core_sci_lg takes seconds and hundreds of MB
+NLP = None
+
+
+def get_nlp():
+    global NLP
+    if NLP is None:
+        import spacy
+        from negspacy.negation import Negex  # noqa: F401
+
+        NLP = spacy.load("en_core_sci_lg")
+        NLP.add_pipe(
+            "negex",
+            config={
+                "chunk_prefix": ["no"],
+            },
+            last=True,
+        )
+    return NLP
+
+
+def warmup():
+    """
+    Load the spaCy pipeline now instead of on the first negation check or diagnosis extraction, e.g. before
+    forking workers so that they share the loaded model.
+    """
+    get_nlp()
+
+
 # nltk.download("stopwords")
 
 ###
@@ -33,10 +54,24 @@ nlp.add_pipe(
 
 
 def treatment_alternative_procedure_checker(operation_keywords, text):
+    sentences = text.split(".")
+    # keyword_positive only parses sentences that contain a location, as the modifier is only checked after it. Parse
+    # those in one pass, the loops below then only hit the cache
+    locations = [
+        alternative_operations["location"].lower()
+        for alternative_operations in operation_keywords
+    ]
+    parse_entity_negations(
+        [
+            sentence
+            for sentence in sentences
+            if any(location in sentence.lower() for location in locations)
+        ]
+    )
     for alternative_operations in operation_keywords:
         op_loc = alternative_operations["location"]
         for op_mod in alternative_operations["modifiers"]:
-            for sentence in text.split("."):
+            for sentence in sentences:
                 if keyword_positive(sentence, op_loc) and keyword_positive(
                     sentence, op_mod
                 ):
@@ -44,17 +79,87 @@ def treatment_alternative_procedure_checker(operation_keywords, text):
     return False
 
 
+# Entities of recently parsed sentences as (lowercase text, negated) tuples. Evaluators check the same sentences for many keywords
+ENTITY_NEGATION_CACHE = OrderedDict()
+ENTITY_NEGATION_CACHE_SIZE = 8192
+
+
+def parse_entity_negations(sentences: List[str]):
+    """
+    Entities and their negation of every sentence. Sentences that are not cached are parsed together in one nlp.pipe pass.
+
+    Returns:
+        entity_negations (list): Tuple of (lowercase entity text, negated) per sentence
+    """
+    entity_negations = {
+        sentence: ENTITY_NEGATION_CACHE[sentence]
+        for sentence in sentences
+        if sentence in ENTITY_NEGATION_CACHE
+    }
+    unparsed_sentences = [
+        sentence
+        for sentence in dict.fromkeys(sentences)
+        if sentence not in entity_negations
+    ]
+    if unparsed_sentences:
+        for sentence, doc in zip(
+            unparsed_sentences, get_nlp().pipe(unparsed_sentences)
+        ):
+            entity_negations[sentence] = tuple(
+                (e.text.lower(), e._.negex) for e in doc.ents
+            )
+
+    for sentence, negations in entity_negations.items():
+        ENTITY_NEGATION_CACHE[sentence] = negations
+        ENTITY_NEGATION_CACHE.move_to_end(sentence)
+    while len(ENTITY_NEGATION_CACHE) > ENTITY_NEGATION_CACHE_SIZE:
+        ENTITY_NEGATION_CACHE.popitem(last=False)
+    return [entity_negations[sentence] for sentence in sentences]
+
+
+def keyword_positive_in_entities(sentence, keyword, entity_negations):
+    keyword = keyword.lower()
+    for entity, negated in entity_negations:
+        if keyword in entity:
+            return not negated
+
+    # Just check for keyword in sentence if not found in entities
+    return keyword in sentence.lower()
+
+
 # Makes check if a keyword is positive i.e. occurs and is not negated. For negation check uses the negex algorithm i.e. "No appendicitis" or "No signs of appendicitis" or "Abscence of typical indications of appendicitis"
 def keyword_positive(sentence, keyword):
-    doc = nlp(sentence)
+    # Entities are substrings of the sentence, so without the keyword in the sentence there is nothing to parse
+    if keyword.lower() not in sentence.lower():
+        return False
+    (entity_negations,) = parse_entity_negations([sentence])
+    return keyword_positive_in_entities(sentence, keyword, entity_negations)
 
-    for e in doc.ents:
-        if keyword.lower() in e.text.lower():
-            return not e._.negex
 
-    # Just check for keyword in sentence if not found in entities
-    return keyword.lower() in sentence.lower()
-    # return False
+def keyword_positive_many(sentences: List[str], keywords: List[str]):
+    """
+    keyword_positive for every combination of sentence and keyword, parsing each sentence at most once.
+
+    Returns:
+        positives (list): One list per sentence with one bool per keyword
+    """
+    sentences_to_parse = [
+        sentence
+        for sentence in sentences
+        if any(keyword.lower() in sentence.lower() for keyword in keywords)
+    ]
+    parsed = dict(zip(sentences_to_parse, parse_entity_negations(sentences_to_parse)))
+    positives = []
+    for sentence in sentences:
+        positives.append(
+            [
+                sentence in parsed
+                and keyword.lower() in sentence.lower()
+                and keyword_positive_in_entities(sentence, keyword, parsed[sentence])
+                for keyword in keywords
+            ]
+        )
+    return positives
 
 
 def remove_punctuation(input_string):
@@ -64,7 +169,7 @@ def remove_punctuation(input_string):
 
 
 def contains(keyword: str, strings: List[str]):
-    return any(keyword_positive(string, keyword) for string in strings)
+    return any(positives[0] for positives in keyword_positive_many(strings, [keyword]))
 
 
 # Check if diagnosis is in list of diagnoses. Combines discharge text diagnosis with all recorded ICD diagnoses
@@ -90,6 +195,8 @@ def procedure_checker(
 
 # Extract keywords from text using spacy library. Keywords are nouns and adjectives
 def extract_keywords_spacy(text: str):
+    import spacy
+
     nlp = spacy.load("en_core_web_sm")
     doc = nlp(text)
     keywords = [token.text for token in doc if token.pos_ in ["NOUN", "ADJ", "PROPN"]]
@@ -126,63 +233,196 @@ def match_fluid(test: str):
     return None, None
 
 
-# Convert list of tests to canonical names. Canonical names are the names used in the lab test mapping file
-def convert_labs_to_itemid(tests: List[str], lab_test_mapping_df: pd.DataFrame):
-    logging.getLogger().setLevel(logging.ERROR)
-    labels = lab_test_mapping_df["label"].tolist()
-    all_tests = []
-    for test_full in tests:
+class LabelIndex:
+    """
+    Labels preprocessed the same way thefuzz preprocesses query and choices, so that rapidfuzz can be called directly.
+    """
+
+    def __init__(self, labels: List[str]):
+        self.labels = labels
+        self.processed_labels = [rf_utils.default_process(label) for label in labels]
+        # Position of the first label of every processed label. An identical processed label is the only way to score 100
+        self.exact_positions = {}
+        for position, processed_label in enumerate(self.processed_labels):
+            self.exact_positions.setdefault(processed_label, position)
+
+    def extract_one(self, query: str, threshold: int):
+        """
+        Equivalent of process.extractOne(query, labels, scorer=fuzz.ratio) followed by a check of the rounded score
+        against the threshold.
+
+        Returns:
+            label (str): Best matching label or None if its score is below the threshold
+        """
+        processed_query = rf_utils.default_process(query)
+        if processed_query in self.exact_positions:
+            return self.labels[self.exact_positions[processed_query]]
+        # The cutoff only skips labels that can not reach the threshold after rounding, the best label stays the same
+        result = rf_process.extractOne(
+            processed_query,
+            self.processed_labels,
+            scorer=rf_fuzz.ratio,
+            processor=None,
+            score_cutoff=threshold - 1,
+        )
+        return self.label_if_above_threshold(result, threshold)
+
+    def extract_many(self, queries: List[str], threshold: int):
+        """
+        extract_one for many queries with a single batched call to rapidfuzz for all queries without an exact match.
+        """
+        processed_queries = [rf_utils.default_process(query) for query in queries]
+        matches = [None] * len(queries)
+        fuzzy_indices = []
+        for indx, processed_query in enumerate(processed_queries):
+            if processed_query in self.exact_positions:
+                matches[indx] = self.labels[self.exact_positions[processed_query]]
+            else:
+                fuzzy_indices.append(indx)
+        if not fuzzy_indices or not self.labels:
+            return matches
+
+        scores = rf_process.cdist(
+            [processed_queries[indx] for indx in fuzzy_indices],
+            self.processed_labels,
+            scorer=rf_fuzz.ratio,
+            processor=None,
+            score_cutoff=threshold - 1,
+            dtype=np.float64,
+        )
+        # argmax returns the first best label, the same one extractOne returns
+        best_positions = scores.argmax(axis=1)
+        for indx, position, row in zip(fuzzy_indices, best_positions, scores):
+            result = (self.labels[position], row[position], position)
+            matches[indx] = self.label_if_above_threshold(result, threshold)
+        return matches
+
+    def label_if_above_threshold(self, result, threshold: int):
+        # thefuzz rounds the score before it is compared to the threshold
+        if result is None or int(round(result[1])) < threshold:
+            return None
+        return self.labels[result[2]]
+
+
+class LabNameResolver:
+    """
+    Resolves requested lab tests to canonical labels of the lab test mapping. Follows the fallback order of
+    fuzzy matching the full, long and short name and finally the name without fluid with the same thresholds as
+    process.extractOne with fuzz.ratio, but on a prebuilt index and with a cache of previously resolved tests.
+    """
+
+    def __init__(self, lab_test_mapping, cache_size: int = 4096):
+        # The shared resolvers are keyed by their mapping, see get_lab_name_resolver
+        self.lab_test_mapping_ref = weakref.ref(lab_test_mapping)
+        self.index = LabelIndex(lab_test_mapping.labels)
+        self.fluid_indexes = {}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        # Patients of a run may be processed in concurrent threads
+        self.lock = threading.Lock()
+
+    def fluid_index(self, fluid: str):
+        if fluid not in self.fluid_indexes:
+            self.fluid_indexes[fluid] = LabelIndex(
+                self.lab_test_mapping_ref().labels_of_fluid(fluid)
+            )
+        return self.fluid_indexes[fluid]
+
+    def resolve(self, test_full: str):
+        """
+        Returns:
+            test_match (str): Canonical label or an empty string if no label matches
+            fluid (str): Fluid requested in the test or None
+        """
+        return self.resolve_many([test_full])[0]
+
+    def resolve_many(self, tests: List[str]):
+        with self.lock:
+            return self._resolve_many(tests)
+
+    def _resolve_many(self, tests: List[str]):
+        results = [self.cache.get(test) for test in tests]
+        uncached_tests = list(
+            dict.fromkeys(
+                test for test, result in zip(tests, results) if result is None
+            )
+        )
+        if uncached_tests:
+            # Start with full name since its hardest to match and has least amount of false positives. Batched as this step is needed for every test
+            full_matches = self.index.extract_many(uncached_tests, 90)
+            for test_full, full_match in zip(uncached_tests, full_matches):
+                self.add_to_cache(test_full, self.fallback(test_full, full_match))
+
+        for indx, test in enumerate(tests):
+            if results[indx] is None:
+                results[indx] = self.cache[test]
+            self.cache.move_to_end(test)
+        return results
+
+    def fallback(self, test_full: str, full_match):
         fluid, test_no_fluid = match_fluid(test_full)
+        if full_match is not None:
+            return full_match, fluid
 
         # Extract short and long name
         test_short, test_long = extract_short_and_long_name(test_full)
 
-        # Try fuzzy matching to allow for spelling mistakes and small discrepencies. Use ratio because we have many tests that are just one letter that match too strong with partial ratio
-        # Start with full name since its hardest to match and has least amount of false positives
-        test_match, score = process.extractOne(test_full, labels, scorer=fuzz.ratio)
-        if score < 90:
-            # If no match, try using the long name.
-            test_match, score = process.extractOne(test_long, labels, scorer=fuzz.ratio)
-            if score < 90:
-                # If no match, try using the short name but look for exact match because a single letter difference typically completely changes the test
-                test_match, score = process.extractOne(
-                    test_short, labels, scorer=fuzz.ratio
-                )
-                if score < 100:
-                    # If no match, try removing the fluid and searching again
-                    if fluid:
-                        labels_fluid = lab_test_mapping_df[
-                            lab_test_mapping_df["fluid"] == fluid
-                        ]["label"].tolist()
-                        test_match, score = process.extractOne(
-                            test_no_fluid, labels_fluid, scorer=fuzz.ratio
-                        )
-                        if score < 90:
-                            # Finally, return just test itself. Will not match going forward but saves original intent
-                            test_match = ""
-                            with open("no_canonical_names.txt", "a") as f:
-                                f.write(f"{test_full}\n")
-                    else:
-                        # Finally, return just test itself. Will not match going forward but saves original intent
-                        test_match = ""
-                        with open("no_canonical_names.txt", "a") as f:
-                            f.write(f"{test_full}\n")
+        # If no match, try using the long name.
+        test_match = self.index.extract_one(test_long, 90)
+        if test_match is None:
+            # If no match, try using the short name but look for exact match because a single letter difference typically completely changes the test
+            test_match = self.index.extract_one(test_short, 100)
+        if test_match is None and fluid:
+            # If no match, try removing the fluid and searching again
+            test_match = self.fluid_index(fluid).extract_one(test_no_fluid, 90)
+        if test_match is None:
+            test_match = ""
+        return test_match, fluid
+
+    def add_to_cache(self, test: str, result):
+        self.cache[test] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+
+# Resolvers of the lab test mappings in use. Dropped together with their mapping
+LAB_NAME_RESOLVERS = weakref.WeakKeyDictionary()
+
+
+def get_lab_name_resolver(lab_test_mapping_df):
+    lab_test_mapping = get_lab_test_mapping(lab_test_mapping_df)
+    if lab_test_mapping not in LAB_NAME_RESOLVERS:
+        LAB_NAME_RESOLVERS[lab_test_mapping] = LabNameResolver(lab_test_mapping)
+    return LAB_NAME_RESOLVERS[lab_test_mapping]
+
+
+# Convert list of tests to canonical names. Canonical names are the names used in the lab test mapping file
+def convert_labs_to_itemid(tests: List[str], lab_test_mapping_df: pd.DataFrame):
+    logging.getLogger().setLevel(logging.ERROR)
+    lab_test_mapping = get_lab_test_mapping(lab_test_mapping_df)
+    resolver = get_lab_name_resolver(lab_test_mapping)
+    all_tests = []
+    for test_full, (test_match, fluid) in zip(tests, resolver.resolve_many(tests)):
+        if not test_match:
+            # Finally, return just test itself. Will not match going forward but saves original intent
+            with open("no_canonical_names.txt", "a") as f:
+                f.write(f"{test_full}\n")
 
         # Replace test with full list of valid names if matched
         if test_match:
-            expanded_tests = lab_test_mapping_df.loc[
-                lab_test_mapping_df["label"] == test_match, "corresponding_ids"
-            ].iloc[0]
+            expanded_tests = lab_test_mapping.label_to_field(
+                test_match, "corresponding_ids"
+            )
 
             # Only include those of specific fluid if specified
             if fluid:
                 expanded_tests = [
                     test
                     for test in expanded_tests
-                    if (itemid_to_field(test, "fluid", lab_test_mapping_df) == fluid)
+                    if (lab_test_mapping.itemid_to_field(test, "fluid") == fluid)
                     or (  # If fluid is nan then its a microbio test. TODO: Check against spec_itemid instead
-                        itemid_to_field(test, "fluid", lab_test_mapping_df)
-                        != itemid_to_field(test, "fluid", lab_test_mapping_df)
+                        lab_test_mapping.itemid_to_field(test, "fluid")
+                        != lab_test_mapping.itemid_to_field(test, "fluid")
                     )
                 ]
             all_tests.extend(expanded_tests)
@@ -266,6 +506,7 @@ def extract_primary_diagnosis(text):
     earliest_keyword_index = len(text)
 
     # Do parsing of entire text and check for earliest possible diagnosis
+    nlp = get_nlp()
     doc = nlp(text)
     diag = check_ents_for_diagnosis_noun_chunks(doc)
     if diag:
@@ -332,37 +573,11 @@ def check_ents_for_diagnosis_noun_chunks(doc):
 
 
 def calculate_num_tokens(tokenizer, inputs):
-    num_tokens = 0
-    for input in inputs:
-        tokens = tokenizer.encode(input)
-        if isinstance(tokenizer, ExLlamaV2Tokenizer):
-            num_tokens += tokens.shape[-1]
-        elif isinstance(tokenizer, LlamaTokenizer) or isinstance(
-            tokenizer, tiktoken.Encoding
-        ):
-            num_tokens += len(tokens)
-        else:
-            raise ValueError("Tokenizer not supported")
-    return num_tokens
+    return sum(get_tokenizer_adapter(tokenizer).count_many(inputs))
 
 
 def truncate_text(tokenizer, input, available_tokens):
-    if isinstance(tokenizer, ExLlamaV2Tokenizer):
-        truncated_input_tokens = tokenizer.encode(input)[:, :available_tokens]
-        input = tokenizer.decode(truncated_input_tokens)[0]
-    elif isinstance(tokenizer, tiktoken.Encoding):
-        truncated_input_tokens = input = tokenizer.encode(input)[:available_tokens]
-        input = tokenizer.decode(truncated_input_tokens)
-    elif isinstance(tokenizer, LlamaTokenizer):
-        truncated_tokens = tokenizer.encode(
-            input,
-            truncation=False,
-            padding=False,
-        )[:available_tokens]
-        input = tokenizer.decode(truncated_tokens, skip_special_tokens=True)
-    else:
-        raise ValueError("Tokenizer not supported")
-    return input
+    return get_tokenizer_adapter(tokenizer).truncate_tail(input, available_tokens)
 
 
 def create_lab_test_string(
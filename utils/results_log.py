@@ -0,0 +1,218 @@
+import fcntl
+import os
+import pickle
+import struct
+import zlib
+from collections.abc import Mapping
+
+from utils.logging import load_completed_ids, read_from_pickle_file
+
+RESULTS_LOG_SUFFIX = "_results.rlog"
+MAGIC = b"CDMRLOG1"
+# Length of the pickled hadm_id, length of the pickled result and CRC32 of both
+RECORD_HEADER = struct.Struct("<IQI")
+
+
+class ResultsLog(Mapping):
+    """
+    Append-only log of the results of a run, readable as a mapping of hadm_id to result.
+
+    Every record is a fixed size header followed by the pickled hadm_id and the pickled result. Opening the log only
+    reads the headers and ids to build an offset index, results are unpickled when they are accessed. Records that
+    other workers append are picked up on the next access. If a patient was logged more than once, the last result is
+    returned.
+
+    Appends lock the file, so several threads or processes can write to the same log. A crash can at most leave an
+    incomplete last record behind, which readers ignore and repair removes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = {}
+        self._scanned = 0
+        self._fd = None
+
+    def _file_descriptor(self):
+        # Open lazily so that forked workers read through their own descriptor
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDONLY)
+        return self._fd
+
+    def _check_magic(self, fd):
+        if os.pread(fd, len(MAGIC), 0) != MAGIC:
+            raise ValueError(f"Not a results log: {self.path}")
+
+    def _records(self, fd, offset, size):
+        # Yields the offset, header, and key of every complete record from offset on
+        while offset + RECORD_HEADER.size <= size:
+            header = RECORD_HEADER.unpack(os.pread(fd, RECORD_HEADER.size, offset))
+            key_length, payload_length, _ = header
+            if offset + RECORD_HEADER.size + key_length + payload_length > size:
+                return
+            key = os.pread(fd, key_length, offset + RECORD_HEADER.size)
+            yield offset, header, key
+            offset += RECORD_HEADER.size + key_length + payload_length
+
+    def refresh(self):
+        """Add records appended since the last refresh to the index"""
+        if not os.path.exists(self.path):
+            return
+        fd = self._file_descriptor()
+        size = os.fstat(fd).st_size
+        if self._scanned == 0:
+            if size < len(MAGIC):
+                return
+            self._check_magic(fd)
+            self._scanned = len(MAGIC)
+        for offset, (key_length, payload_length, _), key in self._records(
+            fd, self._scanned, size
+        ):
+            payload_offset = offset + RECORD_HEADER.size + key_length
+            self._index[pickle.loads(key)] = (payload_offset, payload_length)
+            self._scanned = payload_offset + payload_length
+
+    def append(self, hadm_id, result):
+        key = pickle.dumps(hadm_id, protocol=pickle.HIGHEST_PROTOCOL)
+        payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        header = RECORD_HEADER.pack(
+            len(key), len(payload), zlib.crc32(payload, zlib.crc32(key))
+        )
+        with open(self.path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    f.write(MAGIC)
+                f.write(header + key + payload)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def repair(self):
+        """
+        Remove an incomplete or corrupted last record left behind by a crash. Must be called before appending to the
+        log of an interrupted run, as results appended after a broken record could not be read.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                fd = f.fileno()
+                size = os.fstat(fd).st_size
+                end = 0
+                if size >= len(MAGIC):
+                    self._check_magic(fd)
+                    end = len(MAGIC)
+                    for offset, (key_length, payload_length, crc), key in self._records(
+                        fd, end, size
+                    ):
+                        payload = os.pread(
+                            fd, payload_length, offset + RECORD_HEADER.size + key_length
+                        )
+                        if zlib.crc32(payload, zlib.crc32(key)) != crc:
+                            break
+                        end = offset + RECORD_HEADER.size + key_length + payload_length
+                if end < size:
+                    f.truncate(end)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.close()
+        self._index = {}
+        self._scanned = 0
+
+    def records(self):
+        """Stream all records as (hadm_id, result) in the order they were logged, including repeated patients"""
+        if not os.path.exists(self.path):
+            return
+        fd = self._file_descriptor()
+        size = os.fstat(fd).st_size
+        if size < len(MAGIC):
+            return
+        self._check_magic(fd)
+        for offset, (key_length, payload_length, _), key in self._records(
+            fd, len(MAGIC), size
+        ):
+            payload = os.pread(
+                fd, payload_length, offset + RECORD_HEADER.size + key_length
+            )
+            yield pickle.loads(key), pickle.loads(payload)
+
+    def __getitem__(self, hadm_id):
+        if hadm_id not in self._index:
+            self.refresh()
+        offset, length = self._index[hadm_id]
+        return pickle.loads(os.pread(self._file_descriptor(), length, offset))
+
+    def __contains__(self, hadm_id):
+        if hadm_id not in self._index:
+            self.refresh()
+        return hadm_id in self._index
+
+    def __iter__(self):
+        self.refresh()
+        return iter(list(self._index))
+
+    def __len__(self):
+        self.refresh()
+        return len(self._index)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = None
+
+    def __getstate__(self):
+        # File descriptors cannot be pickled. Ship the path and index and reopen on first access
+        state = self.__dict__.copy()
+        state["_fd"] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def convert_pickle_log(pickle_path, log_path=None):
+    """
+    Convert a results pickle written with append_to_pickle_file into a results log next to it.
+
+    Args:
+        pickle_path (str): Path of the {run_name}_results.pkl file
+        log_path (str): Path of the results log. Defaults to the pickle path with the results log suffix
+    """
+    if log_path is None:
+        log_path = pickle_path[: -len("_results.pkl")] + RESULTS_LOG_SUFFIX
+    # Write to a temporary file first so that readers never see a half converted log
+    results_log = ResultsLog(log_path + ".tmp")
+    if os.path.exists(results_log.path):
+        os.remove(results_log.path)
+    for record in read_from_pickle_file(pickle_path):
+        for _id, result in record.items():
+            results_log.append(_id, result)
+    os.replace(results_log.path, log_path)
+    return ResultsLog(log_path)
+
+
+def open_results_log(log_path):
+    """
+    Results log of a run to append to. The log of an interrupted run is repaired and a results pickle of an older run
+    with the same name is converted first.
+    """
+    pickle_path = log_path[: -len(RESULTS_LOG_SUFFIX)] + "_results.pkl"
+    if not os.path.exists(log_path) and os.path.exists(pickle_path):
+        # Drops a last pickle that was cut off by a crash
+        load_completed_ids(pickle_path)
+        convert_pickle_log(pickle_path, log_path)
+    results_log = ResultsLog(log_path)
+    results_log.repair()
+    return results_log
+
+
+def load_results(path):
+    """Mapping of hadm_id to result of a results log or a results pickle"""
+    if path.endswith(".pkl"):
+        return {k: v for d in read_from_pickle_file(path) for k, v in d.items()}
+    return ResultsLog(path)
@@ -0,0 +1,60 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+async def run_patients_async(hadm_ids, predict, write_result, concurrency):
+    """
+    Run predict for up to concurrency patients at once. Predict is blocking, e.g. a request to an OpenAI compatible
+    server, and runs in a thread of its own so that the server can batch the concurrent requests.
+
+    Results are written in the order of hadm_ids, each as soon as all patients before it are done.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        async def run_patient(_id):
+            async with semaphore:
+                return await loop.run_in_executor(executor, predict, _id)
+
+        tasks = [asyncio.ensure_future(run_patient(_id)) for _id in hadm_ids]
+        try:
+            for _id, task in zip(hadm_ids, tasks):
+                write_result(_id, await task)
+        finally:
+            # On failure, patients that did not start yet are dropped
+            for task in tasks:
+                task.cancel()
+
+
+def run_patients(hadm_ids, predict, write_result, concurrency=1):
+    """
+    Call predict(hadm_id) for every patient and write_result(hadm_id, result) in the order of hadm_ids.
+
+    Args:
+        hadm_ids (list): Admissions to process in order
+        predict (callable): Returns the result of one admission
+        write_result (callable): Stores the result of one admission
+        concurrency (int): Number of admissions processed at once. 1 runs sequentially without asyncio
+    """
+    hadm_ids = list(hadm_ids)
+    if concurrency <= 1:
+        for _id in hadm_ids:
+            write_result(_id, predict(_id))
+        return
+    asyncio.run(run_patients_async(hadm_ids, predict, write_result, concurrency))
+
+
+def run_patient_batches(hadm_ids, predict_batch, write_result, batch_size):
+    """
+    Call predict_batch with up to batch_size patients at once, e.g. to generate for all of them in one forward pass,
+    and write_result(hadm_id, result) in the order of hadm_ids.
+
+    Args:
+        predict_batch (callable): Returns the results of a list of admissions in the same order
+    """
+    hadm_ids = list(hadm_ids)
+    for i in range(0, len(hadm_ids), batch_size):
+        batch = hadm_ids[i : i + batch_size]
+        for _id, result in zip(batch, predict_batch(batch)):
+            write_result(_id, result)
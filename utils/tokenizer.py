@@ -0,0 +1,148 @@
+import sys
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from typing import List
+import weakref
+
+###
+# Common interface over the tokenizers of the supported model backends
+###
+
+
+# The tokenizer libraries are slow to import and not all are needed for every model. A tokenizer can only be an instance of a class whose library is already imported, so check without importing
+def is_tokenizer_of(tokenizer, module_name: str, class_name: str):
+    module = sys.modules.get(module_name)
+    return module is not None and isinstance(tokenizer, getattr(module, class_name))
+
+
+class TokenizerAdapter:
+    """
+    Counts and truncates text in tokens of the wrapped tokenizer. Counts are cached by the hash of the text so that
+    counting the same prompt fragments again is free.
+
+    Subclasses implement encode, encode_many and decode for their tokenizer library.
+    """
+
+    def __init__(self, tokenizer, cache_size: int = 4096):
+        # The shared adapters are keyed by their tokenizer, see get_tokenizer_adapter
+        self.tokenizer_ref = weakref.ref(tokenizer) if tokenizer is not None else None
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        # Patients of a run may be processed in concurrent threads
+        self.lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        if self.tokenizer_ref is None:
+            return None
+        tokenizer = self.tokenizer_ref()
+        if tokenizer is None:
+            raise ReferenceError("The tokenizer of the adapter no longer exists")
+        return tokenizer
+
+    def encode(self, text: str) -> List[int]:
+        raise NotImplementedError
+
+    def encode_many(self, texts: List[str]) -> List[List[int]]:
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens: List[int]) -> str:
+        raise NotImplementedError
+
+    def hash_text(self, text: str):
+        return sha256(text.encode()).digest()
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        """
+        Number of tokens of every text. Texts that are not cached are encoded in one batch.
+        """
+        keys = [self.hash_text(text) for text in texts]
+        with self.lock:
+            counts = {key: self.cache[key] for key in keys if key in self.cache}
+        uncached = {key: text for key, text in zip(keys, texts) if key not in counts}
+        if uncached:
+            for key, tokens in zip(
+                uncached.keys(), self.encode_many(list(uncached.values()))
+            ):
+                counts[key] = len(tokens)
+
+        with self.lock:
+            for key, count in counts.items():
+                self.cache[key] = count
+                self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return [counts[key] for key in keys]
+
+    def truncate_tail(self, text: str, max_tokens: int) -> str:
+        """Keep the first max_tokens tokens of the text"""
+        return self.decode(self.encode(text)[:max_tokens])
+
+    def truncate_head(self, text: str, max_tokens: int) -> str:
+        """Keep the last max_tokens tokens of the text"""
+        if max_tokens <= 0:
+            return ""
+        return self.decode(self.encode(text)[-max_tokens:])
+
+
+class HFTokenizerAdapter(TokenizerAdapter):
+    # Any tokenizer of transformers, e.g. LlamaTokenizer or the AutoTokenizer of the ollama and GGUF models
+    def encode(self, text):
+        return self.tokenizer.encode(text, truncation=False, padding=False)
+
+    def encode_many(self, texts):
+        return self.tokenizer(texts, truncation=False, padding=False)["input_ids"]
+
+    def decode(self, tokens):
+        return self.tokenizer.decode(tokens, skip_special_tokens=True)
+
+
+class TiktokenAdapter(TokenizerAdapter):
+    def encode(self, text):
+        return self.tokenizer.encode(text)
+
+    def encode_many(self, texts):
+        return self.tokenizer.encode_batch(texts)
+
+    def decode(self, tokens):
+        return self.tokenizer.decode(tokens)
+
+
+class ExLlamaV2TokenizerAdapter(TokenizerAdapter):
+    # ExLlamaV2Tokenizer encodes to a tensor of shape (1, tokens). Batches would be padded, so encode one by one
+    def encode(self, text):
+        return self.tokenizer.encode(text)[0]
+
+    def decode(self, tokens):
+        return self.tokenizer.decode(tokens.unsqueeze(0))[0]
+
+
+def create_tokenizer_adapter(tokenizer) -> TokenizerAdapter:
+    if is_tokenizer_of(tokenizer, "exllamav2", "ExLlamaV2Tokenizer"):
+        return ExLlamaV2TokenizerAdapter(tokenizer)
+    elif is_tokenizer_of(tokenizer, "tiktoken", "Encoding"):
+        return TiktokenAdapter(tokenizer)
+    elif is_tokenizer_of(tokenizer, "transformers", "PreTrainedTokenizerBase"):
+        return HFTokenizerAdapter(tokenizer)
+    else:
+        raise ValueError("Tokenizer not supported")
+
+
+# Adapters of the tokenizers in use. Dropped together with their tokenizer
+TOKENIZER_ADAPTERS = weakref.WeakKeyDictionary()
+
+
+def get_tokenizer_adapter(tokenizer) -> TokenizerAdapter:
+    """
+    Shared TokenizerAdapter of a tokenizer, created on first use. The agent, the summarizer and the context length
+    control of a run therefore share one count cache.
+    """
+    if isinstance(tokenizer, TokenizerAdapter):
+        return tokenizer
+    if tokenizer not in TOKENIZER_ADAPTERS:
+        TOKENIZER_ADAPTERS[tokenizer] = create_tokenizer_adapter(tokenizer)
+    return TOKENIZER_ADAPTERS[tokenizer]